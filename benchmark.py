@@ -0,0 +1,370 @@
+from __future__ import division
+import os
+import csv
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+import tensorflow as tf
+from model import build
+from inference import BYTES_PER_PIXEL, restore_generator, run_lowres, run_tiled, tile_size_for_budget
+from quality import psnr, ssim
+from synthesis import ReflectionSynthesizer, k_sz
+from training import TrainingGraph
+from vgg import load_vgg19_weights
+
+# benchmarks of every stage of training and testing on deterministic
+# synthetic inputs, no dataset is needed and the GPU is optional
+
+STAGES = ['decode', 'resize', 'syn_data', 'train', 'inference', 'imwrite', 'hypercolumn', 'lowres']
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--stages", default=STAGES, nargs='+', choices=STAGES,
+                    help="stages to benchmark")
+parser.add_argument("--task", default="",
+                    help="checkpoint folder to benchmark with, random weights if not given")
+parser.add_argument("--is_hyper", default=1, type=int,
+                    help="use hypercolumn or not")
+parser.add_argument("--projected_hypercolumn", default=0, type=int,
+                    help="Benchmark the projected hypercolumn in the train and inference stages")
+parser.add_argument("--train_widths", default=[256, 320, 384, 480], type=int, nargs='+',
+                    help="widths of the training images, the height is 3/4 of the width")
+parser.add_argument("--train_batch_sizes", default=[1, 4], type=int, nargs='+',
+                    help="batch sizes of the training stages")
+parser.add_argument("--sizes", default=["640x480", "1920x1080", "4000x3000"], nargs='+',
+                    help="test image sizes as WIDTHxHEIGHT")
+parser.add_argument("--test_batch_sizes", default=[1], type=int, nargs='+',
+                    help="batch sizes of the inference stage")
+parser.add_argument("--max_dense_pixels", default=640*480, type=int,
+                    help="The inference and hypercolumn stages skip larger test images, the generator needs about "
+                         "%d KB of activations per pixel. 0 runs every size" % (BYTES_PER_PIXEL//1024))
+parser.add_argument("--tile_memory_mb", default=0, type=int,
+                    help="Run the test images larger than --max_dense_pixels tiled with this activation memory "
+                         "budget in the inference stage instead of skipping them")
+parser.add_argument("--lowres_pixels", default=[262144, 65536], type=int, nargs='+',
+                    help="pixel budgets of the lowres stage")
+parser.add_argument("--test_images", default="./test_images/real/",
+                    help="real images of the lowres stage, which compares its outputs with full resolution")
+parser.add_argument("--repeat", default=5, type=int,
+                    help="Number of timed runs per measurement, after one warm-up run")
+parser.add_argument("--seed", default=0, type=int,
+                    help="Seed of the synthetic inputs and random weights")
+parser.add_argument("--cpu", action="store_true",
+                    help="Hide the GPUs from tensorflow")
+parser.add_argument("--output", default="",
+                    help="Write the results to this .json or .csv file")
+
+
+def synthetic_images(n, h, w, seed=0):
+    """Smooth random [n, h, w, 3] float32 images in [0, 1]."""
+    rng = np.random.RandomState(seed)
+    images = rng.uniform(0, 1, (n, h//16+1, w//16+1, 3)).repeat(16, axis=1).repeat(16, axis=2)
+    return np.float32(images[:, :h, :w])*0.8+np.float32(rng.uniform(0, 0.2, (n, h, w, 3)))
+
+
+def time_fn(fn, repeat):
+    """Median time of `repeat` calls of `fn` after a warm-up call."""
+    fn()
+    times = []
+    for _ in range(repeat):
+        st = time.time()
+        fn()
+        times.append(time.time()-st)
+    return float(np.median(times))
+
+
+def time_run(sess, fetches, feed_dict, repeat):
+    """Returns the median time of `repeat` runs and the run metadata of one."""
+    run_time = time_fn(lambda: sess.run(fetches, feed_dict=feed_dict), repeat)
+    metadata = tf.RunMetadata()
+    sess.run(fetches, feed_dict=feed_dict, options=tf.RunOptions(
+        trace_level=tf.RunOptions.FULL_TRACE), run_metadata=metadata)
+    return run_time, metadata
+
+
+def memory_stats(metadata):
+    """Peak allocator usage and largest tensor of a traced run, in bytes.
+
+    The peak is only recorded by allocators that track statistics, which
+    the CPU allocator does not by default, so it may be 0 there.
+    """
+    peak, largest = 0, 0
+    for device in metadata.step_stats.dev_stats:
+        for node in device.node_stats:
+            for memory in node.memory:
+                peak = max(peak, memory.peak_bytes)
+            for output in node.output:
+                largest = max(largest, output.tensor_description.allocation_description.requested_bytes)
+    return peak, largest
+
+
+def record(results, stage, w, h, batch, seconds, **extra):
+    result = {'stage': stage, 'width': w, 'height': h, 'batch': batch,
+              'seconds': seconds, 'images_per_second': batch/max(seconds, 1e-9)}
+    result.update(extra)
+    results.append(result)
+    print("%-22s %5dx%-5d batch %2d %9.2f ms %8.2f images/s%s" % (
+        stage, w, h, batch, seconds*1000, result['images_per_second'],
+        ''.join(', %s %.3g' % item for item in sorted(extra.items()))))
+
+
+def record_failure(results, stage, w, h, batch, error):
+    # a size that does not fit in memory, the other sizes still run
+    results.append({'stage': stage, 'width': w, 'height': h, 'batch': batch, 'error': repr(error)})
+    print("%-22s %5dx%-5d batch %2d failed: %s" % (stage, w, h, batch, type(error).__name__))
+
+
+OUT_OF_MEMORY = (tf.errors.ResourceExhaustedError, MemoryError)
+
+
+def _dense(args, w, h):
+    return not args.max_dense_pixels or w*h <= args.max_dense_pixels
+
+
+def _train_sizes(args):
+    return [(w, w*3//4) for w in args.train_widths]
+
+
+def _test_sizes(args):
+    return [tuple(int(s) for s in size.split('x')) for size in args.sizes]
+
+
+def _init_variables(sess, task, values=None, seed=0):
+    # loads a checkpoint, or random weights, or copies `values` by name.
+    # Returns the values of all variables
+    variables = tf.global_variables()+tf.local_variables()
+    if task:
+        load_vgg19_weights(sess)
+        restore_generator(sess, task)
+    elif values is None:
+        rng = np.random.RandomState(seed)
+        for var in sorted(variables, key=lambda v: v.name):
+            shape = var.get_shape().as_list()
+            if var.dtype.base_dtype != tf.float32 or 'Adam' in var.name or 'power' in var.name:
+                continue
+            scale = 1/np.sqrt(np.prod(shape[:-1])) if len(shape) == 4 else 0.5
+            var.load(np.float32(rng.normal(scale=scale, size=shape)), sess)
+    else:
+        for var in variables:
+            if var.name in values:
+                var.load(values[var.name], sess)
+    return dict(zip([var.name for var in variables], sess.run(variables)))
+
+
+def generator_session(hyper, projected, task, values=None, seed=0):
+    # builds the test-time generator in its own graph
+    graph = tf.Graph()
+    with graph.as_default():
+        input = tf.placeholder(tf.float32, shape=[None, None, None, 3])
+        output = build(input, hyper=hyper, per_image_norm=True, projected=projected)
+        sess = tf.Session(graph=graph)
+        sess.run(tf.global_variables_initializer())
+        values = _init_variables(sess, task, values, seed)
+    return sess, input, output, values
+
+
+def bench_decode(args, results):
+    for w, h in _train_sizes(args)+_test_sizes(args):
+        image = np.uint8(synthetic_images(1, h, w, args.seed)[0]*255)
+        for ext in ('.jpg', '.png'):
+            data = cv2.imencode(ext, image)[1]
+            record(results, 'decode'+ext, w, h, 1, time_fn(
+                lambda: cv2.imdecode(data, cv2.IMREAD_UNCHANGED), args.repeat))
+
+
+def bench_resize(args, results):
+    # the loader converts to float32 and resizes with bicubic interpolation
+    for w, h in _train_sizes(args):
+        image = np.uint8(synthetic_images(1, 2*h, 2*w, args.seed)[0]*255)
+        record(results, 'resize', w, h, 1, time_fn(lambda: cv2.resize(
+            np.float32(image), (w, h), cv2.INTER_CUBIC)/255.0, args.repeat))
+
+
+def bench_syn_data(args, results):
+    synthesizer = ReflectionSynthesizer()
+    for w, h in _train_sizes(args):
+        for n in args.train_batch_sizes:
+            t = synthetic_images(n, h, w, args.seed)
+            r = synthetic_images(n, h, w, args.seed+1)
+            out = [np.empty_like(t) for _ in range(3)]
+            sigmas = [k_sz[i*7 % len(k_sz)] for i in range(n)]
+            record(results, 'syn_data', w, h, n, time_fn(
+                lambda: synthesizer.synthesize_batch(t, r, sigmas, out=out), args.repeat))
+
+
+def bench_train(args, results):
+    graph = tf.Graph()
+    with graph.as_default():
+        model = TrainingGraph(args.is_hyper == 1, args.projected_hypercolumn == 1, fused_update=True)
+        sess = tf.Session(graph=graph)
+        sess.run(tf.global_variables_initializer())
+        _init_variables(sess, args.task, seed=args.seed)
+    for w, h in _train_sizes(args):
+        for n in args.train_batch_sizes:
+            feed_dict = {model.input: synthetic_images(n, h, w, args.seed),
+                         model.target: synthetic_images(n, h, w, args.seed+1),
+                         model.reflection: synthetic_images(n, h, w, args.seed+2)}
+            for stage, fetch in (('d_step', model.d_opt),
+                                 ('g_step_syn', model.g_opt_syn),
+                                 ('g_step_real', model.g_opt_real),
+                                 ('fused_step_syn', model.fused_steps[True])):
+                try:
+                    record(results, stage, w, h, n, time_fn(
+                        lambda: sess.run(fetch, feed_dict=feed_dict), args.repeat))
+                except OUT_OF_MEMORY as e:
+                    record_failure(results, stage, w, h, n, e)
+    sess.close()
+
+
+def bench_inference(args, results):
+    """Times the generator, tile by tile above --max_dense_pixels with --tile_memory_mb."""
+    sess, input, output, _ = generator_session(
+        args.is_hyper == 1, args.projected_hypercolumn == 1, args.task, seed=args.seed)
+    tile_size = 0
+    if args.tile_memory_mb > 0:
+        tile_size = tile_size_for_budget(args.tile_memory_mb, projected=args.projected_hypercolumn == 1)
+    for w, h in _test_sizes(args):
+        if not _dense(args, w, h) and not tile_size:
+            print("%-22s %5dx%-5d skipped, larger than --max_dense_pixels" % ('inference', w, h))
+            continue
+        for n in args.test_batch_sizes:
+            stage = 'inference' if _dense(args, w, h) else 'inference_tiled'
+            try:
+                images = synthetic_images(n, h, w, args.seed)
+                if stage == 'inference':
+                    run_time, metadata = time_run(sess, output, {input: images}, args.repeat)
+                    peak, largest = memory_stats(metadata)
+                    record(results, stage, w, h, n, run_time,
+                           peak_mb=peak/2.**20, largest_tensor_mb=largest/2.**20)
+                else:
+                    # run_tiled reads the nm collections of the default graph
+                    with sess.graph.as_default():
+                        run_time = time_fn(lambda: [run_tiled(sess, input, [output], image, tile_size)
+                                                    for image in images], args.repeat)
+                    record(results, stage, w, h, n, run_time, tile=tile_size)
+            except OUT_OF_MEMORY as e:
+                record_failure(results, stage, w, h, n, e)
+    sess.close()
+
+
+def bench_imwrite(args, results):
+    folder = tempfile.mkdtemp()
+    try:
+        for w, h in _test_sizes(args):
+            image = np.uint8(synthetic_images(1, h, w, args.seed)[0]*255)
+            record(results, 'imwrite.png', w, h, 1, time_fn(lambda: cv2.imwrite(
+                os.path.join(folder, 'out.png'), image), args.repeat))
+    finally:
+        shutil.rmtree(folder)
+
+
+def bench_hypercolumn(args, results):
+    """Compares the full resolution and the projected hypercolumn."""
+    hyper = args.is_hyper == 1
+    dense = generator_session(hyper, False, args.task, seed=args.seed)
+    projected = generator_session(hyper, True, args.task, dense[3], seed=args.seed)
+    for w, h in _test_sizes(args):
+        if not _dense(args, w, h):
+            print("%-22s %5dx%-5d skipped, larger than --max_dense_pixels" % ('hypercolumn', w, h))
+            continue
+        image = synthetic_images(1, h, w, args.seed)
+        outputs = []
+        for name, (sess, input, output, _) in (('dense', dense), ('projected', projected)):
+            try:
+                run_time, metadata = time_run(sess, output, {input: image}, args.repeat)
+                peak, largest = memory_stats(metadata)
+                outputs.append(sess.run(output, feed_dict={input: image}))
+                record(results, 'hypercolumn_'+name, w, h, 1, run_time,
+                       peak_mb=peak/2.**20, largest_tensor_mb=largest/2.**20)
+            except OUT_OF_MEMORY as e:
+                record_failure(results, 'hypercolumn_'+name, w, h, 1, e)
+        if len(outputs) == 2:
+            print("%-22s %5dx%-5d max abs difference %.2e" %
+                  ('hypercolumn', w, h, np.abs(outputs[0]-outputs[1]).max()))
+    dense[0].close()
+    projected[0].close()
+
+
+def bench_lowres(args, results):
+    """Speed and quality of run_lowres against full resolution inference.
+
+    Only meaningful with trained weights (--task).
+    """
+    sess, input, output, _ = generator_session(
+        args.is_hyper == 1, args.projected_hypercolumn == 1, args.task, seed=args.seed)
+    with sess.graph.as_default():
+        fetches = tf.split(output, num_or_size_splits=2, axis=3)
+    for path in sorted(glob.glob(os.path.join(args.test_images, '*'))):
+        img = cv2.imread(path)
+        if img is None:
+            continue
+        image = np.float32(img)/255.0
+        h, w = image.shape[0:2]
+        try:
+            full_time = time_fn(lambda: sess.run(fetches, feed_dict={input: image[np.newaxis]}), args.repeat)
+            full = [np.clip(o[0], 0, 1) for o in sess.run(fetches, feed_dict={input: image[np.newaxis]})]
+        except OUT_OF_MEMORY as e:
+            record_failure(results, 'inference_full', w, h, 1, e)
+            continue
+        record(results, 'inference_full', w, h, 1, full_time)
+        for max_pixels in args.lowres_pixels:
+            low_time = time_fn(lambda: run_lowres(sess, input, fetches, image, max_pixels), args.repeat)
+            low = [np.clip(o[0], 0, 1) for o in run_lowres(sess, input, fetches, image, max_pixels)]
+            record(results, 'lowres_%d' % max_pixels, w, h, 1, low_time,
+                   speedup=full_time/low_time,
+                   psnr_t=psnr(low[0], full[0]), ssim_t=ssim(low[0], full[0]),
+                   psnr_r=psnr(low[1], full[1]), ssim_r=ssim(low[1], full[1]))
+    sess.close()
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = ''
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'tensorflow': tf.__version__, 'opencv': cv2.__version__,
+            'python': platform.python_version(), 'cpus': os.cpu_count(),
+            'gpu': tf.test.is_gpu_available()}
+
+
+def write_results(path, results, env):
+    if path.endswith('.csv'):
+        keys = ['stage', 'width', 'height', 'batch', 'seconds', 'images_per_second',
+                'peak_mb', 'largest_tensor_mb', 'tile', 'speedup', 'psnr_t', 'ssim_t', 'psnr_r', 'ssim_r',
+                'error']+sorted(env)
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, keys, extrasaction='ignore')
+            writer.writeheader()
+            for result in results:
+                row = dict(env)
+                row.update(result)
+                writer.writerow(row)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'environment': env, 'results': results}, f, indent=2)
+    print("[i] Wrote %d results to %s" % (len(results), path))
+
+
+if __name__ == '__main__':
+    ARGS = parser.parse_args()
+    print(ARGS)
+    if ARGS.cpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    env = environment()
+    results = []
+    for stage in ARGS.stages:
+        try:
+            globals()['bench_'+stage](ARGS, results)
+        finally:
+            # after every stage, so a later stage that fails or is killed
+            # does not lose the results
+            if ARGS.output:
+                write_results(ARGS.output, results, env)
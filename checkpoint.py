@@ -0,0 +1,141 @@
+from __future__ import division
+import os
+import glob
+import time
+import threading
+from queue import Queue
+import tensorflow as tf
+from manifest import latest_checkpoint
+
+# checkpoints written on a background thread, so training only waits for
+# the variables to be copied to host memory
+
+
+def checkpoint_files(prefix):
+    return glob.glob(prefix+'.index')+glob.glob(prefix+'.data-*')+glob.glob(prefix+'.meta')
+
+
+class CheckpointManager(object):
+    """Saves checkpoints of a training session asynchronously.
+
+    `save` copies the values of the variables to host memory with one
+    session run and returns; a background thread writes them through a
+    separate graph to temporary files that are renamed into place, data
+    before index, so a checkpoint is never seen half written. Saves of
+    the same variables at the same step are written once and hard-linked.
+    Of the distinct prefixes saved, the `max_to_keep` most recent and the
+    `keep_best` with the lowest metric are kept, the files of the others
+    are deleted. `submit(fn, *args)` runs other slow work, e.g. writing
+    sample images, on the same thread.
+    """
+
+    def __init__(self, sess, max_to_keep=10, keep_best=0, max_queue=2):
+        self.sess = sess
+        self.max_to_keep = max_to_keep
+        self.keep_best = keep_best
+        self.history = []  # (prefix, metric), oldest first
+        self.writers = {}
+        self.error = None
+        self.snapshot_time = 0.0
+        self.queue = Queue(maxsize=max(max_queue, 1))
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, saves, metric=None):
+        """Saves every (prefix, variables) of `saves` from a single snapshot."""
+        if self.error is not None:
+            raise self.error
+        st = time.time()
+        variables = []
+        for _, var_list in saves:
+            variables.extend(var for var in var_list if var not in variables)
+        values = dict(zip([var.op.name for var in variables], self.sess.run(variables)))
+        self.snapshot_time += time.time()-st
+        written = {}
+        for prefix, var_list in saves:
+            names = tuple(sorted(var.op.name for var in var_list))
+            self.queue.put((self._write, (prefix, names, values, written.get(names))))
+            written.setdefault(names, prefix)
+        self.queue.put((self._rotate, ([prefix for prefix, _ in saves], metric)))
+
+    def submit(self, fn, *args):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((fn, args))
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            fn, args = item
+            try:
+                fn(*args)
+            except Exception as e:
+                self.error = e
+
+    def _writer(self, names, values):
+        # one graph per set of variables, its values are fed at every save
+        if names not in self.writers:
+            graph = tf.Graph()
+            with graph.as_default():
+                placeholders = {}
+                var_list = {}
+                for name in names:
+                    value = values[name]
+                    placeholders[name] = tf.placeholder(value.dtype, value.shape)
+                    var_list[name] = tf.Variable(placeholders[name], trainable=False)
+                init = tf.variables_initializer(list(var_list.values()))
+                saver = tf.train.Saver(var_list, max_to_keep=None)
+            self.writers[names] = (tf.Session(graph=graph), placeholders, init, saver)
+        return self.writers[names]
+
+    def _write(self, prefix, names, values, same_as=None):
+        st = time.time()
+        folder = os.path.dirname(prefix)
+        tmp = prefix+'.tmp%d' % os.getpid()
+        if same_as is not None:
+            # identical state, link the files written for `same_as`
+            for path in checkpoint_files(same_as):
+                target = tmp+path[len(same_as):]
+                if os.path.exists(target):
+                    os.remove(target)
+                os.link(path, target)
+        else:
+            sess, placeholders, init, saver = self._writer(names, values)
+            sess.run(init, feed_dict=dict((placeholders[name], values[name]) for name in names))
+            saver.save(sess, tmp, write_meta_graph=False, write_state=False)
+        targets = [prefix+path[len(tmp):] for path in checkpoint_files(tmp)]
+        for path in sorted(targets, key=lambda path: path.endswith('.index')):
+            os.replace(tmp+path[len(prefix):], path)
+        for path in checkpoint_files(prefix):
+            if path not in targets:
+                os.remove(path)  # shards or graph of an older checkpoint
+        tf.train.update_checkpoint_state(folder, os.path.basename(prefix))
+        print("[i] Saved %s in %.2fs" % (prefix, time.time()-st))
+
+    def _rotate(self, prefixes, metric):
+        for prefix in prefixes:
+            self.history = [h for h in self.history if h[0] != prefix]+[(prefix, metric)]
+        keep = set(prefix for prefix, _ in self.history[-self.max_to_keep:])
+        scored = [h for h in self.history if h[1] is not None]
+        keep.update(prefix for prefix, _ in sorted(scored, key=lambda h: h[1])[:self.keep_best])
+        for prefix, _ in self.history:
+            if prefix not in keep:
+                for path in checkpoint_files(prefix):
+                    os.remove(path)
+                state = os.path.join(os.path.dirname(prefix), 'checkpoint')
+                if latest_checkpoint(os.path.dirname(prefix)) == prefix:
+                    os.remove(state)
+        self.history = [h for h in self.history if h[0] in keep]
+
+    def close(self):
+        """Waits for the queued saves and stops the thread."""
+        self.queue.put(None)
+        self.thread.join()
+        for sess, _, _, _ in self.writers.values():
+            sess.close()
+        print("[i] Checkpoints: %.2fs spent copying variables on the training thread" % self.snapshot_time)
+        if self.error is not None:
+            raise self.error
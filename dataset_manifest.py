@@ -0,0 +1,240 @@
+from __future__ import division
+import os
+import glob
+import time
+import sqlite3
+import collections
+import multiprocessing
+import cv2
+import numpy as np
+
+# index of the training images and of the statistics the loader uses to
+# reject samples, so training starts without walking the dataset and never
+# draws a sample that would be rejected
+
+# same heuristics as load_training_sample
+MIN_LAYER_MAX = 0.15
+MIN_INPUT_MAX = 0.1
+
+IMG_EXTENSIONS = [
+    '.jpg', '.JPG', '.jpeg', '.JPEG',
+    '.png', '.PNG', '.ppm', '.PPM', '.bmp', '.BMP',
+]
+
+
+def is_image_file(filename):
+    return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
+
+
+def output_names(paths):
+    """Names of the result folders of the test images `paths`.
+
+    An image is named by its stem, unless other images share it: those are
+    named by their path relative to the common folder of `paths`, with the
+    extension, e.g. a_jpg and a_png or day_a_jpg and night_a_jpg. The names
+    only depend on `paths`, so give all images of a folder, not a subset.
+    """
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    counts = collections.Counter(stems)
+    root = None
+    names, taken = [], set()
+    for path, stem in zip(paths, stems):
+        name = stem
+        if counts[stem] > 1:
+            if root is None:
+                root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+            rel, ext = os.path.splitext(os.path.relpath(os.path.abspath(path), root))
+            name = rel.replace(os.sep, '_')+'_'+ext.lstrip('.')
+        unique, i = name, 1
+        while unique in taken:
+            unique, i = '%s_%d' % (name, i), i+1
+        taken.add(unique)
+        names.append(unique)
+    return names
+
+
+# please follow the dataset directory setup in README
+def prepare_data(train_path):
+    input_names = []
+    image1 = []
+    image2 = []
+    for dirname in train_path:
+        train_t_gt = dirname + "transmission_layer/"
+        train_r_gt = dirname + "reflection_layer/"
+        train_b = dirname + "blended/"
+        for root, _, fnames in sorted(os.walk(train_t_gt)):
+            for fname in fnames:
+                if is_image_file(fname):
+                    path_input = os.path.join(train_b, fname)
+                    path_output1 = os.path.join(train_t_gt, fname)
+                    path_output2 = os.path.join(train_r_gt, fname)
+                    input_names.append(path_input)
+                    image1.append(path_output1)
+                    image2.append(path_output2)
+    return input_names, image1, image2
+
+
+def prepare_synthetic_data(train_path):
+    transmission_images = glob.glob(train_path + "transmission_layer/*")
+    transmission_images = [
+        name for name in transmission_images if is_image_file(name)]
+    reflection_images = glob.glob(train_path + "reflection_layer/*")
+    reflection_images = [
+        name for name in reflection_images if is_image_file(name)]
+    return transmission_images, reflection_images
+
+
+def image_stats(path):
+    """Returns (height, width, mean, max) of an image in [0, 1], or None."""
+    image = cv2.imread(path, -1)
+    if image is None:
+        return None
+    image = np.float32(image)/255.0
+    return image.shape[0], image.shape[1], float(image.mean()), float(image.max())
+
+
+def _index(item):
+    path, size, mtime = item
+    return (path, size, mtime), image_stats(path)
+
+
+class DatasetManifest(object):
+    """SQLite index of the synthetic and real training images.
+
+    `build` records the lists of training files with the size, mtime,
+    dimensions, mean and max intensity of every image. Only images that
+    are new or whose size or mtime changed are decoded, by `num_workers`
+    processes. `lists` returns the training files without touching the
+    dataset and `sampler` draws only samples that pass the rejection
+    checks of the loader.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=600)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, size INTEGER, "
+                              "mtime INTEGER, height INTEGER, width INTEGER, mean REAL, max REAL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entries (role TEXT, path TEXT, pair TEXT)")
+
+    def build(self, syn_t, syn_r, real_inputs, real_t, num_workers=None):
+        st = time.time()
+        paths = sorted(set(syn_t) | set(syn_r) | set(real_inputs) | set(real_t))
+        known = dict((row[0], row[1:]) for row in self.conn.execute("SELECT path, size, mtime FROM images"))
+        todo = []
+        for path in paths:
+            stat = os.stat(path)
+            if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+                todo.append((path, stat.st_size, stat.st_mtime_ns))
+        # fork, like the loader, so the caller does not have to be import safe
+        pool = multiprocessing.get_context('fork').Pool(num_workers)
+        try:
+            rows = []
+            for (path, size, mtime), stats in pool.imap_unordered(_index, todo, chunksize=16):
+                if stats is None:
+                    print("[!] Could not read %s, it will not be sampled" % path)
+                    stats = (0, 0, 0.0, 0.0)
+                rows.append((path, size, mtime)+stats)
+        finally:
+            pool.close()
+            pool.join()
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute("DELETE FROM entries")
+            self.conn.executemany("INSERT INTO entries VALUES (?, ?, ?)",
+                                  [('syn_t', path, None) for path in syn_t] +
+                                  [('syn_r', path, None) for path in syn_r] +
+                                  [('real', path, pair) for path, pair in zip(real_inputs, real_t)])
+            self.conn.execute("DELETE FROM images WHERE path NOT IN "
+                              "(SELECT path FROM entries UNION SELECT pair FROM entries WHERE pair IS NOT NULL)")
+        print("[i] Dataset manifest %s: indexed %d of %d images in %.2fs" %
+              (self.path, len(todo), len(paths), time.time()-st))
+
+    def lists(self):
+        """Returns (syn_t, syn_r, real_inputs, real_t) in the order they were built."""
+        syn_t, syn_r, real_inputs, real_t = [], [], [], []
+        for role, path, pair in self.conn.execute("SELECT role, path, pair FROM entries ORDER BY rowid"):
+            if role == 'syn_t':
+                syn_t.append(path)
+            elif role == 'syn_r':
+                syn_r.append(path)
+            else:
+                real_inputs.append(path)
+                real_t.append(pair)
+        return syn_t, syn_r, real_inputs, real_t
+
+    def sampler(self):
+        stats = dict((row[0], row[1:]) for row in self.conn.execute("SELECT path, mean, max FROM images"))
+        return ValidSampler(*(self.lists()+(stats,)))
+
+    def close(self):
+        self.conn.close()
+
+
+class ValidSampler(object):
+    """Draws training files that pass the rejection checks of the loader.
+
+    A synthetic pair is rejected when half the mean of the transmission
+    exceeds the mean of the reflection, or when either layer has a maximum
+    below 0.15; a real pair when the maximum of its transmission is below
+    0.15 or that of its input below 0.1. Pairs are drawn uniformly among
+    the compatible ones, the same distribution as drawing any pair and
+    rejecting it. The statistics are those of the full resolution images,
+    the loader still checks the resized images.
+    """
+
+    def __init__(self, syn_t, syn_r, real_inputs, real_t, stats):
+        reflections = sorted((stats[path][0], path) for path in syn_r if stats[path][1] >= MIN_LAYER_MAX)
+        self.syn_r = [path for _, path in reflections]
+        r_means = np.array([mean for mean, _ in reflections])
+        self.syn_t, first = [], []
+        for path in syn_t:
+            mean, peak = stats[path]
+            # compatible reflections are the ones with a mean of at least mean/2
+            i = np.searchsorted(r_means, mean/2, 'left')
+            if peak >= MIN_LAYER_MAX and i < len(self.syn_r):
+                self.syn_t.append(path)
+                first.append(i)
+        self.first = np.array(first, dtype=np.int64)
+        self.cumulative = np.cumsum(len(self.syn_r)-self.first)
+        self.real = [(path, pair) for path, pair in zip(real_inputs, real_t)
+                     if stats[path][1] >= MIN_INPUT_MAX and stats[pair][1] >= MIN_LAYER_MAX]
+        print("[i] Valid training files: %d of %d transmission and %d of %d reflection layers "
+              "(%d compatible pairs), %d of %d real pairs" %
+              (len(self.syn_t), len(syn_t), len(self.syn_r), len(syn_r),
+               self.cumulative[-1] if len(self.syn_t) else 0, len(self.real), len(real_inputs)))
+
+    def syn_pair(self):
+        """Returns the paths of a compatible transmission and reflection layer."""
+        # transmission layers weighted by their number of compatible reflections
+        k = np.searchsorted(self.cumulative, np.random.randint(self.cumulative[-1]), 'right')
+        return self.syn_t[k], self.syn_r[np.random.randint(self.first[k], len(self.syn_r))]
+
+    def real_pair(self):
+        """Returns the paths of a real input and its transmission layer."""
+        return self.real[np.random.randint(len(self.real))]
+
+
+def training_files(syn_root, real_roots, manifest_path='', refresh=False):
+    """Lists the training files, from the manifest at `manifest_path` if given.
+
+    The manifest is built when it does not exist or with `refresh`. Returns
+    (syn_t, syn_r, real_inputs, real_t, sampler), `sampler` is a
+    ValidSampler with a manifest and None without.
+    """
+    dataset, sampler = None, None
+    if manifest_path:
+        build = refresh or not os.path.exists(manifest_path)
+        dataset = DatasetManifest(manifest_path)
+    if dataset is None or build:
+        syn_t, syn_r = prepare_synthetic_data(
+            syn_root)  # image pairs for generating synthetic training images
+        real_inputs, real_t, _ = prepare_data(
+            real_roots)  # no reflection ground truth for real images
+    if dataset is not None:
+        if build:
+            dataset.build(syn_t, syn_r, real_inputs, real_t)
+        syn_t, syn_r, real_inputs, real_t = dataset.lists()
+        sampler = dataset.sampler()
+        dataset.close()
+    return syn_t, syn_r, real_inputs, real_t, sampler
@@ -0,0 +1,368 @@
+from __future__ import division
+import os
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+from threading import BrokenBarrierError
+import numpy as np
+from dataset_manifest import training_files
+
+# data-parallel training with several processes on one machine. Every
+# worker runs the training graph on its own samples, the gradients are
+# averaged in shared memory at every step so the weights stay identical.
+# Tensorflow is only imported in the workers
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--task", default="pre-trained",
+                    help="path to folder containing the model")
+parser.add_argument("--data_syn_dir", default="",
+                    help="input synthetic data")
+parser.add_argument("--data_real_dir", default="", help="path to real dataset")
+parser.add_argument("--dataset_manifest", default="",
+                    help="Index of the training images, see main.py")
+parser.add_argument("--is_hyper", default=1, type=int,
+                    help="use hypercolumn or not")
+parser.add_argument("--projected_hypercolumn", default=0, type=int,
+                    help="Project the vgg features before upsampling them instead of building the full resolution hypercolumn")
+parser.add_argument("--continue_training", action="store_true",
+                    help="search for checkpoint in the subfolder specified by `task` argument")
+parser.add_argument("--data_syn_ratio", default=0.7, type=float,
+                    help="ratio of synthetic images to be used in the training")
+parser.add_argument("--n_images_epoch", default=-1, type=int,
+                    help="number of images per epoch, over all workers; by default, all training images")
+parser.add_argument("--max_epochs", default=100, type=int,
+                    help="maximum number of epochs")
+parser.add_argument("--save_model_freq", default=1, type=int,
+                    help="frequency to save model")
+parser.add_argument("--discriminator_update_freq", default=2, type=int,
+                    help="frequency to update discriminator")
+parser.add_argument("--lr", default=[0.0002, 0.0001], type=float, nargs=2,
+                    help="Learning rates of the generator and of the discriminator")
+parser.add_argument("--batch_size", default=1, type=int,
+                    help="Number of training images per step and worker")
+parser.add_argument("--num_workers", default=2, type=int,
+                    help="Number of training processes")
+parser.add_argument("--threads", default=0, type=int,
+                    help="intra-op threads of every worker session, by default the cores are shared among the workers")
+parser.add_argument("--affinity", action="store_true",
+                    help="Pin every worker to its own --threads cores")
+parser.add_argument("--gpu", action="store_true",
+                    help="Let the workers use the GPUs, by default they run on the CPU")
+parser.add_argument("--loader_workers", default=1, type=int,
+                    help="Number of data loading processes of every worker")
+parser.add_argument("--prefetch", default=8, type=int,
+                    help="Maximum number of training samples loaded ahead by every worker")
+parser.add_argument("--metrics_log", default="",
+                    help="Log of the losses averaged over the workers, `task`/train_metrics.csv if not given")
+parser.add_argument("--scaling_steps", default=0, type=int,
+                    help="Instead of training, time this many steps with 1, 2, 4... --num_workers workers on synthetic data")
+parser.add_argument("--scaling_size", default="320x240",
+                    help="Size of the synthetic training images of --scaling_steps")
+parser.add_argument("--scaling_output", default="",
+                    help="Write the scaling results to this JSON file")
+
+LOSSES = ['d_loss', 'g_loss', 'loss', 'percep_loss', 'exclusion_loss']
+
+
+class SharedAllReduce(object):
+    """Averages float32 vectors over `num_workers` processes in shared memory.
+
+    Every rank writes its vector to its own row, averages its slice of the
+    columns into the last row once all rows are written (reduce-scatter),
+    and reads the whole average once all slices are done (all-gather).
+    Rank 0 creates the memory-mapped file `path`, the others map it.
+    """
+
+    def __init__(self, path, rank, num_workers, size, barrier):
+        self.path = path
+        self.rank = rank
+        self.num_workers = num_workers
+        self.barrier = barrier
+        if rank == 0:
+            np.memmap(path, dtype=np.float32, mode='w+', shape=(num_workers+1, size)).flush()
+        barrier.wait()
+        self.buffer = np.memmap(path, dtype=np.float32, mode='r+', shape=(num_workers+1, size))
+        chunk = -(-size//num_workers)
+        self.begin, self.end = rank*chunk, min((rank+1)*chunk, size)
+        self.wait_time = 0.0
+
+    def _wait(self):
+        st = time.time()
+        self.barrier.wait()
+        self.wait_time += time.time()-st
+
+    def _check(self, vector):
+        if len(vector) > self.buffer.shape[1]:
+            raise ValueError("vector of %d elements does not fit the %d of the shared buffer" %
+                             (len(vector), self.buffer.shape[1]))
+
+    def allreduce(self, vector):
+        self._check(vector)
+        n = len(vector)
+        self.buffer[self.rank, :n] = vector
+        self._wait()
+        end = min(self.end, n)
+        if self.begin < end:
+            self.buffer[-1, self.begin:end] = self.buffer[:-1, self.begin:end].mean(axis=0)
+        self._wait()
+        # the next call only writes the last row after everyone passed its first barrier
+        return self.buffer[-1, :n].copy()
+
+    def broadcast(self, vector):
+        """Returns the vector of rank 0 on every rank."""
+        self._check(vector)
+        if self.rank == 0:
+            self.buffer[-1, :len(vector)] = vector
+        self._wait()
+        vector = self.buffer[-1, :len(vector)].copy()
+        self._wait()
+        return vector
+
+    def close(self):
+        del self.buffer
+        if self.rank == 0:
+            os.remove(self.path)
+
+
+def shared_path(name):
+    # /dev/shm keeps the segment in memory, fall back to a file elsewhere
+    folder = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(folder, name)
+
+
+def flatten(arrays):
+    return np.concatenate([np.ravel(a) for a in arrays]).astype(np.float32)
+
+
+def unflatten(vector, shapes):
+    arrays, offset = [], 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        arrays.append(vector[offset:offset+size].reshape(shape))
+        offset += size
+    return arrays
+
+
+def _batches(args, files, sampler):
+    # returns the loader, which starts its workers now, and its batches
+    from loader import BucketBatcher, PrefetchLoader, load_training_sample
+    import functools
+    loader = PrefetchLoader(functools.partial(
+        load_training_sample, *files, args.data_syn_ratio, sampler=sampler),
+        num_workers=args.loader_workers, prefetch=args.prefetch)
+    batcher = BucketBatcher(args.batch_size)
+
+    def batches():
+        while True:
+            sample = loader.get()
+            if sample is not None:
+                for batch in batcher.add(0, sample):
+                    yield batch[1:5]
+    return loader, batches()
+
+
+def _synthetic_batches(args, rank):
+    from benchmark import synthetic_images
+    w, h = [int(v) for v in args.scaling_size.split('x')]
+    batch = [synthetic_images(args.batch_size, h, w, seed=3*rank+i) for i in range(3)]
+    while True:
+        yield batch[0], batch[1], batch[2], True
+
+
+def _worker(args, rank, num_workers, threads, cpus, shm_path, barrier, messages, files, sampler, steps):
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if not args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    import cv2
+    cv2.setNumThreads(1)
+    loader = None
+    if steps:
+        batches = _synthetic_batches(args, rank)
+    else:
+        # the loader forks its workers, before tensorflow starts the threads
+        # of the session
+        loader, batches = _batches(args, files, sampler)
+    import tensorflow as tf
+    from training import TrainingGraph
+    from vgg import load_vgg19_weights
+    model = TrainingGraph(args.is_hyper == 1, args.projected_hypercolumn == 1, args.lr, replicated=True)
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)
+    sess = tf.Session(config=config)
+    sess.run(tf.global_variables_initializer())
+    load_vgg19_weights(sess)
+    train_vars = model.g_vars+model.d_vars
+    g_shapes = [var.shape.as_list() for var in model.g_vars]
+    d_shapes = [var.shape.as_list() for var in model.d_vars]
+    g_size = sum(int(np.prod(shape)) for shape in g_shapes)
+    d_size = sum(int(np.prod(shape)) for shape in d_shapes)
+    checkpoints, metrics = None, None
+    if rank == 0:
+        ckpt = tf.train.get_checkpoint_state(args.task)
+        if ckpt is not None and steps is None:
+            if args.continue_training:
+                restore_vars = tf.trainable_variables()
+            else:
+                restore_vars = [var for var in tf.trainable_variables() if 'discriminator' not in var.name]
+            print('loaded '+ckpt.model_checkpoint_path)
+            tf.train.Saver(restore_vars).restore(sess, ckpt.model_checkpoint_path)
+    # the weights of both networks at the start, then the gradients of either
+    # network, with the losses and is_syn after those of the generator
+    reducer = SharedAllReduce(shm_path, rank, num_workers, max(g_size+d_size, g_size+len(LOSSES)+1), barrier)
+    values = unflatten(reducer.broadcast(flatten(sess.run(train_vars))), g_shapes+d_shapes)
+    for var, value in zip(train_vars, values):
+        var.load(value, sess)
+    if rank == 0 and steps is None:
+        from checkpoint import CheckpointManager
+        from train_metrics import TrainMetrics
+        checkpoints = CheckpointManager(sess)
+        metrics = TrainMetrics(args.metrics_log or "%s/train_metrics.csv" % args.task,
+                               LOSSES+['step_time', 'allreduce_time'])
+
+    def step(cnt):
+        input_images, output_images_t, output_images_r, is_syn = next(batches)
+        feed_dict = {model.input: input_images, model.target: output_images_t}
+        if cnt % args.discriminator_update_freq == 0:
+            d_grads = sess.run(model.d_opt, feed_dict=feed_dict)
+            d_grads = unflatten(reducer.allreduce(flatten(d_grads)), d_shapes)
+            sess.run(model.d_apply, feed_dict=dict(zip(model.d_grad_inputs, d_grads)))
+        if is_syn:
+            feed_dict[model.reflection] = output_images_r
+        fetches = sess.run(model.g_fetches[is_syn], feed_dict=feed_dict)
+        losses = list(fetches[3:])
+        losses[-1] *= 255*is_syn
+        averaged = reducer.allreduce(flatten(fetches[0]+[losses, [is_syn]]))
+        sess.run(model.g_apply, feed_dict=dict(zip(model.g_grad_inputs, unflatten(averaged, g_shapes))))
+        return averaged[g_size:]
+
+    try:
+        if steps:
+            # scaling measurement, the first steps warm up
+            for cnt in range(2):
+                step(cnt)
+            barrier.wait()
+            st = time.time()
+            for cnt in range(steps):
+                step(cnt)
+            messages.put(('rate', rank, steps*args.batch_size*num_workers/(time.time()-st)))
+        else:
+            steps_per_epoch = max(files_per_epoch(args, files)//(num_workers*args.batch_size), 1)
+            iteration = 0
+            for epoch in range(1, args.max_epochs):
+                st = time.time()
+                for cnt in range(steps_per_epoch):
+                    step_st, allreduce_time = time.time(), reducer.wait_time
+                    averaged = step(cnt)
+                    if metrics is not None:
+                        values = dict(zip(LOSSES[:-1], averaged[:4]))
+                        if averaged[-1] > 0:
+                            # only defined for synthetic images, averaged over those
+                            values['exclusion_loss'] = averaged[4]/averaged[-1]
+                        metrics.update(iteration, epoch, step_time=time.time()-step_st,
+                                       allreduce_time=reducer.wait_time-allreduce_time, **values)
+                        print("iter: %d %d || D: %.2f || G: %.2f %.2f || all: %.2f || mean: %.2f %.2f || time: %.2f" %
+                              (epoch, cnt, averaged[0], averaged[1], metrics.mean('g_loss'),
+                               metrics.mean('loss'), metrics.mean('percep_loss'),
+                               metrics.mean('exclusion_loss'), time.time()-step_st))
+                    iteration += 1
+                if metrics is not None:
+                    stats = metrics.end_epoch()
+                    print("[i] Epoch %d: %d steps of %d images in %.2fs, %.3fs per step waiting for the other workers" %
+                          (epoch, steps_per_epoch, num_workers*args.batch_size, time.time()-st,
+                           stats['allreduce_time']['mean']))
+                    if epoch % args.save_model_freq == 0:
+                        checkpoints.save([("%s/model.ckpt" % args.task, tf.trainable_variables())],
+                                         metric=stats['loss']['mean'])
+    except BrokenBarrierError:
+        return  # another worker failed, the launcher reports it
+    finally:
+        if checkpoints is not None:
+            checkpoints.close()
+            metrics.close()
+        if loader is not None:
+            loader.close()
+    reducer.close()
+
+
+def files_per_epoch(args, files):
+    if args.n_images_epoch == -1:
+        return len(files[0])+len(files[3])
+    return args.n_images_epoch
+
+
+def run_workers(args, num_workers, files=None, sampler=None, steps=None):
+    """Runs `num_workers` training processes until they finish.
+
+    Returns the messages of the workers. If a worker fails the others are
+    stopped and RuntimeError is raised.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    messages = ctx.Queue()
+    barrier = ctx.Barrier(num_workers)
+    cores = sorted(os.sched_getaffinity(0))
+    threads = args.threads or max(1, len(cores)//num_workers)
+    shm_path = shared_path('reflection_removal_%d_%d' % (os.getpid(), num_workers))
+    workers = []
+    for rank in range(num_workers):
+        cpus = None
+        if args.affinity:
+            cpus = set(cores[(rank*threads+j) % len(cores)] for j in range(threads))
+        p = ctx.Process(target=_worker, args=(args, rank, num_workers, threads, cpus, shm_path,
+                                              barrier, messages, files, sampler, steps))
+        p.daemon = True
+        p.start()
+        workers.append(p)
+    received = []
+    while any(p.is_alive() for p in workers):
+        for p in workers:
+            p.join(timeout=1.0)
+            if p.exitcode not in (None, 0):
+                # unblock the workers waiting for it
+                barrier.abort()
+                for q in workers:
+                    q.terminate()
+                    q.join()
+                if os.path.exists(shm_path):
+                    os.remove(shm_path)
+                raise RuntimeError("worker %d exited with code %s" % (workers.index(p), p.exitcode))
+        while not messages.empty():
+            received.append(messages.get())
+    while not messages.empty():
+        received.append(messages.get())
+    return received
+
+
+def scaling(args):
+    """Times the training steps with 1, 2, 4... workers sharing the cores."""
+    results = []
+    counts = [2**i for i in range(args.num_workers.bit_length()) if 2**i < args.num_workers]+[args.num_workers]
+    for num_workers in counts:
+        messages = run_workers(args, num_workers, steps=args.scaling_steps)
+        rate = [value for kind, rank, value in messages if kind == 'rate' and rank == 0][0]
+        results.append({'workers': num_workers, 'images_per_second': rate,
+                        'efficiency': rate/(num_workers*results[0]['images_per_second']) if results else 1.0})
+        print("[i] %2d workers: %.2f images/s, scaling efficiency %.0f%%" %
+              (num_workers, rate, 100*results[-1]['efficiency']))
+    if args.scaling_output:
+        with open(args.scaling_output, 'w') as f:
+            json.dump({'cores': len(os.sched_getaffinity(0)), 'size': args.scaling_size,
+                       'batch_size': args.batch_size, 'results': results}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    ARGS = parser.parse_args()
+    print(ARGS)
+    if ARGS.scaling_steps:
+        scaling(ARGS)
+    else:
+        if not os.path.isdir(ARGS.task):
+            os.makedirs(ARGS.task)
+        syn_t, syn_r, real_inputs, real_t, sampler = training_files(
+            ARGS.data_syn_dir, [ARGS.data_real_dir], ARGS.dataset_manifest)
+        print("[i] Total %d training images, %d workers" % (len(syn_t)+len(real_t), ARGS.num_workers))
+        st = time.time()
+        run_workers(ARGS, ARGS.num_workers, (syn_t, syn_r, real_inputs, real_t), sampler)
+        print("[i] Training done in %.2fs" % (time.time()-st))
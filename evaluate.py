@@ -0,0 +1,224 @@
+from __future__ import division
+import os
+import csv
+import json
+import time
+import argparse
+import resource
+import multiprocessing
+import cv2
+import numpy as np
+from dataset_manifest import is_image_file, output_names, prepare_data
+from quality import psnr, ssim
+
+# scores the transmission layers of one or more models or inference modes
+# on a test set, together with their speed and memory. Every model runs in
+# its own process, tensorflow is only imported there
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model", default=[], action="append",
+                    help="name[:key=value,...] of a model to evaluate, can be repeated. Keys are task, frozen_model, "
+                         "is_hyper, projected_hypercolumn, lowres_pixels, tile_memory_mb and threads")
+parser.add_argument("--data_dir", default="./test_images/real/",
+                    help="Test set with blended/ and transmission_layer/ folders, or a folder of images, "
+                         "which are then scored against the outputs of the first model")
+parser.add_argument("--output_dir", default="./eval_results",
+                    help="Folder of the outputs of every model and of the reports")
+parser.add_argument("--num_workers", default=0, type=int,
+                    help="Processes computing PSNR and SSIM, by default one per core")
+parser.add_argument("--percep_batch", default=4, type=int,
+                    help="Number of images of the same size whose perceptual distance is computed together")
+
+MODEL_OPTIONS = {'task': str, 'frozen_model': str, 'is_hyper': int, 'projected_hypercolumn': int,
+                 'lowres_pixels': int, 'tile_memory_mb': int, 'threads': int}
+
+
+def parse_model(spec):
+    """Parses name[:key=value,...] into (name, options)."""
+    name, _, rest = spec.partition(':')
+    options = {'task': 'pre-trained', 'frozen_model': '', 'is_hyper': 1, 'projected_hypercolumn': 0,
+               'lowres_pixels': 0, 'tile_memory_mb': 0, 'threads': 0}
+    for item in filter(None, rest.split(',')):
+        key, _, value = item.partition('=')
+        if key not in MODEL_OPTIONS:
+            raise ValueError("Unknown option %s in --model %s" % (key, spec))
+        options[key] = MODEL_OPTIONS[key](value)
+    return name, options
+
+
+def test_set(data_dir):
+    """Returns (names, input paths, reference transmission paths or None)."""
+    data_dir = os.path.join(data_dir, '')
+    if os.path.isdir(data_dir+'blended') and os.path.isdir(data_dir+'transmission_layer'):
+        inputs, references, _ = prepare_data([data_dir])
+    else:
+        inputs = sorted(os.path.join(data_dir, f) for f in os.listdir(data_dir) if is_image_file(f))
+        references = None
+    names = output_names(inputs)
+    return names, inputs, references
+
+
+def _perceptual_graph():
+    # per-image perceptual distance of a batch, weighted like the training loss
+    import tensorflow as tf
+    from training import PERCEP_LAYERS
+    from vgg import build_vgg19
+    images = tf.placeholder(tf.float32, shape=[None, None, None, 3])
+    references = tf.placeholder(tf.float32, shape=[None, None, None, 3])
+    vgg = build_vgg19(tf.concat([images, references], axis=0)*255.0)
+    distance = 0.
+    for layer, weight in PERCEP_LAYERS:
+        fake, real = tf.split(vgg[layer], 2, axis=0)
+        distance += tf.reduce_mean(tf.abs(real-fake), axis=[1, 2, 3])*weight
+    return images, references, distance
+
+
+def _run_model(name, options, names, inputs, references, output_dir, percep_batch, messages):
+    # runs in a fresh process, so the memory peak is the one of this model
+    if options['threads']:
+        os.sched_setaffinity(0, set(sorted(os.sched_getaffinity(0))[:options['threads']]))
+    import tensorflow as tf
+    from inference import GENERATOR_HALO, load_model, run_lowres, run_tiled, tile_size_for_budget
+    from vgg import load_vgg19_weights
+    st = time.time()
+    config = None
+    if options['threads']:
+        config = tf.ConfigProto(intra_op_parallelism_threads=options['threads'])
+    sess, input, transmission_layer, reflection_layer = load_model(
+        options['frozen_model'] or options['task'], hyper=options['is_hyper'] == 1,
+        projected=options['projected_hypercolumn'] == 1, config=config)
+    fetches = [transmission_layer, reflection_layer]
+    percep_images, percep_references, percep_distance = _perceptual_graph()
+    load_vgg19_weights(sess)
+    load_time = time.time()-st
+    tile_size, max_pixels = 0, 0
+    if options['tile_memory_mb'] > 0:
+        tile_size = tile_size_for_budget(options['tile_memory_mb'],
+                                         projected=options['projected_hypercolumn'] == 1)
+        max_pixels = (tile_size+2*GENERATOR_HALO)**2
+
+    def infer(image):
+        if options['lowres_pixels'] and image.shape[0]*image.shape[1] > options['lowres_pixels']:
+            return run_lowres(sess, input, fetches, image, options['lowres_pixels'])
+        if tile_size and image.shape[0]*image.shape[1] > max_pixels:
+            return run_tiled(sess, input, fetches, image, tile_size)
+        return sess.run(fetches, feed_dict={input: image[np.newaxis]})
+
+    folder = os.path.join(output_dir, name)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    rows, groups = [], {}
+    for i, (testind, path) in enumerate(zip(names, inputs)):
+        image = np.float32(cv2.imread(path))/255.0
+        if i == 0:
+            infer(image)  # warm up
+        st = time.time()
+        output_t, output_r = infer(image)
+        latency = time.time()-st
+        output = np.uint8(np.clip(output_t[0], 0, 1)*255.0+0.5)
+        cv2.imwrite(os.path.join(folder, testind+'_t.png'), output)
+        cv2.imwrite(os.path.join(folder, testind+'_r.png'), np.uint8(np.clip(output_r[0], 0, 1)*255.0+0.5))
+        rows.append({'model': name, 'image': testind, 'height': image.shape[0], 'width': image.shape[1],
+                     'latency': latency})
+        if references is not None:
+            groups.setdefault(image.shape, []).append(i)
+    # perceptual distances of the images of the same size, in batches
+    for indices in groups.values():
+        for k in range(0, len(indices), max(percep_batch, 1)):
+            batch = indices[k:k+max(percep_batch, 1)]
+            outputs = [cv2.imread(os.path.join(folder, names[i]+'_t.png')) for i in batch]
+            targets = [cv2.imread(references[i]) for i in batch]
+            if any(t is None or t.shape != o.shape for o, t in zip(outputs, targets)):
+                continue
+            distances = sess.run(percep_distance, feed_dict={
+                percep_images: np.float32(outputs)/255.0, percep_references: np.float32(targets)/255.0})
+            for i, distance in zip(batch, distances):
+                rows[i]['perceptual'] = float(distance)
+    sess.close()
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+    messages.put((rows, load_time, peak_mb))
+
+
+def _scores(item):
+    output_path, reference_path = item
+    output, reference = cv2.imread(output_path), cv2.imread(reference_path)
+    if output is None or reference is None or output.shape != reference.shape:
+        return {}
+    output, reference = np.float32(output)/255.0, np.float32(reference)/255.0
+    return {'psnr': psnr(output, reference), 'ssim': ssim(output, reference)}
+
+
+def evaluate_model(name, options, names, inputs, references, args, pool):
+    """Runs a model in its own process and scores it, returns (rows, summary)."""
+    ctx = multiprocessing.get_context('spawn')
+    messages = ctx.Queue()
+    p = ctx.Process(target=_run_model, args=(name, options, names, inputs, references,
+                                             args.output_dir, args.percep_batch, messages))
+    p.start()
+    while p.is_alive() and messages.empty():
+        p.join(timeout=1.0)
+    if messages.empty():
+        raise RuntimeError("model %s exited with code %s" % (name, p.exitcode))
+    rows, load_time, peak_mb = messages.get()
+    p.join()
+    if references is not None:
+        folder = os.path.join(args.output_dir, name)
+        items = [(os.path.join(folder, testind+'_t.png'), reference)
+                 for testind, reference in zip(names, references)]
+        for row, scores in zip(rows, pool.map(_scores, items)):
+            row.update(scores)
+    latencies = np.array([row['latency'] for row in rows])
+    summary = {'model': name, 'options': options, 'images': len(rows), 'load_time': load_time,
+               'latency_mean': float(latencies.mean()), 'latency_p50': float(np.percentile(latencies, 50)),
+               'latency_p90': float(np.percentile(latencies, 90)),
+               'images_per_second': len(rows)/float(latencies.sum()), 'peak_mb': peak_mb}
+    for key in ['psnr', 'ssim', 'perceptual']:
+        values = [row[key] for row in rows if key in row and np.isfinite(row[key])]
+        summary[key] = float(np.mean(values)) if values else None
+    return rows, summary
+
+
+def _format(value, spec):
+    return spec % value if value is not None else '-'
+
+
+if __name__ == '__main__':
+    ARGS = parser.parse_args()
+    print(ARGS)
+    models = [parse_model(spec) for spec in ARGS.model or ['pre-trained']]
+    if len(set(name for name, _ in models)) != len(models):
+        raise ValueError("Every --model needs its own name")
+    names, inputs, references = test_set(ARGS.data_dir)
+    if not os.path.isdir(ARGS.output_dir):
+        os.makedirs(ARGS.output_dir)
+    print("[i] %d test images, %s" % (len(inputs), "with ground truth" if references is not None else
+                                     "scored against the outputs of %s" % models[0][0]))
+    pool = multiprocessing.get_context('fork').Pool(ARGS.num_workers or None)
+    all_rows, summaries = [], []
+    for i, (name, options) in enumerate(models):
+        if references is None and i > 0:
+            model_references = [os.path.join(ARGS.output_dir, models[0][0], testind+'_t.png') for testind in names]
+        else:
+            model_references = references
+        rows, summary = evaluate_model(name, options, names, inputs, model_references, ARGS, pool)
+        all_rows.extend(rows)
+        summaries.append(summary)
+    pool.close()
+    pool.join()
+
+    columns = ['model', 'image', 'height', 'width', 'latency', 'psnr', 'ssim', 'perceptual']
+    with open(os.path.join(ARGS.output_dir, 'per_image.csv'), 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(all_rows)
+    with open(os.path.join(ARGS.output_dir, 'report.json'), 'w') as f:
+        json.dump({'data_dir': ARGS.data_dir, 'ground_truth': references is not None,
+                   'models': summaries}, f, indent=2)
+    print("%-16s %8s %8s %10s %12s %10s %9s" %
+          ('model', 'PSNR', 'SSIM', 'perceptual', 'latency p50', 'images/s', 'peak MB'))
+    for summary in summaries:
+        print("%-16s %8s %8s %10s %11.3fs %10.2f %9.0f" % (
+            summary['model'], _format(summary['psnr'], '%.2f'), _format(summary['ssim'], '%.4f'),
+            _format(summary['perceptual'], '%.3f'), summary['latency_p50'],
+            summary['images_per_second'], summary['peak_mb']))
+    print("[i] Reports written to %s" % ARGS.output_dir)
@@ -0,0 +1,128 @@
+from __future__ import division
+import os
+import json
+import time
+import argparse
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework import graph_util, tensor_util
+from tensorflow.tools.graph_transforms import TransformGraph
+from inference import MODEL_COLLECTIONS, MODEL_OUTPUTS, build_inference_graph, restore_generator
+from vgg import load_vgg19_weights
+
+# exports the generator of a checkpoint as a self-contained frozen graph
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--task", default="pre-trained",
+                    help="path to folder containing the model")
+parser.add_argument("--output", default="",
+                    help="path of the frozen graph, `task`/model[_quantize].pb if not given")
+parser.add_argument("--is_hyper", default=1, type=int,
+                    help="use hypercolumn or not")
+parser.add_argument("--projected_hypercolumn", default=0, type=int,
+                    help="Project the vgg features before upsampling them instead of building the full resolution hypercolumn")
+parser.add_argument("--quantize", default="none", choices=["none", "float16", "int8"],
+                    help="Store the weights as float16 or as int8 with a scale per output channel")
+parser.add_argument("--quantize_min_size", default=1024, type=int,
+                    help="Only quantize weights with at least this many elements")
+ARGS = parser.parse_args()
+print(ARGS)
+
+
+def _const(name, value):
+    node = tf.NodeDef()
+    node.op = 'Const'
+    node.name = name
+    node.attr['dtype'].CopyFrom(tf.AttrValue(
+        type=tf.as_dtype(value.dtype).as_datatype_enum))
+    node.attr['value'].CopyFrom(tf.AttrValue(
+        tensor=tensor_util.make_tensor_proto(value)))
+    return node
+
+
+def _cast(name, input, src, dst):
+    node = tf.NodeDef()
+    node.op = 'Cast'
+    node.name = name
+    node.input.append(input)
+    node.attr['SrcT'].CopyFrom(tf.AttrValue(type=src.as_datatype_enum))
+    node.attr['DstT'].CopyFrom(tf.AttrValue(type=dst.as_datatype_enum))
+    return node
+
+
+def quantize_weights(graph_def, mode, min_size):
+    """Replaces large float32 constants by float16 or int8 ones.
+
+    Every quantized constant keeps its name, which now belongs to the node
+    converting it back to float32, so the rest of the graph is unchanged.
+    Only the stored weights are quantized: the conversion is constant and
+    folded once when the graph is loaded, computation stays in float32.
+    """
+    output = tf.GraphDef()
+    n_weights = 0
+    for node in graph_def.node:
+        value = None
+        if node.op == 'Const' and node.attr['dtype'].type == tf.float32.as_datatype_enum:
+            value = tensor_util.MakeNdarray(node.attr['value'].tensor)
+        if value is None or value.size < min_size or (mode == 'int8' and value.ndim != 4):
+            output.node.extend([node])
+            continue
+        n_weights += value.size
+        if mode == 'float16':
+            output.node.extend([
+                _const(node.name+'/float16', np.float16(value)),
+                _cast(node.name, node.name+'/float16', tf.float16, tf.float32)])
+        else:
+            # symmetric quantization with one scale per output channel
+            scale = np.abs(value).reshape((-1, value.shape[-1])).max(axis=0)/127.0
+            scale = np.float32(np.where(scale > 0, scale, 1.0))
+            output.node.extend([
+                _const(node.name+'/int8', np.int8(np.round(value/scale))),
+                _cast(node.name+'/cast', node.name+'/int8', tf.int8, tf.float32),
+                _const(node.name+'/scale', scale)])
+            mul = output.node.add()
+            mul.op = 'Mul'
+            mul.name = node.name
+            mul.input.extend([node.name+'/cast', node.name+'/scale'])
+            mul.attr['T'].CopyFrom(tf.AttrValue(type=tf.float32.as_datatype_enum))
+    print("[i] Quantized %d weights to %s" % (n_weights, mode))
+    return output
+
+
+st = time.time()
+input, transmission_layer, reflection_layer = build_inference_graph(
+    ARGS.is_hyper == 1, ARGS.projected_hypercolumn == 1)
+with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    load_vgg19_weights(sess)
+    if restore_generator(sess, ARGS.task) is None:
+        raise ValueError("No checkpoint found in %s" % ARGS.task)
+    # the vgg19 weights are local variables, freeze them with the others
+    graph_def = graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(), MODEL_OUTPUTS)
+
+# keep the path from the input to the outputs and precompute everything
+# that does not depend on the input, e.g. the constant parts of nm
+graph_def = TransformGraph(graph_def, ['input'], MODEL_OUTPUTS, [
+    'strip_unused_nodes', 'fold_constants(ignore_errors=true)', 'sort_by_execution_order'])
+if ARGS.quantize != 'none':
+    graph_def = quantize_weights(graph_def, ARGS.quantize, ARGS.quantize_min_size)
+
+output = ARGS.output
+if not output:
+    suffix = '' if ARGS.quantize == 'none' else '_'+ARGS.quantize
+    output = os.path.join(ARGS.task, 'model%s.pb' % suffix)
+with open(output, 'wb') as f:
+    f.write(graph_def.SerializeToString())
+
+# the nm statistics used by tiled inference are not part of the GraphDef
+nodes = set(node.name for node in graph_def.node)
+collections = {'hyper': ARGS.is_hyper == 1, 'quantize': ARGS.quantize,
+               'projected_hypercolumn': ARGS.projected_hypercolumn == 1}
+for key in MODEL_COLLECTIONS:
+    collections[key] = [tensor.name for tensor in tf.get_collection(key)
+                        if tensor.op.name in nodes]
+with open(os.path.splitext(output)[0]+'.json', 'w') as f:
+    json.dump(collections, f, indent=2)
+print("[i] Exported %s (%.1f MB) in %.2fs" %
+      (output, os.path.getsize(output)/2.**20, time.time()-st))
@@ -0,0 +1,131 @@
+from __future__ import division
+import os
+import time
+import fcntl
+import sqlite3
+import cv2
+import numpy as np
+
+# persistent cache of decoded training images shared by the loader workers
+
+
+class ImageCache(object):
+    """Stores decoded images once so they never have to be decoded again.
+
+    Pixels are appended to segment files under `root` and read back through
+    memory maps, without decoding or copying. An SQLite index maps every
+    source path to its segment and offset together with the size and mtime
+    of the source file, so entries of modified files are decoded again.
+    When the segments exceed `max_mb`, the least recently used segments are
+    deleted as a whole. The cache can be used from several processes.
+    """
+
+    def __init__(self, root, max_mb=10240, segment_mb=256):
+        self.root = root
+        self.max_bytes = max_mb*2**20
+        self.segment_bytes = segment_mb*2**20
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self.pid = None
+        self.hits = 0
+        self.misses = 0
+        db = self._db()
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, size INTEGER, "
+                       "mtime INTEGER, segment INTEGER, offset INTEGER, dtype TEXT, shape TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, "
+                       "bytes INTEGER, last_used REAL)")
+
+    def _db(self):
+        # sqlite connections and memory maps must not cross a fork
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.conn = sqlite3.connect(os.path.join(
+                self.root, "index.sqlite"), timeout=600)
+            self.maps = {}
+            self.touched = {}
+        return self.conn
+
+    def _segment_path(self, segment):
+        return os.path.join(self.root, "segment_%06d.bin" % segment)
+
+    def _map(self, segment, end):
+        mm = self.maps.get(segment)
+        if mm is None or len(mm) < end:
+            # the segment may have grown since it was mapped
+            mm = np.memmap(self._segment_path(segment), dtype=np.uint8, mode='r')
+            self.maps[segment] = mm
+        return mm
+
+    def imread(self, path):
+        """Same as `cv2.imread(path, -1)`, the result is read-only."""
+        db = self._db()
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = db.execute("SELECT size, mtime, segment, offset, dtype, shape FROM images "
+                         "WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[0:2] == (stat.st_size, stat.st_mtime_ns):
+            segment, offset, dtype, shape = row[2:]
+            shape = tuple(int(s) for s in shape.split(','))
+            nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+            try:
+                mm = self._map(segment, offset+nbytes)
+            except (IOError, OSError):
+                mm = None  # evicted after the lookup
+            if mm is not None:
+                self._touch(segment)
+                self.hits += 1
+                return np.ndarray(shape, dtype=dtype, buffer=mm, offset=offset)
+        self.misses += 1
+        image = cv2.imread(path, -1)
+        if image is not None:
+            self._insert(path, stat, image)
+        return image
+
+    def _touch(self, segment):
+        # access times are only written once a minute per segment and process
+        now = time.time()
+        if now-self.touched.get(segment, 0) > 60:
+            self.touched[segment] = now
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE segments SET last_used = ? WHERE id = ?", (now, segment))
+
+    def _insert(self, path, stat, image):
+        image = np.ascontiguousarray(image)
+        with open(os.path.join(self.root, "lock"), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with self.conn as db:
+                row = db.execute(
+                    "SELECT id, bytes FROM segments ORDER BY id DESC LIMIT 1").fetchone()
+                if row is None or row[1]+image.nbytes > self.segment_bytes:
+                    segment = 0 if row is None else row[0]+1
+                    db.execute("INSERT INTO segments VALUES (?, 0, ?)",
+                               (segment, time.time()))
+                else:
+                    segment = row[0]
+                with open(self._segment_path(segment), 'ab') as f:
+                    # keep every image aligned for the memory mapped views
+                    offset = f.tell()
+                    pad = -offset % 64
+                    f.write(b'\0'*pad)
+                    f.write(image.tobytes())
+                db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           (path, stat.st_size, stat.st_mtime_ns, segment, offset+pad,
+                            image.dtype.str, ','.join(str(s) for s in image.shape)))
+                db.execute("UPDATE segments SET bytes = ?, last_used = ? WHERE id = ?",
+                           (offset+pad+image.nbytes, time.time(), segment))
+                self._evict(db, segment)
+
+    def _evict(self, db, current):
+        total = db.execute("SELECT SUM(bytes) FROM segments").fetchone()[0]
+        for segment, nbytes in db.execute(
+                "SELECT id, bytes FROM segments WHERE id != ? ORDER BY last_used",
+                (current,)).fetchall():
+            if total <= self.max_bytes:
+                break
+            db.execute("DELETE FROM images WHERE segment = ?", (segment,))
+            db.execute("DELETE FROM segments WHERE id = ?", (segment,))
+            os.remove(self._segment_path(segment))
+            self.maps.pop(segment, None)
+            total -= nbytes
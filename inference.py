@@ -0,0 +1,312 @@
+from __future__ import division
+import os
+import json
+import cv2
+import numpy as np
+import tensorflow as tf
+from model import build
+from vgg import load_vgg19_weights
+
+# helpers to run the trained model on many images efficiently
+
+
+class ShapeBatcher(object):
+    """Collects images and releases them in batches of identical shape.
+
+    Images of the same height and width are stacked into one [n, h, w, 3]
+    array so they can be processed by a single `sess.run`. At most
+    `max_pending` images are held back: when the limit is reached the
+    fullest bucket is released even if it is incomplete.
+    """
+
+    def __init__(self, batch_size, max_pending=None):
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 8*batch_size
+        self.buckets = {}
+        self.pending = 0
+
+    def add(self, key, image):
+        """Adds an image and returns the list of batches that became ready.
+
+        Every batch is a (keys, images) pair, `images` being float32 in [0, 1].
+        """
+        bucket = self.buckets.setdefault(image.shape, [])
+        bucket.append((key, image))
+        self.pending += 1
+        if len(bucket) >= self.batch_size:
+            return [self._release(image.shape)]
+        if self.pending >= self.max_pending:
+            shape = max(self.buckets, key=lambda s: len(self.buckets[s]))
+            return [self._release(shape)]
+        return []
+
+    def flush(self):
+        """Returns the remaining, possibly incomplete, batches."""
+        return [self._release(shape) for shape in list(self.buckets)]
+
+    def _release(self, shape):
+        bucket = self.buckets.pop(shape)
+        self.pending -= len(bucket)
+        keys = [key for key, _ in bucket]
+        images = np.stack([image for _, image in bucket])
+        return keys, np.float32(images)/255.0
+
+
+# tiled inference for images too large to process at once
+
+# radius in pixels of the input region that influences one output pixel:
+# 128 for the dilated g_conv* stack, 94 for vgg19 up to conv5_2 and 16 for
+# the upsampling of its features, rounded up to the vgg pooling stride
+GENERATOR_HALO = 240
+# rough peak activation memory of the generator per input pixel: about two
+# copies of the full resolution hypercolumn, or with the projected
+# hypercolumn (never materialized) a few maps of 64 channels
+BYTES_PER_PIXEL = 12*1024
+PROJECTED_BYTES_PER_PIXEL = 2*1024
+
+
+def min_tile_memory_mb(halo=GENERATOR_HALO, projected=False):
+    """Smallest budget in MB that fits a 16 pixel tile with its halo."""
+    bytes_per_pixel = PROJECTED_BYTES_PER_PIXEL if projected else BYTES_PER_PIXEL
+    return int(np.ceil((2*halo+16)**2*bytes_per_pixel/2**20))
+
+
+def tile_size_for_budget(memory_mb, halo=GENERATOR_HALO, projected=False):
+    """Largest tile side, a multiple of 16, whose haloed region fits the budget.
+
+    Every tile runs the generator on its (tile+2*halo)^2 region, see
+    tile_overhead; the projected hypercolumn needs about 6 times less
+    memory per pixel, so it gets much larger tiles from the same budget.
+    Raises ValueError when the budget cannot fit the smallest tile.
+    """
+    minimum = min_tile_memory_mb(halo, projected)
+    if memory_mb < minimum:
+        raise ValueError("A tile memory budget of %d MB cannot fit a tile with a %d pixel halo, "
+                         "it needs at least %d MB" % (memory_mb, halo, minimum))
+    bytes_per_pixel = PROJECTED_BYTES_PER_PIXEL if projected else BYTES_PER_PIXEL
+    side = int(np.sqrt(memory_mb*2**20/bytes_per_pixel))
+    return (side-2*halo)//16*16
+
+
+def tile_overhead(tile, halo=GENERATOR_HALO):
+    """Pixels processed per output pixel by the tiles inside a large image."""
+    return ((tile+2*halo)/tile)**2
+
+
+def _tiles(h, w, tile, halo):
+    # core boxes cover the image without overlap, regions add the halo.
+    # tile and halo are multiples of 16 so every region is aligned with the
+    # vgg pooling grid of the whole image
+    tiles = []
+    for y in range(0, h, tile):
+        for x in range(0, w, tile):
+            core = (y, min(y+tile, h), x, min(x+tile, w))
+            region = (max(y-halo, 0), min(y+tile+halo, h),
+                      max(x-halo, 0), min(x+tile+halo, w))
+            tiles.append((core, region))
+    return tiles
+
+
+def _feather(c0, c1, r0, r1, n, overlap):
+    # 1D blending weights of a tile over its region: linear ramps centered
+    # on the core borders that sum to one with the neighbouring tiles
+    p = np.arange(r0, r1)+0.5
+    weight = np.ones(r1-r0, dtype=np.float32)
+    if c0 > 0:
+        weight = np.minimum(weight, np.clip(
+            (p-c0+overlap)/(2.0*overlap), 0, 1))
+    if c1 < n:
+        weight = np.minimum(weight, np.clip(
+            (c1+overlap-p)/(2.0*overlap), 0, 1))
+    return weight
+
+
+def _run_tiles(sess, input, fetches, image, tiles, feed_dict, tile_batch):
+    # runs tiles of equal shape together, yields (tile, outputs) per tile
+    groups = {}
+    for tile in tiles:
+        y0, y1, x0, x1 = tile[1]
+        groups.setdefault((y1-y0, x1-x0), []).append(tile)
+    for group in groups.values():
+        for i in range(0, len(group), tile_batch):
+            chunk = group[i:i+tile_batch]
+            batch = np.stack([image[y0:y1, x0:x1]
+                              for _, (y0, y1, x0, x1) in chunk])
+            feed = dict(feed_dict)
+            feed[input] = batch
+            outputs = sess.run(fetches, feed_dict=feed)
+            for j, tile in enumerate(chunk):
+                yield tile, [output[j] for output in outputs]
+
+
+def _tiled_moments(sess, input, image, tiles, tile_batch):
+    # computes the statistics every nm layer would see on the whole image,
+    # one layer at a time, feeding the statistics of the previous layers
+    feed_dict = {}
+    for x, mean, variance in zip(tf.get_collection('nm_inputs'),
+                                 tf.get_collection('nm_means'),
+                                 tf.get_collection('nm_variances')):
+        s, ss, n = 0.0, 0.0, 0
+        for ((cy0, cy1, cx0, cx1), (y0, _, x0, _)), (out,) in _run_tiles(
+                sess, input, [x], image, tiles, feed_dict, tile_batch):
+            out = np.float64(out[cy0-y0:cy1-y0, cx0-x0:cx1-x0])
+            s = s+out.sum(axis=(0, 1))
+            ss = ss+np.square(out).sum(axis=(0, 1))
+            n += out.shape[0]*out.shape[1]
+        m = s/n
+        feed_dict[mean] = m.reshape((1, 1, 1, -1))
+        feed_dict[variance] = np.maximum(ss/n-m*m, 0).reshape((1, 1, 1, -1))
+    return feed_dict
+
+
+def _lowres_moments(sess, input, image, max_pixels):
+    # approximates the statistics of every nm layer on a downscaled copy
+    scale = np.sqrt(max_pixels/(image.shape[0]*image.shape[1]))
+    small = cv2.resize(image, (max(16, int(image.shape[1]*scale)),
+                               max(16, int(image.shape[0]*scale))), interpolation=cv2.INTER_AREA)
+    means = tf.get_collection('nm_means')
+    variances = tf.get_collection('nm_variances')
+    values = sess.run(means+variances, feed_dict={input: small[np.newaxis]})
+    return dict(zip(means+variances, values))
+
+
+def run_tiled(sess, input, fetches, image, tile, halo=GENERATOR_HALO, overlap=32,
+              stats='exact', tile_batch=1):
+    """Runs `fetches` on a [h, w, 3] image split into overlapping tiles.
+
+    Every tile is extended by `halo` pixels of context and the outputs are
+    feather-blended over `overlap` pixels around the tile borders. The nm
+    layers normalize with image-wide statistics, which are either gathered
+    exactly tile by tile ('exact', one extra partial pass per layer) or
+    estimated on a downscaled copy of the image ('lowres'). Returns one
+    [1, h, w, c] array per fetch.
+    """
+    h, w = image.shape[0:2]
+    overlap = min(overlap, halo)
+    tiles = _tiles(h, w, tile, halo)
+    if stats == 'exact':
+        feed_dict = _tiled_moments(sess, input, image, tiles, tile_batch)
+    else:
+        feed_dict = _lowres_moments(sess, input, image, (tile+2*halo)**2)
+    outputs = None
+    total = np.zeros((h, w, 1), dtype=np.float32)
+    for ((cy0, cy1, cx0, cx1), (y0, y1, x0, x1)), tile_outputs in _run_tiles(
+            sess, input, fetches, image, tiles, feed_dict, tile_batch):
+        if outputs is None:
+            outputs = [np.zeros((h, w, out.shape[-1]), dtype=np.float32)
+                       for out in tile_outputs]
+        weight = np.outer(_feather(cy0, cy1, y0, y1, h, overlap),
+                          _feather(cx0, cx1, x0, x1, w, overlap))[:, :, np.newaxis]
+        for output, out in zip(outputs, tile_outputs):
+            output[y0:y1, x0:x1] += out*weight
+        total[y0:y1, x0:x1] += weight
+    return [np.expand_dims(output/total, axis=0) for output in outputs]
+
+
+# inference-only models, built from a checkpoint or loaded from an export
+
+MODEL_OUTPUTS = ['transmission_layer', 'reflection_layer']
+MODEL_COLLECTIONS = ['nm_inputs', 'nm_means', 'nm_variances']
+
+
+def build_inference_graph(hyper=True, projected=False):
+    """Builds the generator alone, returns (input, transmission, reflection)."""
+    input = tf.placeholder(tf.float32, shape=[None, None, None, 3], name='input')
+    network = build(input, hyper=hyper, per_image_norm=True, projected=projected)
+    transmission_layer, reflection_layer = tf.split(
+        network, num_or_size_splits=2, axis=3)
+    transmission_layer = tf.identity(transmission_layer, name=MODEL_OUTPUTS[0])
+    reflection_layer = tf.identity(reflection_layer, name=MODEL_OUTPUTS[1])
+    return input, transmission_layer, reflection_layer
+
+
+def restore_generator(sess, task):
+    """Restores the generator variables of the latest checkpoint in `task`."""
+    ckpt = tf.train.get_checkpoint_state(task)
+    print("[i] contain checkpoint: ", ckpt)
+    if ckpt is not None:
+        saver_restore = tf.train.Saver(
+            [var for var in tf.trainable_variables() if 'discriminator' not in var.name])
+        print('loaded '+ckpt.model_checkpoint_path)
+        saver_restore.restore(sess, ckpt.model_checkpoint_path)
+    return ckpt
+
+
+def load_model(model, hyper=True, projected=False, config=None):
+    """Loads a model for inference into the default graph and a new session.
+
+    `model` is either a checkpoint folder, in which case the generator is
+    built (see model.build) and restored, or a frozen graph written by
+    export.py. Returns
+    (sess, input, transmission_layer, reflection_layer).
+    """
+    graph = tf.get_default_graph()
+    if model.endswith('.pb'):
+        graph_def = tf.GraphDef()
+        with open(model, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name='')
+        with open(os.path.splitext(model)[0]+'.json') as f:
+            collections = json.load(f)
+        for key in MODEL_COLLECTIONS:
+            for name in collections.get(key, []):
+                tf.add_to_collection(key, graph.get_tensor_by_name(name))
+        input = graph.get_tensor_by_name('input:0')
+        transmission_layer, reflection_layer = [
+            graph.get_tensor_by_name(name+':0') for name in MODEL_OUTPUTS]
+        sess = tf.Session(config=config)
+        print("[i] Loaded exported model %s" % model)
+    else:
+        input, transmission_layer, reflection_layer = build_inference_graph(hyper, projected)
+        sess = tf.Session(config=config)
+        sess.run(tf.global_variables_initializer())
+        load_vgg19_weights(sess)
+        restore_generator(sess, model)
+    return sess, input, transmission_layer, reflection_layer
+
+
+# reduced resolution inference, upsampled with the full resolution input
+
+
+def _box(x, radius):
+    return cv2.blur(x, (2*radius+1, 2*radius+1), borderType=cv2.BORDER_REFLECT)
+
+
+def guided_upsample(guide_low, src_low, guide, radius=4, eps=1e-3):
+    """Fast guided filter upsampling of `src_low` with a full resolution guide.
+
+    A linear model src = a*guide+b is fitted per channel in every window of
+    the low resolution images, then the smoothed coefficients are upsampled
+    and applied to `guide`, which transfers its edges to the result.
+    """
+    mean_i = _box(guide_low, radius)
+    mean_p = _box(src_low, radius)
+    var_i = _box(guide_low*guide_low, radius)-mean_i*mean_i
+    cov_ip = _box(guide_low*src_low, radius)-mean_i*mean_p
+    a = cov_ip/(var_i+eps)
+    b = mean_p-a*mean_i
+    size = (guide.shape[1], guide.shape[0])
+    a = cv2.resize(_box(a, radius), size, interpolation=cv2.INTER_LINEAR)
+    b = cv2.resize(_box(b, radius), size, interpolation=cv2.INTER_LINEAR)
+    return a*guide+b
+
+
+def run_lowres(sess, input, fetches, image, max_pixels, radius=4, eps=1e-3):
+    """Runs the [transmission, reflection] `fetches` on a downscaled copy.
+
+    The image is downscaled to at most `max_pixels` pixels. The reflection
+    is brought back to full resolution by guided upsampling, and the
+    transmission is the input minus the reflection, minus the smooth part
+    of the input that the network did not attribute to either layer.
+    Returns [1, h, w, 3] arrays like `sess.run`.
+    """
+    h, w = image.shape[0:2]
+    scale = min(1.0, np.sqrt(max_pixels/(h*w)))
+    small = cv2.resize(image, (max(16, int(w*scale)), max(16, int(h*scale))),
+                       interpolation=cv2.INTER_AREA)
+    t_low, r_low = [output[0] for output in sess.run(
+        fetches, feed_dict={input: small[np.newaxis]})]
+    r = guided_upsample(small, r_low, image, radius, eps)
+    residual = cv2.resize(small-t_low-r_low, (w, h), interpolation=cv2.INTER_LINEAR)
+    t = image-r-residual
+    return [t[np.newaxis], r[np.newaxis]]
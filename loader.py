@@ -0,0 +1,178 @@
+from __future__ import division
+import os
+import time
+import multiprocessing
+import cv2
+import numpy as np
+from synthesis import k_sz, syn_data
+
+# background data loading for training: worker processes decode, resize and
+# synthesize samples while the main process runs the D/G updates
+
+
+def imread(path):
+    return cv2.imread(path, -1)
+
+
+def load_training_sample(syn_image1_list, syn_image2_list, input_real_names, output_real_names1, syn_ratio,
+                         imread=imread, sampler=None):
+    """Draws one training sample the same way the training loop always did.
+
+    Returns (input_image, output_image_t, output_image_r, is_syn, file) with
+    images of shape [h, w, 3] in [0, 1], or None if the sample was rejected.
+    `imread` decodes an image file, e.g. `ImageCache.imread`. With a
+    `dataset_manifest.ValidSampler` the files are drawn among those that
+    pass the rejection checks instead of the lists.
+    """
+    magic = np.random.random()
+    if magic < syn_ratio:  # choose from synthetic dataset
+        is_syn = True
+        if sampler is not None:
+            syn_image1_path, syn_image2_path = sampler.syn_pair()
+        else:
+            syn_image1_path = syn_image1_list[np.random.randint(len(syn_image1_list))]
+        syn_image1 = imread(syn_image1_path)
+        neww = np.random.randint(256, 480)
+        newh = round((neww/syn_image1.shape[1])*syn_image1.shape[0])
+        output_image_t = cv2.resize(np.float32(
+            syn_image1), (neww, newh), cv2.INTER_CUBIC)/255.0
+        if sampler is None:
+            syn_image2_path = np.random.choice(syn_image2_list)
+        output_image_r = cv2.resize(np.float32(imread(syn_image2_path)),
+                                    (neww, newh), cv2.INTER_CUBIC)/255.0
+        file = os.path.splitext(os.path.basename(syn_image1_path))[0]
+        sigma = k_sz[np.random.randint(0, len(k_sz))]
+        if np.mean(output_image_t)*1/2 > np.mean(output_image_r):
+            return None
+        _, output_image_r, input_image = syn_data(
+            output_image_t, output_image_r, sigma)
+    else:  # choose from real dataste
+        is_syn = False
+        if sampler is not None:
+            input_path, output_path = sampler.real_pair()
+        else:
+            _id = np.random.randint(len(input_real_names))
+            input_path, output_path = input_real_names[_id], output_real_names1[_id]
+        inputimg = imread(input_path)
+        file = os.path.splitext(os.path.basename(input_path))[0]
+        neww = np.random.randint(256, 480)
+        newh = round((neww/inputimg.shape[1])*inputimg.shape[0])
+        input_image = cv2.resize(np.float32(
+            inputimg), (neww, newh), cv2.INTER_CUBIC)/255.0
+        output_image_t = cv2.resize(np.float32(imread(
+            output_path)), (neww, newh), cv2.INTER_CUBIC)/255.0
+        output_image_r = output_image_t  # reflection gt not necessary
+
+    # remove some degenerated images (low-light or over-saturated images), heuristically set
+    if output_image_r.max() < 0.15 or output_image_t.max() < 0.15:
+        print("Invalid reflection file %s (degenerate channel)" % (file))
+        return None
+    if input_image.max() < 0.1:
+        print("Invalid file %s (degenerate image)" % (file))
+        return None
+    return input_image, output_image_t, output_image_r, is_syn, file
+
+
+def _worker(sample_fn, queue, seed):
+    # forked workers inherit the parent's random state, reseed them apart
+    np.random.seed(seed)
+    cv2.setNumThreads(1)
+    while True:
+        queue.put(sample_fn())
+
+
+class PrefetchLoader(object):
+    """Keeps up to `prefetch` samples ready in a bounded queue.
+
+    `sample_fn` is called with no arguments and returns a sample or None.
+    With `num_workers=0` samples are produced on the calling thread.
+    """
+
+    def __init__(self, sample_fn, num_workers=2, prefetch=8):
+        self.sample_fn = sample_fn
+        self.num_workers = num_workers
+        self.wait_time = 0.0
+        self.workers = []
+        if num_workers > 0:
+            # fork is required, the training script is not import safe
+            ctx = multiprocessing.get_context('fork')
+            self.queue = ctx.Queue(maxsize=max(prefetch, 1))
+            for i in range(num_workers):
+                seed = (np.random.randint(2**31) + i) % 2**32
+                p = ctx.Process(target=_worker, args=(
+                    sample_fn, self.queue, seed))
+                p.daemon = True
+                p.start()
+                self.workers.append(p)
+        print("[i] Data loader: %d workers, prefetch depth %d" %
+              (num_workers, prefetch))
+
+    def get(self):
+        st = time.time()
+        if self.num_workers > 0:
+            sample = self.queue.get()
+        else:
+            sample = self.sample_fn()
+        self.wait_time += time.time()-st
+        return sample
+
+    def pop_wait_time(self):
+        """Returns the time spent waiting for samples since the last call."""
+        wait_time = self.wait_time
+        self.wait_time = 0.0
+        return wait_time
+
+    def close(self):
+        for p in self.workers:
+            p.terminate()
+        for p in self.workers:
+            p.join()
+        self.workers = []
+
+
+class BucketBatcher(object):
+    """Groups samples of similar size into minibatches.
+
+    Samples are bucketed by their size rounded down to `granularity` pixels
+    and by whether they are synthetic, so a batch never mixes synthetic and
+    real data. A full bucket is randomly cropped to the smallest height and
+    width it contains and stacked into [n, h, w, 3] arrays.
+    """
+
+    def __init__(self, batch_size, granularity=32):
+        self.batch_size = batch_size
+        self.granularity = granularity
+        self.buckets = {}
+
+    def add(self, id, sample):
+        """Adds a sample and returns the list of batches that became ready."""
+        h, w = sample[0].shape[0:2]
+        key = (sample[3], h//self.granularity, w//self.granularity)
+        bucket = self.buckets.setdefault(key, [])
+        bucket.append((id, sample))
+        if len(bucket) < self.batch_size:
+            return []
+        del self.buckets[key]
+        return [self._stack(bucket)]
+
+    def flush(self):
+        """Returns the remaining, possibly incomplete, batches."""
+        batches = [self._stack(bucket) for bucket in self.buckets.values()]
+        self.buckets = {}
+        return batches
+
+    def _stack(self, bucket):
+        h = min(sample[0].shape[0] for _, sample in bucket)
+        w = min(sample[0].shape[1] for _, sample in bucket)
+        ids = []
+        images = [[], [], []]
+        for id, sample in bucket:
+            y = np.random.randint(sample[0].shape[0]-h+1)
+            x = np.random.randint(sample[0].shape[1]-w+1)
+            for i in range(3):
+                images[i].append(sample[i][y:y+h, x:x+w])
+            ids.append(id)
+        input_images, output_images_t, output_images_r = [
+            np.stack(image) for image in images]
+        is_syn, file = bucket[-1][1][3:5]
+        return ids, input_images, output_images_t, output_images_r, is_syn, file
@@ -2,15 +2,23 @@ from __future__ import division
 import os
 import time
 import cv2
-import scipy.io
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
 import numpy as np
 import matplotlib.pyplot as plt
-from discriminator import build_discriminator
-import scipy.stats as st
+from vgg import load_vgg19_weights
+from training import TrainingGraph
+from loader import BucketBatcher, PrefetchLoader, imread, load_training_sample
+from image_cache import ImageCache
+from dataset_manifest import is_image_file, output_names, training_files
+from checkpoint import CheckpointManager
+from profiler import Profiler, parse_iterations
+from train_metrics import TrainMetrics
+from writer import FORMATS, ResultWriter
+from manifest import RESULT_DEFAULTS, ResultManifest, latest_checkpoint, result_identity
+from inference import ShapeBatcher, load_model, min_tile_memory_mb, run_lowres, run_tiled, tile_overhead, tile_size_for_budget
+import functools
 import argparse
-import glob
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--task", default="pre-trained",
@@ -22,12 +30,22 @@ parser.add_argument("--save_model_freq", default=1,
                     type=int, help="frequency to save model")
 parser.add_argument("--discriminator_update_freq", default=2,
                     type=int, help="frequency to update discriminator weights")
+parser.add_argument("--fused_update", default=0, type=int,
+                    help="Update the discriminator and the generator from the same forward pass instead of one after the other")
 parser.add_argument("--save_model_freq_epoch", default=10,
                     type=int, help="frequency to save model")
+parser.add_argument("--max_to_keep", default=10, type=int,
+                    help="Number of most recent checkpoints kept")
+parser.add_argument("--keep_best", default=0, type=int,
+                    help="Also keep this many epoch checkpoints with the lowest mean training loss")
+parser.add_argument("--save_generator_only", action="store_true",
+                    help="Only save the generator in the epoch checkpoints, enough for testing and export.py")
 parser.add_argument("--save_images_freq", default=1,
                     type=int, help="frequency to save images")
 parser.add_argument("--is_hyper", default=1, type=int,
                     help="use hypercolumn or not")
+parser.add_argument("--projected_hypercolumn", default=0, type=int,
+                    help="Project the vgg features before upsampling them instead of building the full resolution hypercolumn")
 parser.add_argument("--is_training", default=1, help="training or testing")
 parser.add_argument("--continue_training", action="store_true",
                     help="search for checkpoint in the subfolder specified by `task` argument")
@@ -41,8 +59,68 @@ parser.add_argument("--data_test_dir", default="./test_images/real/",
                     help="path to test dataset for making predictions")
 parser.add_argument("--output_folder_name", default="CEILNet",
                     help="Name of folder for saving results")
+parser.add_argument("--frozen_model", default="",
+                    help="Frozen graph written by export.py to test with instead of the checkpoint in `task`")
+parser.add_argument("--test_batch_size", default=1, type=int,
+                    help="Maximum number of equally sized test images processed in one run")
+parser.add_argument("--tile_memory_mb", default=0, type=int,
+                    help="Split test images that do not fit this activation memory budget into tiles, at least %d MB "
+                         "with the default --tile_halo or %d MB with --projected_hypercolumn 1, which also gets much "
+                         "larger tiles from the same budget. 0 disables tiling"
+                         % (min_tile_memory_mb(), min_tile_memory_mb(projected=True)))
+parser.add_argument("--tile_halo", default=RESULT_DEFAULTS['tile_halo'], type=int,
+                    help="Context in pixels added around every tile, a multiple of 16")
+parser.add_argument("--tile_stats", default=RESULT_DEFAULTS['tile_stats'], choices=["exact", "lowres"],
+                    help="Compute the normalization statistics of tiled images exactly or on a downscaled copy")
+parser.add_argument("--tile_batch", default=1, type=int,
+                    help="Number of equally sized tiles run together")
+parser.add_argument("--profile_iterations", default="",
+                    help="Trace these iterations (training) or runs (testing), e.g. 10-12,50; empty disables profiling")
+parser.add_argument("--profile_dir", default="",
+                    help="Folder of the traces and of the profile summary, `task`/profile if not given")
+parser.add_argument("--metrics_log", default="",
+                    help="Log of the losses and timings of every iteration, .csv or .jsonl, `task`/train_metrics.csv if not given")
+parser.add_argument("--metrics_flush_secs", default=30.0, type=float,
+                    help="Write the buffered metrics to the log at most every this many seconds")
+parser.add_argument("--tensorboard_dir", default="",
+                    help="Also write the metrics as TensorBoard summaries to this folder")
+parser.add_argument("--incremental", action="store_true",
+                    help="Only test images that are new or changed, or were tested with another model or options")
+parser.add_argument("--write_workers", default=2, type=int,
+                    help="Number of threads writing the test results, 0 writes them in the test loop")
+parser.add_argument("--write_queue", default=16, type=int,
+                    help="Maximum number of test results waiting to be written")
+parser.add_argument("--write_outputs", default=list(RESULT_DEFAULTS['outputs']), nargs='*', choices=["t", "r"],
+                    help="Test outputs to write: transmission (t) and/or reflection (r) layer")
+parser.add_argument("--write_format", default=RESULT_DEFAULTS['format'], choices=sorted(FORMATS),
+                    help="Image format of the test results")
+parser.add_argument("--write_level", default=RESULT_DEFAULTS['level'], type=int,
+                    help="PNG compression level (0-9) or JPEG/WebP quality (WebP above 100 is lossless)")
+parser.add_argument("--input_copy", default=RESULT_DEFAULTS['input_copy'], choices=["encode", "link", "skip"],
+                    help="Write the test input encoded like the outputs, hard-linked to its source file, or not at all")
+parser.add_argument("--lowres_pixels", default=RESULT_DEFAULTS['lowres_pixels'], type=int,
+                    help="Run test images larger than this many pixels at a reduced resolution and upsample the results, 0 disables it")
+parser.add_argument("--lowres_radius", default=RESULT_DEFAULTS['lowres_radius'], type=int,
+                    help="Window radius in low resolution pixels of the guided upsampling")
+parser.add_argument("--lowres_eps", default=RESULT_DEFAULTS['lowres_eps'], type=float,
+                    help="Regularization of the guided upsampling, larger values smooth more")
 parser.add_argument("--lr", default=[0.0002, 0.0001], type=float, nargs=2,
                     help="Learning rate for generator and discriminator")
+parser.add_argument("--num_workers", default=2, type=int,
+                    help="Number of processes loading training data, 0 loads on the main thread")
+parser.add_argument("--prefetch", default=8, type=int,
+                    help="Maximum number of training samples queued ahead of the trainer")
+parser.add_argument("--image_cache_dir", default="",
+                    help="Folder of a persistent cache of decoded training images, empty disables the cache")
+parser.add_argument("--image_cache_mb", default=10240, type=int,
+                    help="Maximum size of the decoded image cache in megabytes")
+parser.add_argument("--dataset_manifest", default="",
+                    help="Index of the training images, built on the first run, to start without listing the dataset "
+                         "and to only draw samples that pass the rejection checks")
+parser.add_argument("--refresh_dataset_manifest", action="store_true",
+                    help="List the dataset again and index the new and modified images")
+parser.add_argument("--batch_size", default=1, type=int,
+                    help="Number of training images per step, grouped by size and by synthetic/real")
 
 ARGS = parser.parse_args()
 print(ARGS)
@@ -57,372 +135,26 @@ if is_training:
     os.environ['CUDA_VISIBLE_DEVICES'] = str(0)
 else:
     os.environ['CUDA_VISIBLE_DEVICES'] = str(0)
-EPS = 1e-12
-channel = 64  # number of feature channels to build the model, set to 64
 
 train_syn_root = [ARGS.data_syn_dir]
 train_real_root = [ARGS.data_real_dir]
 
-IMG_EXTENSIONS = [
-    '.jpg', '.JPG', '.jpeg', '.JPEG',
-    '.png', '.PNG', '.ppm', '.PPM', '.bmp', '.BMP',
-]
-
-
-def is_image_file(filename):
-    return any(filename.endswith(extension) for extension in IMG_EXTENSIONS)
-
-
-def build_net(ntype, nin, nwb=None, name=None):
-    if ntype == 'conv':
-        return tf.nn.relu(tf.nn.conv2d(nin, nwb[0], strides=[1, 1, 1, 1], padding='SAME', name=name)+nwb[1])
-    elif ntype == 'pool':
-        return tf.nn.avg_pool(nin, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
-
-
-def get_weight_bias(vgg_layers, i):
-    weights = vgg_layers[i][0][0][2][0][0]
-    weights = tf.constant(weights)
-    bias = vgg_layers[i][0][0][2][0][1]
-    bias = tf.constant(np.reshape(bias, (bias.size)))
-    return weights, bias
-
-
-def lrelu(x):
-    return tf.maximum(x*0.2, x)
-
-
-def relu(x):
-    return tf.maximum(0.0, x)
-
-
-def identity_initializer():
-    def _initializer(shape, dtype=tf.float32, partition_info=None):
-        array = np.zeros(shape, dtype=float)
-        cx, cy = shape[0]//2, shape[1]//2
-        for i in range(np.minimum(shape[2], shape[3])):
-            array[cx, cy, i, i] = 1
-        return tf.constant(array, dtype=dtype)
-    return _initializer
-
-
-def nm(x):
-    w0 = tf.Variable(1.0, name='w0')
-    w1 = tf.Variable(0.0, name='w1')
-    return w0*x+w1*slim.batch_norm(x)
-
-
-vgg_path = scipy.io.loadmat('./VGG_Model/imagenet-vgg-verydeep-19.mat')
-print("[i] Loaded pre-trained vgg19 parameters")
-# build VGG19 to load pre-trained parameters
-
-
-def build_vgg19(input, reuse=False):
-    with tf.variable_scope("vgg19"):
-        if reuse:
-            tf.get_variable_scope().reuse_variables()
-        net = {}
-        vgg_layers = vgg_path['layers'][0]
-        net['input'] = input - \
-            np.array([123.6800, 116.7790, 103.9390]).reshape((1, 1, 1, 3))
-        net['conv1_1'] = build_net('conv', net['input'], get_weight_bias(
-            vgg_layers, 0), name='vgg_conv1_1')
-        net['conv1_2'] = build_net('conv', net['conv1_1'], get_weight_bias(
-            vgg_layers, 2), name='vgg_conv1_2')
-        net['pool1'] = build_net('pool', net['conv1_2'])
-        net['conv2_1'] = build_net('conv', net['pool1'], get_weight_bias(
-            vgg_layers, 5), name='vgg_conv2_1')
-        net['conv2_2'] = build_net('conv', net['conv2_1'], get_weight_bias(
-            vgg_layers, 7), name='vgg_conv2_2')
-        net['pool2'] = build_net('pool', net['conv2_2'])
-        net['conv3_1'] = build_net('conv', net['pool2'], get_weight_bias(
-            vgg_layers, 10), name='vgg_conv3_1')
-        net['conv3_2'] = build_net('conv', net['conv3_1'], get_weight_bias(
-            vgg_layers, 12), name='vgg_conv3_2')
-        net['conv3_3'] = build_net('conv', net['conv3_2'], get_weight_bias(
-            vgg_layers, 14), name='vgg_conv3_3')
-        net['conv3_4'] = build_net('conv', net['conv3_3'], get_weight_bias(
-            vgg_layers, 16), name='vgg_conv3_4')
-        net['pool3'] = build_net('pool', net['conv3_4'])
-        net['conv4_1'] = build_net('conv', net['pool3'], get_weight_bias(
-            vgg_layers, 19), name='vgg_conv4_1')
-        net['conv4_2'] = build_net('conv', net['conv4_1'], get_weight_bias(
-            vgg_layers, 21), name='vgg_conv4_2')
-        net['conv4_3'] = build_net('conv', net['conv4_2'], get_weight_bias(
-            vgg_layers, 23), name='vgg_conv4_3')
-        net['conv4_4'] = build_net('conv', net['conv4_3'], get_weight_bias(
-            vgg_layers, 25), name='vgg_conv4_4')
-        net['pool4'] = build_net('pool', net['conv4_4'])
-        net['conv5_1'] = build_net('conv', net['pool4'], get_weight_bias(
-            vgg_layers, 28), name='vgg_conv5_1')
-        net['conv5_2'] = build_net('conv', net['conv5_1'], get_weight_bias(
-            vgg_layers, 30), name='vgg_conv5_2')
-        return net
-
-# our reflection removal model
-
-
-def build(input):
-    if hyper:
-        print("[i] Hypercolumn ON, building hypercolumn features ... ")
-        vgg19_features = build_vgg19(input[:, :, :, 0:3]*255.0)
-        for layer_id in range(1, 6):
-            vgg19_f = vgg19_features['conv%d_2' % layer_id]
-            input = tf.concat([tf.image.resize_bilinear(
-                vgg19_f, (tf.shape(input)[1], tf.shape(input)[2]))/255.0, input], axis=3)
-    else:
-        vgg19_features = build_vgg19(input[:, :, :, 0:3]*255.0)
-        for layer_id in range(1, 6):
-            vgg19_f = vgg19_features['conv%d_2' % layer_id]
-            input = tf.concat([tf.image.resize_bilinear(tf.zeros_like(
-                vgg19_f), (tf.shape(input)[1], tf.shape(input)[2]))/255.0, input], axis=3)
-    net = slim.conv2d(input, channel, [1, 1], rate=1, activation_fn=lrelu,
-                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv0')
-    net = slim.conv2d(net, channel, [3, 3], rate=1, activation_fn=lrelu,
-                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv1')
-    net = slim.conv2d(net, channel, [3, 3], rate=2, activation_fn=lrelu,
-                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv2')
-    net = slim.conv2d(net, channel, [3, 3], rate=4, activation_fn=lrelu,
-                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv3')
-    net = slim.conv2d(net, channel, [3, 3], rate=8, activation_fn=lrelu,
-                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv4')
-    net = slim.conv2d(net, channel, [3, 3], rate=16, activation_fn=lrelu,
-                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv5')
-    net = slim.conv2d(net, channel, [3, 3], rate=32, activation_fn=lrelu,
-                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv6')
-    net = slim.conv2d(net, channel, [3, 3], rate=64, activation_fn=lrelu,
-                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv7')
-    net = slim.conv2d(net, channel, [3, 3], rate=1, activation_fn=lrelu,
-                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv9')
-    # output 6 channels --> 3 for transmission layer and 3 for reflection layer
-    net = slim.conv2d(net, 3*2, [1, 1], rate=1,
-                      activation_fn=None, scope='g_conv_last')
-    return net
-
-# functions for synthesizing images with reflection (details in the paper)
-
-
-def gkern(kernlen=100, nsig=1):
-    """Returns a 2D Gaussian kernel array."""
-    interval = (2*nsig+1.)/(kernlen)
-    x = np.linspace(-nsig-interval/2., nsig+interval/2., kernlen+1)
-    kern1d = np.diff(st.norm.cdf(x))
-    kernel_raw = np.sqrt(np.outer(kern1d, kern1d))
-    kernel = kernel_raw/kernel_raw.sum()
-    kernel = kernel/kernel.max()
-    return kernel
-
-
-# create a vignetting mask
-g_mask = gkern(560, 3)
-g_mask = np.dstack((g_mask, g_mask, g_mask))
-
-
-def syn_data(t, r, sigma):
-    t = np.power(t, 2.2)
-    r = np.power(r, 2.2)
-
-    sz = int(2*np.ceil(2*sigma)+1)
-    r_blur = cv2.GaussianBlur(r, (sz, sz), sigma, sigma, 0)
-    blend = r_blur+t
-
-    att = 1.08+np.random.random()/10.0
-
-    for i in range(3):
-        maski = blend[:, :, i] > 1
-        mean_i = max(1., np.sum(blend[:, :, i]*maski)/(maski.sum()+1e-6))
-        r_blur[:, :, i] = r_blur[:, :, i]-(mean_i-1)*att
-    r_blur[r_blur >= 1] = 1
-    r_blur[r_blur <= 0] = 0
-
-    h, w = r_blur.shape[0:2]
-    neww = np.random.randint(0, 560-w-10)
-    newh = np.random.randint(0, 560-h-10)
-    alpha1 = g_mask[newh:newh+h, neww:neww+w, :]
-    alpha2 = 1-np.random.random()/5.0
-    r_blur_mask = np.multiply(r_blur, alpha1)
-    blend = r_blur_mask+t*alpha2
-
-    t = np.power(t, 1/2.2)
-    r_blur_mask = np.power(r_blur_mask, 1/2.2)
-    blend = np.power(blend, 1/2.2)
-    blend[blend >= 1] = 1
-    blend[blend <= 0] = 0
-
-    return t, r_blur_mask, blend
-
-# functions to compute different loss terms
-
-
-def compute_l1_loss(input, output):
-    return tf.reduce_mean(tf.abs(input-output))
-
-
-def compute_percep_loss(input, output, reuse=False):
-    vgg_real = build_vgg19(output*255.0, reuse=reuse)
-    vgg_fake = build_vgg19(input*255.0, reuse=True)
-    p0 = compute_l1_loss(vgg_real['input'], vgg_fake['input'])
-    p1 = compute_l1_loss(vgg_real['conv1_2'], vgg_fake['conv1_2'])/2.6
-    p2 = compute_l1_loss(vgg_real['conv2_2'], vgg_fake['conv2_2'])/4.8
-    p3 = compute_l1_loss(vgg_real['conv3_2'], vgg_fake['conv3_2'])/3.7
-    p4 = compute_l1_loss(vgg_real['conv4_2'], vgg_fake['conv4_2'])/5.6
-    p5 = compute_l1_loss(vgg_real['conv5_2'], vgg_fake['conv5_2'])*10/1.5
-    return p0+p1+p2+p3+p4+p5
-
-
-def compute_exclusion_loss(img1, img2, level=1):
-    gradx_loss = []
-    grady_loss = []
-
-    for l in range(level):
-        gradx1, grady1 = compute_gradient(img1)
-        gradx2, grady2 = compute_gradient(img2)
-        alphax = 2.0*tf.reduce_mean(tf.abs(gradx1)) / \
-            tf.reduce_mean(tf.abs(gradx2))
-        alphay = 2.0*tf.reduce_mean(tf.abs(grady1)) / \
-            tf.reduce_mean(tf.abs(grady2))
-
-        gradx1_s = (tf.nn.sigmoid(gradx1)*2)-1
-        grady1_s = (tf.nn.sigmoid(grady1)*2)-1
-        gradx2_s = (tf.nn.sigmoid(gradx2*alphax)*2)-1
-        grady2_s = (tf.nn.sigmoid(grady2*alphay)*2)-1
-
-        gradx_loss.append(tf.reduce_mean(tf.multiply(
-            tf.square(gradx1_s), tf.square(gradx2_s)), reduction_indices=[1, 2, 3])**0.25)
-        grady_loss.append(tf.reduce_mean(tf.multiply(
-            tf.square(grady1_s), tf.square(grady2_s)), reduction_indices=[1, 2, 3])**0.25)
-
-        img1 = tf.nn.avg_pool(img1, [1, 2, 2, 1], [1, 2, 2, 1], padding='SAME')
-        img2 = tf.nn.avg_pool(img2, [1, 2, 2, 1], [1, 2, 2, 1], padding='SAME')
-    return gradx_loss, grady_loss
-
-
-def compute_gradient(img):
-    gradx = img[:, 1:, :, :]-img[:, :-1, :, :]
-    grady = img[:, :, 1:, :]-img[:, :, :-1, :]
-    return gradx, grady
-
-def log_train_evolution(task, epoch, cnt, all_percep, all_grad):
+def log_train_evolution(task, epoch, cnt, percep_mean, grad_mean):
     log_path = "%s/train_evolution.csv" % task
     if not os.path.exists(log_path):
         with open(log_path, 'w') as f:
             f.write('epoch\titeration\tperceptual_loss\tall_loss\n')
     text = '%d\t%d\t%.2f\t%.2f\n' %(
-        epoch, cnt, np.mean(all_percep[np.where(all_percep)]), np.mean(all_grad[np.where(all_grad)]))
+        epoch, cnt, percep_mean, grad_mean)
     with open(log_path, 'a') as f:
         f.write(text)
 
-# set up the model and define the graph
-with tf.variable_scope(tf.get_variable_scope()):
-    input = tf.placeholder(tf.float32, shape=[None, None, None, 3])
-    target = tf.placeholder(tf.float32, shape=[None, None, None, 3])
-    reflection = tf.placeholder(tf.float32, shape=[None, None, None, 3])
-    issyn = tf.placeholder(tf.bool, shape=[])
-
-    # build the model
-    network = build(input)
-    transmission_layer, reflection_layer = tf.split(
-        network, num_or_size_splits=2, axis=3)
-
-    # Perceptual Loss
-    loss_percep_t = compute_percep_loss(transmission_layer, target)
-    loss_percep_r = tf.where(issyn, compute_percep_loss(
-        reflection_layer, reflection, reuse=True), 0.)
-    loss_percep = tf.where(issyn, loss_percep_t+loss_percep_r, loss_percep_t)
-
-    # Adversarial Loss
-    with tf.variable_scope("discriminator"):
-        predict_real, pred_real_dict = build_discriminator(input, target)
-    with tf.variable_scope("discriminator", reuse=True):
-        predict_fake, pred_fake_dict = build_discriminator(
-            input, transmission_layer)
-
-    d_loss = (tf.reduce_mean(-(tf.log(predict_real + EPS) +
-                               tf.log(1 - predict_fake + EPS)))) * 0.5
-    g_loss = tf.reduce_mean(-tf.log(predict_fake + EPS))
-
-    # L1 loss on reflection image
-    loss_l1_r = tf.where(issyn, compute_l1_loss(
-        reflection_layer, reflection), 0)
-
-    # Gradient loss
-    loss_gradx, loss_grady = compute_exclusion_loss(
-        transmission_layer, reflection_layer, level=3)
-    loss_gradxy = tf.reduce_sum(sum(loss_gradx)/3.) + \
-        tf.reduce_sum(sum(loss_grady)/3.)
-    loss_grad = tf.where(issyn, loss_gradxy/2.0, 0)
-
-    loss = loss_l1_r+loss_percep*0.2+loss_grad
-
-train_vars = tf.trainable_variables()
-d_vars = [var for var in train_vars if 'discriminator' in var.name]
-g_vars = [var for var in train_vars if 'g_' in var.name]
-# TODO: allow to modify the lr during train. https://github.com/ibab/tensorflow-wavenet/issues/267
-g_opt = tf.train.AdamOptimizer(learning_rate=ARGS.lr[0]).minimize(
-    loss*100+g_loss, var_list=g_vars)  # optimizer for the generator
-d_opt = tf.train.AdamOptimizer(learning_rate=ARGS.lr[1]).minimize(
-    d_loss, var_list=d_vars)  # optimizer for the discriminator
-
-for var in tf.trainable_variables():
-    print("Listing trainable variables ... ")
-    print(var)
-
-saver = tf.train.Saver(max_to_keep=10)
-
-######### Session #########
-sess = tf.Session()
-sess.run(tf.global_variables_initializer())
-ckpt = tf.train.get_checkpoint_state(task)
-print("[i] contain checkpoint: ", ckpt)
-if ckpt and continue_training:
-    saver_restore = tf.train.Saver([var for var in tf.trainable_variables()])
-    print('loaded '+ckpt.model_checkpoint_path)
-    saver_restore.restore(sess, ckpt.model_checkpoint_path)
-# test doesn't need to load discriminator
-elif ckpt is not None:
-    saver_restore = tf.train.Saver(
-        [var for var in tf.trainable_variables() if 'discriminator' not in var.name])
-    print('loaded '+ckpt.model_checkpoint_path)
-    saver_restore.restore(sess, ckpt.model_checkpoint_path)
-
-maxepoch = ARGS.max_epochs
-k_sz = np.linspace(1, 5, 80)  # for synthetic images
 if is_training:
     # please follow the dataset directory setup in README
-    def prepare_data(train_path):
-        input_names = []
-        image1 = []
-        image2 = []
-        for dirname in train_path:
-            train_t_gt = dirname + "transmission_layer/"
-            train_r_gt = dirname + "reflection_layer/"
-            train_b = dirname + "blended/"
-            for root, _, fnames in sorted(os.walk(train_t_gt)):
-                for fname in fnames:
-                    if is_image_file(fname):
-                        path_input = os.path.join(train_b, fname)
-                        path_output1 = os.path.join(train_t_gt, fname)
-                        path_output2 = os.path.join(train_r_gt, fname)
-                        input_names.append(path_input)
-                        image1.append(path_output1)
-                        image2.append(path_output2)
-        return input_names, image1, image2
-
-    def prepare_synthetic_data(train_path):
-        transmission_images = glob.glob(train_path + "transmission_layer/*")
-        transmission_images = [
-            name for name in transmission_images if is_image_file(name)]
-        reflection_images = glob.glob(train_path + "reflection_layer/*")
-        reflection_images = [
-            name for name in reflection_images if is_image_file(name)]
-        return transmission_images, reflection_images
-
-    syn_image1_list, syn_image2_list = prepare_synthetic_data(
-        train_syn_root[0])  # image pairs for generating synthetic training images
-    input_real_names, output_real_names1, output_real_names2 = prepare_data(
-        train_real_root)  # no reflection ground truth for real images
+    syn_image1_list, syn_image2_list, input_real_names, output_real_names1, sampler = training_files(
+        train_syn_root[0], train_real_root, ARGS.dataset_manifest, ARGS.refresh_dataset_manifest)
     print(len(syn_image1_list), len(syn_image2_list))
-    print(len(input_real_names), len(output_real_names1), len(output_real_names2))
+    print(len(input_real_names), len(output_real_names1))
     print("[i] Total %d training images, first path of real image is %s." %
           (len(syn_image1_list)+len(output_real_names1), input_real_names[0]))
 
@@ -431,108 +163,154 @@ if is_training:
     else:
         num_train = ARGS.n_images_epoch
     print("[i] Number of images per epoch: %i" % num_train)
-    all_l = np.zeros(num_train, dtype=float)
-    all_percep = np.zeros(num_train, dtype=float)
-    all_grad = np.zeros(num_train, dtype=float)
-    all_g = np.zeros(num_train, dtype=float)
-    for epoch in range(1, maxepoch):
-        input_images = [None]*num_train
-        output_images_t = [None]*num_train
-        output_images_r = [None]*num_train
+    # the loader forks its workers, before tensorflow starts the threads of
+    # the session
+    if ARGS.image_cache_dir:
+        image_cache = ImageCache(ARGS.image_cache_dir, ARGS.image_cache_mb)
+        imread = image_cache.imread
+    loader = PrefetchLoader(functools.partial(
+        load_training_sample, syn_image1_list, syn_image2_list,
+        input_real_names, output_real_names1, ARGS.data_syn_ratio, imread=imread, sampler=sampler),
+        num_workers=ARGS.num_workers, prefetch=ARGS.prefetch)
+    batcher = BucketBatcher(ARGS.batch_size)
 
+# set up the model and define the graph
+graph_st = time.time()
+if is_training:
+    model = TrainingGraph(hyper, ARGS.projected_hypercolumn == 1, ARGS.lr, ARGS.fused_update == 1)
+    input, target, reflection = model.input, model.target, model.reflection
+    d_opt, g_fetches = model.d_opt, model.g_fetches
+    if ARGS.fused_update:
+        fused_steps = model.fused_steps
+
+    for var in tf.trainable_variables():
+        print("Listing trainable variables ... ")
+        print(var)
+
+    ######### Session #########
+    sess = tf.Session()
+    sess.run(tf.global_variables_initializer())
+    load_vgg19_weights(sess)
+    ckpt = tf.train.get_checkpoint_state(task)
+    print("[i] contain checkpoint: ", ckpt)
+    if ckpt and continue_training:
+        saver_restore = tf.train.Saver([var for var in tf.trainable_variables()])
+        print('loaded '+ckpt.model_checkpoint_path)
+        saver_restore.restore(sess, ckpt.model_checkpoint_path)
+    elif ckpt is not None:
+        saver_restore = tf.train.Saver(
+            [var for var in tf.trainable_variables() if 'discriminator' not in var.name])
+        print('loaded '+ckpt.model_checkpoint_path)
+        saver_restore.restore(sess, ckpt.model_checkpoint_path)
+    checkpoints = CheckpointManager(sess, max_to_keep=ARGS.max_to_keep, keep_best=ARGS.keep_best)
+else:
+    # testing only needs the generator, built from the checkpoint or loaded
+    # from a frozen graph written by export.py
+    sess, input, transmission_layer, reflection_layer = load_model(
+        ARGS.frozen_model or task, hyper=hyper, projected=ARGS.projected_hypercolumn == 1)
+print("[i] Graph built in %.2fs, GraphDef size %.1f MB" % (
+    time.time()-graph_st, tf.get_default_graph().as_graph_def().ByteSize()/2.**20))
+
+profiler = None
+if ARGS.profile_iterations:
+    profiler = Profiler(ARGS.profile_dir or os.path.join(task, 'profile'),
+                        parse_iterations(ARGS.profile_iterations))
+
+maxepoch = ARGS.max_epochs
+if is_training:
+    metrics = TrainMetrics(ARGS.metrics_log or "%s/train_metrics.csv" % task,
+                           ['d_loss', 'g_loss', 'loss', 'percep_loss', 'exclusion_loss',
+                            'data_time', 'd_time', 'g_time'],
+                           flush_interval=ARGS.metrics_flush_secs, tensorboard_dir=ARGS.tensorboard_dir)
+
+    def epoch_batches():
+        for id in np.random.permutation(num_train):
+            sample = loader.get()
+            if sample is not None:
+                for batch in batcher.add(id, sample):
+                    yield batch
+        # train on the incomplete buckets too so every sample is seen once
+        for batch in batcher.flush():
+            yield batch
+
+    iteration = 0  # over all epochs, see --profile_iterations
+    for epoch in range(1, maxepoch):
         epoch_folder = "%s/%05d" % (task, epoch)
         if os.path.isdir(epoch_folder):
             continue
         cnt = 0
-        for id in np.random.permutation(num_train):
-            st = time.time()
-            if input_images[id] is None:
-                magic = np.random.random()
-                if magic < ARGS.data_syn_ratio:  # choose from synthetic dataset
-                    is_syn = True
-                    _id = np.random.randint(len(syn_image1_list))
-                    syn_image1 = cv2.imread(syn_image1_list[_id], -1)
-                    neww = np.random.randint(256, 480)
-                    newh = round(
-                        (neww/syn_image1.shape[1])*syn_image1.shape[0])
-                    output_image_t = cv2.resize(np.float32(
-                        syn_image1), (neww, newh), cv2.INTER_CUBIC)/255.0
-                    output_image_r = cv2.resize(np.float32(cv2.imread(np.random.choice(
-                        syn_image2_list), -1)), (neww, newh), cv2.INTER_CUBIC)/255.0
-                    file = os.path.splitext(
-                        os.path.basename(syn_image1_list[_id]))[0]
-                    sigma = k_sz[np.random.randint(0, len(k_sz))]
-                    if np.mean(output_image_t)*1/2 > np.mean(output_image_r):
-                        continue
-                    _, output_image_r, input_image = syn_data(
-                        output_image_t, output_image_r, sigma)
-                else:  # choose from real dataste
-                    is_syn = False
-                    _id = np.random.randint(len(input_real_names))
-                    inputimg = cv2.imread(input_real_names[_id], -1)
-                    file = os.path.splitext(
-                        os.path.basename(input_real_names[_id]))[0]
-                    neww = np.random.randint(256, 480)
-                    newh = round((neww/inputimg.shape[1])*inputimg.shape[0])
-                    input_image = cv2.resize(np.float32(
-                        inputimg), (neww, newh), cv2.INTER_CUBIC)/255.0
-                    output_image_t = cv2.resize(np.float32(cv2.imread(
-                        output_real_names1[_id], -1)), (neww, newh), cv2.INTER_CUBIC)/255.0
-                    output_image_r = output_image_t  # reflection gt not necessary
-                    sigma = 0.0
-                input_images[id] = np.expand_dims(input_image, axis=0)
-                output_images_t[id] = np.expand_dims(output_image_t, axis=0)
-                output_images_r[id] = np.expand_dims(output_image_r, axis=0)
-
-                # remove some degenerated images (low-light or over-saturated images), heuristically set
-                if output_images_r[id].max() < 0.15 or output_images_t[id].max() < 0.15:
-                    print("Invalid reflection file %s (degenerate channel)" % (file))
-                    continue
-                if input_images[id].max() < 0.1:
-                    print("Invalid file %s (degenerate image)" % (file))
-                    continue
-
-                # alternate training, update discriminator every two iterations
-                if cnt % ARGS.discriminator_update_freq == 0:
-                    fetch_list = [d_opt]
+        loader.pop_wait_time()
+        epoch_st = time.time()
+        n_samples = 0
+        st = time.time()
+        for ids, input_images, output_images_t, output_images_r, is_syn, file in epoch_batches():
+            data_time = time.time()-st
+            d_time = 0.0
+            feed_dict = {input: input_images, target: output_images_t}
+            if is_syn:
+                feed_dict[reflection] = output_images_r
+            fetch_list = g_fetches[is_syn]
+            run_options = profiler.run_options(iteration) if profiler else {}
+            # alternate training, update discriminator every two iterations
+            if cnt % ARGS.discriminator_update_freq == 0:
+                if ARGS.fused_update:
+                    # update D and G in the same run
+                    fetch_list = [fused_steps[is_syn]]+fetch_list[1:]
+                else:
                     # update D
+                    d_run_options = profiler.run_options(iteration) if profiler else {}
+                    d_st = time.time()
                     _ = sess.run(
-                        fetch_list, feed_dict={input: input_images[id], target: output_images_t[id]})
-                    fetch_list = [g_opt, transmission_layer, reflection_layer,
-                                  d_loss, g_loss,
-                                  loss, loss_percep, loss_grad]
-                # update G
-                _, pred_image_t, pred_image_r, current_d, current_g, current, current_percep, current_grad = sess.run(
-                    fetch_list,
-                    feed_dict={input: input_images[id], target: output_images_t[id], reflection: output_images_r[id], issyn: is_syn})
-
-                all_l[id] = current
-                all_percep[id] = current_percep
-                all_grad[id] = current_grad*255
-                all_g[id] = current_g
-                g_mean = np.mean(all_g[np.where(all_g)])
-                print("iter: %d %d || D: %.2f || G: %.2f %.2f || all: %.2f || loss: %.2f %.2f || mean: %.2f %.2f || time: %.2f" %
-                      (epoch, cnt, current_d, current_g, g_mean,
-                       np.mean(all_l[np.where(all_l)]),
-                       current_percep, current_grad*255,
-                       np.mean(all_percep[np.where(all_percep)]), np.mean(
-                           all_grad[np.where(all_grad)]),
-                       time.time()-st))
-                cnt += 1
-                input_images[id] = 1.
-                output_images_t[id] = 1.
-                output_images_r[id] = 1.
+                        [d_opt], feed_dict={input: input_images, target: output_images_t}, **d_run_options)
+                    d_time = time.time()-d_st
+                    if d_run_options:
+                        profiler.record(d_run_options, iteration, 'd_step')
+            # update G
+            g_st = time.time()
+            _, pred_image_t, pred_image_r, current_d, current_g, current, current_percep, current_grad = sess.run(
+                fetch_list, feed_dict=feed_dict, **run_options)
+            g_time = time.time()-g_st
+            if run_options:
+                profiler.record(run_options, iteration, 'g_step_syn' if is_syn else 'g_step_real')
+
+            values = dict(d_loss=current_d, g_loss=current_g, loss=current, percep_loss=current_percep,
+                          data_time=data_time, d_time=d_time, g_time=g_time)
+            if is_syn:  # the exclusion loss is only defined for synthetic images
+                values['exclusion_loss'] = current_grad*255
+            metrics.update(iteration, epoch, **values)
+            print("iter: %d %d || D: %.2f || G: %.2f %.2f || all: %.2f || loss: %.2f %.2f || mean: %.2f %.2f || time: %.2f" %
+                  (epoch, cnt, current_d, current_g, metrics.mean('g_loss'),
+                   metrics.mean('loss'),
+                   current_percep, current_grad*255,
+                   metrics.mean('percep_loss'), metrics.mean('exclusion_loss'),
+                   time.time()-st))
+            cnt += 1
+            iteration += 1
+            n_samples += len(ids)
+            st = time.time()
+        epoch_time = time.time()-epoch_st
+        print("[i] Epoch %d: %d iterations, %d images in %.2fs (%.2f images/s), %.2fs waiting for data" %
+              (epoch, cnt, n_samples, epoch_time, n_samples/epoch_time, loader.pop_wait_time()))
 
         # save model and images if required
         if epoch % ARGS.save_model_freq == 0 or epoch % ARGS.save_images_freq == 0:
             os.makedirs(epoch_folder)
-        log_train_evolution(task, epoch, cnt, all_percep, all_grad)
+        stats = metrics.end_epoch()
+        print("[i] Epoch %d time per iteration: %.3fs data, %.3fs D step, %.3fs G step" %
+              (epoch, stats['data_time']['mean'], stats['d_time']['mean'], stats['g_time']['mean']))
+        log_train_evolution(task, epoch, cnt, stats['percep_loss']['mean'], stats['exclusion_loss']['mean'])
+        # the checkpoints only hold the variables that are restored, not
+        # the optimizer slots, and are written in the background
+        saves = []
         if epoch % ARGS.save_model_freq == 0:
             print('Saving the model')
-            saver.save(sess, "%s/model.ckpt" % task)
+            saves.append(("%s/model.ckpt" % task, tf.trainable_variables()))
         if epoch % ARGS.save_model_freq_epoch == 0:
             print('Saving the epoch model')
-            saver.save(sess, "%s/model.ckpt" % (epoch_folder))
+            saves.append(("%s/model.ckpt" % (epoch_folder),
+                          model.g_vars if ARGS.save_generator_only else tf.trainable_variables()))
+        if saves:
+            checkpoints.save(saves, metric=stats['loss']['mean'])
         if epoch % ARGS.save_images_freq == 0:
             fileid = os.path.splitext(os.path.basename(file))[0]
             if not os.path.isdir("%s/%s" % (epoch_folder, fileid)):
@@ -540,12 +318,15 @@ if is_training:
             pred_image_t = np.minimum(np.maximum(pred_image_t, 0.0), 1.0)*255.0
             pred_image_r = np.minimum(np.maximum(pred_image_r, 0.0), 1.0)*255.0
             print("shape of outputs: ", pred_image_t.shape, pred_image_r.shape)
-            cv2.imwrite("%s/%s/int_t.png" % (epoch_folder, fileid),
-                        np.uint8(np.squeeze(input_image*255.0)))
-            cv2.imwrite("%s/%s/out_t.png" %
-                        (epoch_folder, fileid), np.uint8(np.squeeze(pred_image_t)))
-            cv2.imwrite("%s/%s/out_r.png" %
-                        (epoch_folder, fileid), np.uint8(np.squeeze(pred_image_r)))
+            checkpoints.submit(cv2.imwrite, "%s/%s/int_t.png" % (epoch_folder, fileid),
+                               np.uint8(input_images[-1]*255.0))
+            checkpoints.submit(cv2.imwrite, "%s/%s/out_t.png" %
+                               (epoch_folder, fileid), np.uint8(pred_image_t[-1]))
+            checkpoints.submit(cv2.imwrite, "%s/%s/out_r.png" %
+                               (epoch_folder, fileid), np.uint8(pred_image_r[-1]))
+    checkpoints.close()
+    metrics.close()
+    loader.close()
 # To test the model on images with reflection
 else:
     def prepare_data_test(test_path):
@@ -561,23 +342,92 @@ else:
     test_path = [ARGS.data_test_dir]
     subtask = ARGS.output_folder_name  # if you want to save different testset separately
     val_names = prepare_data_test(test_path)
-
-    for val_path in val_names:
-        testind = os.path.splitext(os.path.basename(val_path))[0]
-        if not os.path.isfile(val_path):
-            continue
-        img = cv2.imread(val_path)
-        input_image = np.expand_dims(np.float32(img), axis=0)/255.0
+    # result folders, named from the whole test set so images sharing a stem
+    # get the same distinct folders in every run
+    folders = dict(zip(val_names, output_names(val_names)))
+    manifest = None
+    if ARGS.incremental:
+        if not os.path.isdir("./test_results/%s" % subtask):
+            os.makedirs("./test_results/%s" % subtask)
+        model_id = result_identity(ARGS.frozen_model or latest_checkpoint(task) or task,
+                                   hyper=hyper, projected=ARGS.projected_hypercolumn,
+                                   tile_memory_mb=ARGS.tile_memory_mb, tile_halo=ARGS.tile_halo,
+                                   tile_stats=ARGS.tile_stats, lowres_pixels=ARGS.lowres_pixels,
+                                   lowres_radius=ARGS.lowres_radius, lowres_eps=ARGS.lowres_eps,
+                                   outputs=ARGS.write_outputs,
+                                   format=ARGS.write_format, level=ARGS.write_level,
+                                   input_copy=ARGS.input_copy)
+        manifest = ResultManifest("./test_results/%s/manifest.sqlite" % subtask, model_id)
+        val_names = manifest.pending(val_names)
+
+    # results are encoded and written on background threads, see --write_workers
+    writer = ResultWriter("./test_results/%s" % subtask, ARGS.write_workers, ARGS.write_queue,
+                          ARGS.write_outputs, ARGS.write_format, ARGS.write_level, ARGS.input_copy,
+                          on_written=manifest.done if manifest else None)
+
+    # images of the same size are run together, see --test_batch_size
+    batcher = ShapeBatcher(ARGS.test_batch_size)
+    n_images, n_runs, run_time = 0, 0, 0.0
+    # images larger than max_pixels are run alone, at a reduced resolution
+    # (--lowres_pixels) or tile by tile (--tile_memory_mb)
+    max_pixels = 0
+    if ARGS.lowres_pixels > 0:
+        max_pixels = ARGS.lowres_pixels
+        print("[i] Running images larger than %d pixels at a reduced resolution" % max_pixels)
+    elif ARGS.tile_memory_mb > 0:
+        tile_size = tile_size_for_budget(ARGS.tile_memory_mb, ARGS.tile_halo, ARGS.projected_hypercolumn == 1)
+        max_pixels = (tile_size+2*ARGS.tile_halo)**2
+        print("[i] Tiling images larger than %d pixels into %dx%d tiles, which process %.1f times their pixels" %
+              (max_pixels, tile_size, tile_size, tile_overhead(tile_size, ARGS.tile_halo)))
+    test_st = time.time()
+
+    def test_batches():
+        # batches are keyed by path, names like a.jpg and a.png share a stem
+        for val_path in val_names:
+            if not os.path.isfile(val_path):
+                continue
+            img = cv2.imread(val_path)
+            if max_pixels and img.shape[0]*img.shape[1] > max_pixels:
+                # too large to batch
+                yield [val_path], np.float32(img[np.newaxis])/255.0
+                continue
+            for batch in batcher.add(val_path, img):
+                yield batch
+        for batch in batcher.flush():
+            yield batch
+
+    for val_paths, input_images in test_batches():
+        testinds = [folders[val_path] for val_path in val_paths]
         st = time.time()
-        output_image_t, output_image_r = sess.run(
-            [transmission_layer, reflection_layer], feed_dict={input: input_image})
-        print("Test time %.3f for image %s" % (time.time()-st, val_path))
-        output_image_t = np.minimum(np.maximum(output_image_t, 0.0), 1.0)*255.0
-        output_image_r = np.minimum(np.maximum(output_image_r, 0.0), 1.0)*255.0
-        if not os.path.isdir("./test_results/%s/%s" % (subtask, testind)):
-            os.makedirs("./test_results/%s/%s" % (subtask, testind))
-        cv2.imwrite("./test_results/%s/%s/input.png" % (subtask, testind), img)
-        cv2.imwrite("./test_results/%s/%s/t_output.png" % (subtask, testind),
-                    np.uint8(output_image_t[0, :, :, 0:3]))  # output transmission layer
-        cv2.imwrite("./test_results/%s/%s/r_output.png" % (subtask, testind),
-                    np.uint8(output_image_r[0, :, :, 0:3]))  # output reflection layer
+        if ARGS.lowres_pixels > 0 and input_images.shape[1]*input_images.shape[2] > max_pixels:
+            output_image_t, output_image_r = run_lowres(
+                sess, input, [transmission_layer, reflection_layer], input_images[0],
+                max_pixels, radius=ARGS.lowres_radius, eps=ARGS.lowres_eps)
+        elif max_pixels and input_images.shape[1]*input_images.shape[2] > max_pixels:
+            output_image_t, output_image_r = run_tiled(
+                sess, input, [transmission_layer, reflection_layer], input_images[0],
+                tile_size, halo=ARGS.tile_halo, stats=ARGS.tile_stats, tile_batch=ARGS.tile_batch)
+        else:
+            run_options = profiler.run_options(n_runs) if profiler else {}
+            output_image_t, output_image_r = sess.run(
+                [transmission_layer, reflection_layer], feed_dict={input: input_images}, **run_options)
+            if run_options:
+                profiler.record(run_options, n_runs, 'test')
+        print("Test time %.3f for %d images: %s" %
+              (time.time()-st, len(testinds), ", ".join(testinds)))
+        run_time += time.time()-st
+        n_images += len(testinds)
+        n_runs += 1
+        for i, (testind, val_path) in enumerate(zip(testinds, val_paths)):
+            writer.submit(testind, val_path, input_images[i],
+                          output_image_t[i, :, :, 0:3], output_image_r[i, :, :, 0:3])
+    writer.close()
+    if manifest:
+        manifest.close()
+    total_time = time.time()-test_st
+    print("[i] Tested %d images in %d runs: %.2f images/s overall, %.2f images/s in the network, %.2fs waiting for the writer" %
+          (n_images, n_runs, n_images/max(total_time, 1e-6), n_images/max(run_time, 1e-6), writer.wait_time))
+
+if profiler:
+    # the tables of all traced runs, printed once
+    profiler.summary()
@@ -0,0 +1,127 @@
+from __future__ import division
+import os
+import glob
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+# record of the processed test images, so reruns only process new images
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def latest_checkpoint(task):
+    """Same as tf.train.latest_checkpoint, without importing tensorflow."""
+    path = os.path.join(task, 'checkpoint')
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                if line.startswith('model_checkpoint_path:'):
+                    name = line.split(':', 1)[1].strip().strip('"')
+                    return name if os.path.isabs(name) else os.path.join(task, name)
+    return None
+
+
+def model_identity(model, **config):
+    """Identifies a checkpoint or frozen graph and the options of a run.
+
+    `model` is a checkpoint prefix (e.g. task/model.ckpt) or a .pb file;
+    its files are identified by name, size and mtime. `config` holds the
+    options that change the results.
+    """
+    files = sorted(glob.glob(model+'.*')) if not model.endswith('.pb') else [model]
+    stats = [(os.path.basename(f), os.path.getsize(f), os.stat(f).st_mtime_ns) for f in files]
+    text = json.dumps({'model': os.path.abspath(model), 'files': stats, 'config': config},
+                      sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+# options of a test run that change its results, with the defaults of
+# main.py; tile_halo is GENERATOR_HALO of inference.py
+RESULT_DEFAULTS = {'tile_halo': 240, 'tile_stats': 'exact', 'lowres_pixels': 0, 'lowres_radius': 4,
+                   'lowres_eps': 1e-3, 'outputs': ['t', 'r'], 'format': 'png', 'level': None,
+                   'input_copy': 'encode'}
+
+
+def result_identity(model, hyper, projected, tile_memory_mb, **options):
+    """model_identity of a test run, options not given take the defaults of main.py."""
+    config = dict(RESULT_DEFAULTS)
+    for key, value in options.items():
+        if key not in config:
+            raise ValueError("Unknown result option %s" % key)
+        config[key] = value
+    return model_identity(model, hyper=hyper, projected=projected, tile_memory_mb=tile_memory_mb, **config)
+
+
+class ResultManifest(object):
+    """SQLite table of the images processed by a model in an output folder.
+
+    An image is processed again when its size, mtime and content hash do
+    not match the record, or when it was processed by another model or
+    with other options (`model_id`). Images are recorded by `done` once
+    their results are written, so an interrupted run resumes with the
+    images it did not finish. Records are committed at least every
+    `commit_interval` seconds.
+    """
+
+    def __init__(self, path, model_id, commit_interval=5.0):
+        self.model_id = model_id
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        # `done` is called from the writer threads
+        self.conn = sqlite3.connect(path, timeout=600, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS results (path TEXT PRIMARY KEY, size INTEGER, "
+                              "mtime INTEGER, hash TEXT, model TEXT, done REAL)")
+        self.stats = {}
+        self.last_commit = time.time()
+
+    def pending(self, paths):
+        """Returns the paths that have to be (re)processed."""
+        pending = []
+        n_changed = 0
+        for path in paths:
+            key = os.path.abspath(path)
+            stat = os.stat(key)
+            row = self.conn.execute("SELECT size, mtime, hash, model FROM results WHERE path = ?",
+                                    (key,)).fetchone()
+            if row is not None and row[3] == self.model_id and row[0:2] == (stat.st_size, stat.st_mtime_ns):
+                continue
+            # only hash files whose size or mtime changed
+            digest = file_hash(key)
+            if row is not None and row[3] == self.model_id and row[2] == digest:
+                with self.lock:
+                    self.conn.execute("UPDATE results SET size = ?, mtime = ? WHERE path = ?",
+                                      (stat.st_size, stat.st_mtime_ns, key))
+                continue
+            n_changed += row is not None
+            self.stats[key] = (stat.st_size, stat.st_mtime_ns, digest)
+            pending.append(path)
+        with self.lock:
+            self.conn.commit()
+        print("[i] Manifest: %d of %d images to process, %d of them changed or processed by another model" %
+              (len(pending), len(paths), n_changed))
+        return pending
+
+    def done(self, path):
+        key = os.path.abspath(path)
+        size, mtime, digest = self.stats.pop(key)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                              (key, size, mtime, digest, self.model_id, time.time()))
+            if time.time()-self.last_commit > self.commit_interval:
+                self.conn.commit()
+                self.last_commit = time.time()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
@@ -0,0 +1,137 @@
+from __future__ import division
+import numpy as np
+import tensorflow as tf
+import tensorflow.contrib.slim as slim
+from vgg import build_vgg19
+
+channel = 64  # number of feature channels to build the model, set to 64
+
+
+def lrelu(x):
+    return tf.maximum(x*0.2, x)
+
+
+def relu(x):
+    return tf.maximum(0.0, x)
+
+
+def identity_initializer():
+    def _initializer(shape, dtype=tf.float32, partition_info=None):
+        array = np.zeros(shape, dtype=float)
+        cx, cy = shape[0]//2, shape[1]//2
+        for i in range(np.minimum(shape[2], shape[3])):
+            array[cx, cy, i, i] = 1
+        return tf.constant(array, dtype=dtype)
+    return _initializer
+
+
+def nm(x, per_image=False):
+    w0 = tf.Variable(1.0, name='w0')
+    w1 = tf.Variable(0.0, name='w1')
+    if not per_image:
+        return w0*x+w1*slim.batch_norm(x)
+    # same as slim.batch_norm on a batch of one image, but every image of a
+    # batch is normalized with its own moments so batching does not change
+    # the outputs at test time
+    with tf.variable_scope('BatchNorm'):
+        beta = tf.get_variable('beta', [x.get_shape()[-1]], initializer=tf.zeros_initializer())
+    mean, variance = tf.nn.moments(x, axes=[1, 2], keep_dims=True)
+    # exposed so that tiled inference can feed image-wide statistics
+    tf.add_to_collection('nm_inputs', x)
+    tf.add_to_collection('nm_means', mean)
+    tf.add_to_collection('nm_variances', variance)
+    # w0*x+w1*((x-mean)/sqrt(variance+eps)+beta) folded into a single scale
+    # and shift per image and channel
+    inv = tf.rsqrt(variance+1e-3)
+    return x*(w0+w1*inv)+w1*(beta-mean*inv)
+
+
+# our reflection removal model
+
+# vgg19 layers of the hypercolumn, concatenated deepest first before the
+# input image: 512+512+256+128+64+3 input channels for g_conv0
+HYPERCOLUMN_LAYERS = [('conv5_2', 512), ('conv4_2', 512), ('conv3_2', 256),
+                      ('conv2_2', 128), ('conv1_2', 64)]
+HYPERCOLUMN_CHANNELS = sum(n for _, n in HYPERCOLUMN_LAYERS)+3
+
+
+def build(input, hyper=True, per_image_norm=False, projected=False):
+    """Builds the generator, `per_image_norm` is used at test time (see nm).
+
+    With `projected` the hypercolumn is never materialized at full
+    resolution (see projected_hypercolumn), the variables are the same.
+    """
+    with slim.arg_scope([slim.conv2d], normalizer_params={'per_image': per_image_norm}):
+        if projected:
+            net = projected_hypercolumn(input, hyper, per_image_norm)
+        else:
+            net = slim.conv2d(hypercolumn(input, hyper), channel, [1, 1], rate=1, activation_fn=lrelu,
+                              normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv0')
+        return _build(net)
+
+
+def hypercolumn(input, hyper):
+    if hyper:
+        print("[i] Hypercolumn ON, building hypercolumn features ... ")
+        vgg19_features = build_vgg19(input[:, :, :, 0:3]*255.0)
+        for layer_id in range(1, 6):
+            vgg19_f = vgg19_features['conv%d_2' % layer_id]
+            input = tf.concat([tf.image.resize_bilinear(
+                vgg19_f, (tf.shape(input)[1], tf.shape(input)[2]))/255.0, input], axis=3)
+    else:
+        vgg19_features = build_vgg19(input[:, :, :, 0:3]*255.0)
+        for layer_id in range(1, 6):
+            vgg19_f = vgg19_features['conv%d_2' % layer_id]
+            input = tf.concat([tf.image.resize_bilinear(tf.zeros_like(
+                vgg19_f), (tf.shape(input)[1], tf.shape(input)[2]))/255.0, input], axis=3)
+    return input
+
+
+def projected_hypercolumn(input, hyper, per_image_norm):
+    """Same as g_conv0 on the hypercolumn without building the hypercolumn.
+
+    Bilinear resizing and 1x1 convolutions are both linear and commute, so
+    every vgg19 feature map is projected to `channel` maps by its slice of
+    the g_conv0 kernel at its own resolution, then upsampled and summed.
+    The largest full resolution tensor has `channel` channels instead of
+    HYPERCOLUMN_CHANNELS.
+    """
+    size = (tf.shape(input)[1], tf.shape(input)[2])
+    with tf.variable_scope('g_conv0'):
+        weights = slim.model_variable('weights', [1, 1, HYPERCOLUMN_CHANNELS, channel],
+                                      initializer=identity_initializer())
+        net = tf.nn.conv2d(input, weights[:, :, -3:], [1, 1, 1, 1], 'SAME')
+        if hyper:
+            print("[i] Hypercolumn ON, building projected hypercolumn features ... ")
+            vgg19_features = build_vgg19(input[:, :, :, 0:3]*255.0)
+            offset = 0
+            for name, n in HYPERCOLUMN_LAYERS:
+                projection = tf.nn.conv2d(vgg19_features[name]/255.0, weights[:, :, offset:offset+n],
+                                          [1, 1, 1, 1], 'SAME')
+                net = net+tf.image.resize_bilinear(projection, size)
+                offset += n
+        # without hypercolumn the features are zeros and contribute nothing
+        return lrelu(nm(net, per_image_norm))
+
+
+def _build(net):
+    net = slim.conv2d(net, channel, [3, 3], rate=1, activation_fn=lrelu,
+                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv1')
+    net = slim.conv2d(net, channel, [3, 3], rate=2, activation_fn=lrelu,
+                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv2')
+    net = slim.conv2d(net, channel, [3, 3], rate=4, activation_fn=lrelu,
+                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv3')
+    net = slim.conv2d(net, channel, [3, 3], rate=8, activation_fn=lrelu,
+                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv4')
+    net = slim.conv2d(net, channel, [3, 3], rate=16, activation_fn=lrelu,
+                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv5')
+    net = slim.conv2d(net, channel, [3, 3], rate=32, activation_fn=lrelu,
+                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv6')
+    net = slim.conv2d(net, channel, [3, 3], rate=64, activation_fn=lrelu,
+                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv7')
+    net = slim.conv2d(net, channel, [3, 3], rate=1, activation_fn=lrelu,
+                      normalizer_fn=nm, weights_initializer=identity_initializer(), scope='g_conv9')
+    # output 6 channels --> 3 for transmission layer and 3 for reflection layer
+    net = slim.conv2d(net, 3*2, [1, 1], rate=1,
+                      activation_fn=None, scope='g_conv_last')
+    return net
@@ -0,0 +1,115 @@
+from __future__ import division
+import os
+import re
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+# opt-in tracing of selected session runs with a per-op and per-scope summary
+
+
+def parse_iterations(text):
+    """'10-12,50' -> {10, 11, 12, 50}"""
+    iterations = set()
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            iterations.update(range(int(first), int(last)+1))
+        elif part.strip():
+            iterations.add(int(part))
+    return iterations
+
+
+def op_group(name):
+    """Scope an op is accounted to: vgg19, g_conv*, discriminator/layer_*,
+    percep_loss/vgg19, exclusion_loss...
+
+    Repeated scopes (vgg19_1, discriminator_1, percep_loss_1, g_conv1_1)
+    are merged and the ops of the backward pass are grouped under gradients/
+    the same way.
+    """
+    parts = [re.sub(r'^(vgg19|discriminator|gradients|\w*_loss|g_conv\w*?)_\d+$', r'\1', part)
+             for part in name.split(':')[0].split('/')]
+    prefix = ''
+    if parts[0] == 'gradients' and len(parts) > 1:
+        prefix, parts = 'gradients/', parts[1:]
+    for i, part in enumerate(parts):
+        if part == 'discriminator' and i+1 < len(parts) and parts[i+1].startswith('layer_'):
+            return prefix+'discriminator/'+parts[i+1]
+        if part.endswith('_loss'):
+            # the perceptual loss runs its own vgg19 passes
+            return prefix+part+('/vgg19' if 'vgg19' in parts[i+1:] else '')
+        if part in ('vgg19', 'discriminator') or part.startswith('g_conv'):
+            return prefix+part
+    return prefix+parts[0]
+
+
+class Profiler(object):
+    """Traces the session runs of chosen iterations.
+
+    `run_options(step)` returns the keyword arguments of `sess.run`: empty,
+    so nothing changes, unless `step` is one of `iterations`. Every traced
+    run is written to `folder` as a Chrome trace (chrome://tracing) and
+    accumulated into per-op and per-scope tables of time and output memory.
+    """
+
+    def __init__(self, folder, iterations, top=25):
+        self.folder = folder
+        self.iterations = iterations
+        self.top = top
+        self.ops = {}
+        self.groups = {}
+        self.n_runs = 0
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        print("[i] Profiling iterations %s into %s" % (sorted(iterations), folder))
+
+    def run_options(self, step):
+        if step not in self.iterations:
+            return {}
+        return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                'run_metadata': tf.RunMetadata()}
+
+    def record(self, run_options, step, name):
+        """Exports and accumulates the trace of a run made with `run_options`."""
+        step_stats = run_options['run_metadata'].step_stats
+        trace = timeline.Timeline(step_stats).generate_chrome_trace_format(show_memory=True)
+        with open(os.path.join(self.folder, "trace_%s_%06d.json" % (name, step)), 'w') as f:
+            f.write(trace)
+        self.n_runs += 1
+        # on gpu, kernel times are in the stream:all device, the other gpu
+        # devices only hold launches or duplicate the streams
+        devices = [device.device for device in step_stats.dev_stats]
+        streams = any(device.endswith('/stream:all') for device in devices)
+        for device in step_stats.dev_stats:
+            if streams and 'gpu' in device.device.lower() and not device.device.endswith('/stream:all'):
+                continue
+            for node in device.node_stats:
+                op = node.node_name.split(':')[0]
+                micros = node.all_end_rel_micros
+                nbytes = sum(output.tensor_description.allocation_description.requested_bytes
+                             for output in node.output)
+                for table, key in ((self.ops, (name, op)), (self.groups, (name, op_group(op)))):
+                    entry = table.setdefault(key, [0, 0])
+                    entry[0] += micros
+                    entry[1] += nbytes
+
+    def summary(self):
+        """Prints the top ops and the scopes by time and writes summary.txt."""
+        lines = []
+        for title, table, n in (('op', self.ops, self.top), ('scope', self.groups, None)):
+            for name in sorted(set(key[0] for key in table)):
+                entries = [(key[1], value) for key, value in table.items() if key[0] == name]
+                total = max(sum(value[0] for _, value in entries), 1)
+                lines.append("%s: time per %s over %d traced runs" % (name, title, self.n_runs))
+                lines.append("%-60s %10s %6s %10s" % (title, 'ms', '%', 'output MB'))
+                for key, (micros, nbytes) in sorted(entries, key=lambda e: -e[1][0])[:n]:
+                    lines.append("%-60s %10.2f %6.1f %10.1f" % (
+                        key[-60:], micros/1000, 100*micros/total, nbytes/2.**20))
+                for key, (micros, nbytes) in sorted(entries, key=lambda e: -e[1][1])[:5]:
+                    lines.append("%-60s %10s %6s %10.1f  (largest output)" % (
+                        key[-60:], '', '', nbytes/2.**20))
+                lines.append('')
+        text = '\n'.join(lines)
+        print(text)
+        with open(os.path.join(self.folder, "summary.txt"), 'w') as f:
+            f.write(text)
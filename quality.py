@@ -0,0 +1,26 @@
+from __future__ import division
+import cv2
+import numpy as np
+
+# image quality metrics on [h, w, c] images in [0, 1]
+
+
+def psnr(image, reference):
+    mse = np.mean(np.square(np.float64(image)-np.float64(reference)))
+    return float('inf') if mse == 0 else 10*np.log10(1.0/mse)
+
+
+def ssim(image, reference):
+    """Mean SSIM over the channels with an 11x11 Gaussian window (sigma 1.5)."""
+    c1, c2 = 0.01**2, 0.03**2
+    x = np.float64(image)
+    y = np.float64(reference)
+
+    def blur(z):
+        return cv2.GaussianBlur(z, (11, 11), 1.5, borderType=cv2.BORDER_REFLECT)
+    mx, my = blur(x), blur(y)
+    sxx = blur(x*x)-mx*mx
+    syy = blur(y*y)-my*my
+    sxy = blur(x*y)-mx*my
+    ssim_map = ((2*mx*my+c1)*(2*sxy+c2))/((mx*mx+my*my+c1)*(sxx+syy+c2))
+    return float(ssim_map.mean())
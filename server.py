@@ -0,0 +1,280 @@
+from __future__ import division
+import os
+import json
+import time
+import base64
+import argparse
+import itertools
+import threading
+import collections
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import cv2
+import numpy as np
+from inference import GENERATOR_HALO, load_model, min_tile_memory_mb, run_lowres, run_tiled, tile_size_for_budget
+
+# long-lived inference server: loads the model once and runs the queued
+# requests in batches of equally sized images
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--task", default="pre-trained",
+                    help="path to folder containing the model")
+parser.add_argument("--frozen_model", default="",
+                    help="Frozen graph written by export.py to serve instead of the checkpoint in `task`")
+parser.add_argument("--is_hyper", default=1, type=int,
+                    help="use hypercolumn or not")
+parser.add_argument("--projected_hypercolumn", default=0, type=int,
+                    help="Project the vgg features before upsampling them instead of building the full resolution hypercolumn")
+parser.add_argument("--port", default=8500, type=int,
+                    help="Port of the HTTP server, it only listens on localhost")
+parser.add_argument("--socket", default="",
+                    help="Serve on this Unix socket instead of a port")
+parser.add_argument("--batch_size", default=4, type=int,
+                    help="Maximum number of equally sized images run together")
+parser.add_argument("--max_latency_ms", default=20, type=float,
+                    help="Maximum time a request waits for other requests to batch with")
+parser.add_argument("--lowres_pixels", default=0, type=int,
+                    help="Run images larger than this many pixels at a reduced resolution and upsample the results, 0 disables it")
+parser.add_argument("--tile_memory_mb", default=0, type=int,
+                    help="Split images that do not fit this activation memory budget into tiles, at least %d MB "
+                         "with the default --tile_halo or %d MB with --projected_hypercolumn 1, which also gets much "
+                         "larger tiles from the same budget. 0 disables tiling"
+                         % (min_tile_memory_mb(), min_tile_memory_mb(projected=True)))
+parser.add_argument("--tile_halo", default=GENERATOR_HALO, type=int,
+                    help="Context in pixels added around every tile, a multiple of 16")
+
+
+class Request(object):
+
+    def __init__(self, image):
+        self.image = image
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.outputs = None
+        self.error = None
+
+
+class DynamicBatcher(object):
+    """Runs queued images in batches of identical shape on a worker thread.
+
+    A request waits at most `max_latency` seconds for other requests of the
+    same shape; the shape with the oldest request is served first. Images
+    larger than `max_pixels` are run alone, at a reduced resolution with
+    `lowres` or else with tiled inference.
+    """
+
+    def __init__(self, sess, input, fetches, batch_size, max_latency,
+                 tile_size=0, max_pixels=0, halo=GENERATOR_HALO, lowres=False):
+        self.sess = sess
+        self.input = input
+        self.fetches = fetches
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.tile_size = tile_size
+        self.max_pixels = max_pixels
+        self.halo = halo
+        self.lowres = lowres
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.depth = 0
+        self.n_requests = 0
+        self.n_batches = 0
+        self.latencies = collections.deque(maxlen=1000)
+        self.run_times = collections.deque(maxlen=1000)
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+    def process(self, image):
+        """Blocks until `image` has been processed, returns the outputs."""
+        request = Request(image)
+        key = image.shape
+        if self.max_pixels and image.shape[0]*image.shape[1] > self.max_pixels:
+            key = ('large',)+key  # never batched
+        with self.cond:
+            self.pending.setdefault(key, []).append(request)
+            self.depth += 1
+            self.cond.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.outputs
+
+    def _next_batch(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                # buckets that are full, expired or too large, oldest first
+                ready = [(bucket[0].arrival, key) for key, bucket in self.pending.items()
+                         if key[0] == 'large' or len(bucket) >= self.batch_size
+                         or now >= bucket[0].arrival+self.max_latency]
+                if ready:
+                    break
+                if self.pending:
+                    self.cond.wait(min(bucket[0].arrival for bucket in self.pending.values())
+                                   + self.max_latency-now)
+                else:
+                    self.cond.wait()
+            key = min(ready)[1]
+            bucket = self.pending.pop(key)
+            batch = bucket[:self.batch_size]
+            if len(bucket) > len(batch):
+                self.pending[key] = bucket[len(batch):]
+            self.depth -= len(batch)
+            return key, batch
+
+    def _loop(self):
+        while True:
+            key, batch = self._next_batch()
+            st = time.time()
+            try:
+                images = np.float32(np.stack([r.image for r in batch]))/255.0
+                if key[0] == 'large' and self.lowres:
+                    outputs = run_lowres(self.sess, self.input, self.fetches, images[0],
+                                         self.max_pixels)
+                elif key[0] == 'large':
+                    outputs = run_tiled(self.sess, self.input, self.fetches, images[0],
+                                        self.tile_size, halo=self.halo)
+                else:
+                    outputs = self.sess.run(self.fetches, feed_dict={self.input: images})
+                for i, request in enumerate(batch):
+                    request.outputs = [output[i] for output in outputs]
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            now = time.time()
+            with self.cond:
+                self.n_batches += 1
+                self.n_requests += len(batch)
+                self.run_times.append(now-st)
+                self.latencies.extend(now-r.arrival for r in batch)
+            for request in batch:
+                request.done.set()
+
+    def stats(self):
+        with self.cond:
+            latencies = np.array(self.latencies)*1000
+            stats = {'queue_depth': self.depth, 'requests': self.n_requests,
+                     'batches': self.n_batches,
+                     'mean_batch_size': self.n_requests/max(self.n_batches, 1),
+                     'mean_run_ms': float(np.mean(self.run_times)*1000) if self.run_times else 0.0}
+        for p in (50, 90, 99):
+            stats['latency_p%d_ms' % p] = float(np.percentile(latencies, p)) if len(latencies) else 0.0
+        return stats
+
+
+def _encode(output):
+    output = np.uint8(np.minimum(np.maximum(output, 0.0), 1.0)*255.0)
+    return cv2.imencode('.png', output)[1].tobytes()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """POST /separate with a JSON body, GET /stats.
+
+    The body holds either `path`, an image file readable by the server, or
+    `image`, a base64 encoded image file. With `output_dir` the outputs are
+    written there as <name>_<id>_t.png and <name>_<id>_r.png, `name` being
+    the stem of `path` or `request` and `id` unique to the request, and
+    their paths are returned as `t_output` and `r_output`. Otherwise they
+    are returned base64 encoded as `transmission` and `reflection` PNG files.
+    """
+    batcher = None
+    request_ids = itertools.count()
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.batcher.stats())
+        else:
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/separate':
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            body = json.loads(self.rfile.read(
+                int(self.headers.get('Content-Length', 0))).decode())
+            if not isinstance(body, dict):
+                raise TypeError("the body must be a JSON object")
+            if 'path' in body:
+                image = cv2.imread(body['path'])
+            else:
+                image = cv2.imdecode(np.frombuffer(
+                    base64.b64decode(body['image']), np.uint8), cv2.IMREAD_COLOR)
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': 'invalid request: %s' % e})
+            return
+        if image is None:
+            self._reply(400, {'error': 'could not read the image'})
+            return
+        st = time.time()
+        try:
+            output_t, output_r = self.batcher.process(image)
+        except Exception as e:
+            self._reply(500, {'error': str(e)})
+            return
+        reply = {'latency_ms': (time.time()-st)*1000}
+        if body.get('output_dir'):
+            try:
+                # concurrent requests, even for the same path, never share a name
+                stem = os.path.splitext(os.path.basename(body['path']))[0] if 'path' in body else 'request'
+                prefix = os.path.join(body['output_dir'], '%s_%d' % (stem, next(self.request_ids)))
+                os.makedirs(body['output_dir'], exist_ok=True)
+                for name, suffix, output in (('t_output', '_t.png', output_t),
+                                             ('r_output', '_r.png', output_r)):
+                    reply[name] = prefix+suffix
+                    with open(reply[name], 'wb') as f:
+                        f.write(_encode(output))
+            except (OSError, TypeError) as e:
+                self._reply(500, {'error': 'could not write the outputs: %s' % e})
+                return
+        else:
+            reply['transmission'] = base64.b64encode(_encode(output_t)).decode()
+            reply['reflection'] = base64.b64encode(_encode(output_r)).decode()
+        self._reply(200, reply)
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    ARGS = parser.parse_args()
+    print(ARGS)
+    sess, input, transmission_layer, reflection_layer = load_model(
+        ARGS.frozen_model or ARGS.task, hyper=ARGS.is_hyper == 1,
+        projected=ARGS.projected_hypercolumn == 1)
+    tile_size, max_pixels = 0, 0
+    if ARGS.lowres_pixels > 0:
+        max_pixels = ARGS.lowres_pixels
+    elif ARGS.tile_memory_mb > 0:
+        tile_size = tile_size_for_budget(ARGS.tile_memory_mb, ARGS.tile_halo, ARGS.projected_hypercolumn == 1)
+        max_pixels = (tile_size+2*ARGS.tile_halo)**2
+    Handler.batcher = DynamicBatcher(sess, input, [transmission_layer, reflection_layer],
+                                     ARGS.batch_size, ARGS.max_latency_ms/1000.0,
+                                     tile_size, max_pixels, ARGS.tile_halo, ARGS.lowres_pixels > 0)
+    if ARGS.socket:
+        if os.path.exists(ARGS.socket):
+            os.remove(ARGS.socket)
+        server = ThreadingUnixHTTPServer(ARGS.socket, Handler)
+        print("[i] Serving on unix socket %s" % ARGS.socket)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', ARGS.port), Handler)
+        print("[i] Serving on http://127.0.0.1:%d" % ARGS.port)
+    server.serve_forever()
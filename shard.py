@@ -0,0 +1,232 @@
+from __future__ import division
+import os
+import json
+import time
+import queue
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from dataset_manifest import is_image_file, output_names
+from manifest import ResultManifest, latest_checkpoint, result_identity
+
+# tests a folder of images with several processes, each with its own
+# session. Tensorflow is only imported in the workers
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--task", default="pre-trained",
+                    help="path to folder containing the model")
+parser.add_argument("--frozen_model", default="",
+                    help="Frozen graph written by export.py to test with instead of the checkpoint in `task`")
+parser.add_argument("--is_hyper", default=1, type=int,
+                    help="use hypercolumn or not")
+parser.add_argument("--projected_hypercolumn", default=0, type=int,
+                    help="Project the vgg features before upsampling them instead of building the full resolution hypercolumn")
+parser.add_argument("--data_test_dir", default="./test_images/real/",
+                    help="path to test dataset for making predictions")
+parser.add_argument("--output_folder_name", default="CEILNet",
+                    help="Name of folder for saving results")
+parser.add_argument("--num_workers", default=0, type=int,
+                    help="Number of worker processes, by default one per --threads cores")
+parser.add_argument("--threads", default=1, type=int,
+                    help="intra-op threads of every worker session")
+parser.add_argument("--inter_op_threads", default=1, type=int,
+                    help="inter-op threads of every worker session")
+parser.add_argument("--affinity", action="store_true",
+                    help="Pin every worker to its own --threads cores")
+parser.add_argument("--gpu", action="store_true",
+                    help="Let the workers use the GPUs, by default they run on the CPU")
+parser.add_argument("--tile_memory_mb", default=0, type=int,
+                    help="Split test images that do not fit this activation memory budget into tiles, at least 2883 MB "
+                         "with the 240 pixel halo or 481 MB with --projected_hypercolumn 1, 0 disables tiling")
+parser.add_argument("--incremental", action="store_true",
+                    help="Only test images that are new or changed, or were tested with another model")
+parser.add_argument("--benchmark", default=0, type=int,
+                    help="Instead of testing, time every workers x threads configuration on this many images")
+parser.add_argument("--benchmark_output", default="",
+                    help="Write the benchmark results to this JSON file")
+
+def list_images(folder):
+    names = []
+    for dirname, _, fnames in sorted(os.walk(folder)):
+        for fname in sorted(fnames):
+            if is_image_file(fname):
+                names.append(os.path.join(dirname, fname))
+    return names
+
+
+def _worker(args, worker_id, paths, names, cpus, output_folder, messages):
+    # runs in a fresh process: configure threads and affinity before
+    # tensorflow is imported
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    if not args.gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    import cv2
+    import numpy as np
+    import tensorflow as tf
+    from inference import GENERATOR_HALO, load_model, run_tiled, tile_size_for_budget
+    from writer import ResultWriter
+    cv2.setNumThreads(1)
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.threads,
+                            inter_op_parallelism_threads=args.inter_op_threads)
+    sess, input, transmission_layer, reflection_layer = load_model(
+        args.frozen_model or args.task, hyper=args.is_hyper == 1,
+        projected=args.projected_hypercolumn == 1, config=config)
+    fetches = [transmission_layer, reflection_layer]
+    tile_size, max_pixels = 0, 0
+    if args.tile_memory_mb > 0:
+        tile_size = tile_size_for_budget(args.tile_memory_mb, projected=args.projected_hypercolumn == 1)
+        max_pixels = (tile_size+2*GENERATOR_HALO)**2
+    # the workers already use all cores, write on the worker thread
+    writer = ResultWriter(output_folder, num_workers=0)
+    messages.put(('ready', worker_id, None, time.time()))
+    for path in paths:
+        st = time.time()
+        try:
+            img = cv2.imread(path)
+            if img is None:
+                raise IOError("Could not read %s" % path)
+            image = np.float32(img)/255.0
+            if tile_size and image.shape[0]*image.shape[1] > max_pixels:
+                output_t, output_r = run_tiled(sess, input, fetches, image, tile_size)
+            else:
+                output_t, output_r = sess.run(fetches, feed_dict={input: image[np.newaxis]})
+            writer.submit(names[path], path, image, output_t[0], output_r[0])
+            messages.put(('done', worker_id, path, time.time()-st))
+        except Exception as e:
+            messages.put(('failed', worker_id, path, repr(e)))
+    messages.put(('exit', worker_id, None, time.time()))
+
+
+def run_sharded(args, paths, num_workers, output_folder, on_done=None, names=None):
+    """Tests `paths` with `num_workers` processes.
+
+    `names` maps the paths to their result folders, output_names(paths) by
+    default. Progress is printed as the workers report it. Files that fail, or that
+    were assigned to a worker that died, are returned with their error and
+    do not stop the other files. Returns (failures, images per second
+    once all workers were ready).
+    """
+    if names is None:
+        names = dict(zip(paths, output_names(paths)))
+    ctx = multiprocessing.get_context('spawn')
+    messages = ctx.Queue()
+    cores = sorted(os.sched_getaffinity(0))
+    workers = {}
+    for i in range(num_workers):
+        # interleaved shards, so every worker sees a mix of the folders
+        shard = paths[i::num_workers]
+        cpus = None
+        if args.affinity:
+            cpus = set(cores[(i*args.threads+j) % len(cores)] for j in range(args.threads))
+        p = ctx.Process(target=_worker, args=(args, i, shard, dict((path, names[path]) for path in shard),
+                                              cpus, output_folder, messages))
+        p.daemon = True
+        p.start()
+        workers[i] = (p, set(shard))
+    failures = {}
+    n_done, ready, last_print = 0, {}, time.time()
+    running = set(workers)
+    while running:
+        try:
+            kind, worker_id, path, value = messages.get(timeout=1.0)
+        except queue.Empty:
+            # a worker that died without saying goodbye fails its files
+            for i in list(running):
+                p, remaining = workers[i]
+                if not p.is_alive():
+                    for path in remaining:
+                        failures[path] = 'worker %d exited with code %s' % (i, p.exitcode)
+                    running.discard(i)
+            continue
+        if kind == 'ready':
+            ready[worker_id] = value
+            if len(ready) == num_workers:
+                start = time.time()
+        elif kind == 'exit':
+            running.discard(worker_id)
+        else:
+            workers[worker_id][1].discard(path)
+            if kind == 'done':
+                n_done += 1
+                if on_done is not None:
+                    on_done(path)
+            else:
+                failures[path] = value
+                print("[!] Failed %s: %s" % (path, value))
+        if time.time()-last_print > 5 or not running:
+            last_print = time.time()
+            print("[i] %d/%d images done, %d failed, %d/%d workers running" %
+                  (n_done, len(paths), len(failures), len(running), num_workers))
+    for p, _ in workers.values():
+        p.join()
+    rate = 0.0
+    if len(ready) == num_workers:
+        rate = n_done/max(time.time()-start, 1e-6)
+    return failures, rate
+
+
+def benchmark(args, paths):
+    """Times every workers x threads configuration that fits the cores."""
+    cores = len(os.sched_getaffinity(0))
+    paths = [paths[i % len(paths)] for i in range(args.benchmark)]
+    configs = []
+    workers = 1
+    while workers <= cores:
+        configs.append((workers, cores//workers))
+        workers *= 2
+    results = []
+    folder = tempfile.mkdtemp()
+    try:
+        for num_workers, threads in configs:
+            args.threads = threads
+            _, rate = run_sharded(args, paths, num_workers, folder)
+            results.append({'workers': num_workers, 'threads': threads,
+                            'inter_op_threads': args.inter_op_threads,
+                            'affinity': args.affinity, 'images_per_second': rate})
+            print("[i] %2d workers x %2d threads: %.2f images/s" % (num_workers, threads, rate))
+    finally:
+        shutil.rmtree(folder)
+    best = max(results, key=lambda r: r['images_per_second'])
+    print("[i] Best configuration on %d cores: --num_workers %d --threads %d (%.2f images/s)" %
+          (cores, best['workers'], best['threads'], best['images_per_second']))
+    if args.benchmark_output:
+        with open(args.benchmark_output, 'w') as f:
+            json.dump({'cores': cores, 'images': len(paths), 'results': results}, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    ARGS = parser.parse_args()
+    print(ARGS)
+    paths = list_images(ARGS.data_test_dir)
+    # named from the whole folder, like main.py, also with --incremental
+    names = dict(zip(paths, output_names(paths)))
+    if ARGS.benchmark:
+        benchmark(ARGS, paths)
+    else:
+        output_folder = "./test_results/%s" % ARGS.output_folder_name
+        if not os.path.isdir(output_folder):
+            os.makedirs(output_folder)
+        manifest = None
+        if ARGS.incremental:
+            # same identity as main.py with its default tiling and output options
+            model = ARGS.frozen_model or latest_checkpoint(ARGS.task) or ARGS.task
+            manifest = ResultManifest(os.path.join(output_folder, 'manifest.sqlite'), result_identity(
+                model, hyper=ARGS.is_hyper == 1, projected=ARGS.projected_hypercolumn,
+                tile_memory_mb=ARGS.tile_memory_mb))
+            paths = manifest.pending(paths)
+        num_workers = ARGS.num_workers or max(1, len(os.sched_getaffinity(0))//ARGS.threads)
+        st = time.time()
+        failures, rate = run_sharded(ARGS, paths, num_workers, output_folder,
+                                     manifest.done if manifest else None, names)
+        if manifest:
+            manifest.close()
+        print("[i] Tested %d images with %d workers in %.2fs, %.2f images/s once loaded" %
+              (len(paths)-len(failures), num_workers, time.time()-st, rate))
+        if failures:
+            with open(os.path.join(output_folder, 'failed.txt'), 'w') as f:
+                for path, error in sorted(failures.items()):
+                    f.write("%s\t%s\n" % (path, error))
+            print("[!] %d images failed, see %s/failed.txt" % (len(failures), output_folder))
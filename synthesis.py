@@ -0,0 +1,120 @@
+from __future__ import division
+import cv2
+import numpy as np
+import scipy.stats as st
+
+# functions for synthesizing images with reflection (details in the paper)
+
+k_sz = np.linspace(1, 5, 80)  # blur sigmas for synthetic images
+
+
+def gkern(kernlen=100, nsig=1):
+    """Returns a 2D Gaussian kernel array."""
+    interval = (2*nsig+1.)/(kernlen)
+    x = np.linspace(-nsig-interval/2., nsig+interval/2., kernlen+1)
+    kern1d = np.diff(st.norm.cdf(x))
+    kernel_raw = np.sqrt(np.outer(kern1d, kern1d))
+    kernel = kernel_raw/kernel_raw.sum()
+    kernel = kernel/kernel.max()
+    return kernel
+
+
+class ReflectionSynthesizer(object):
+    """Float32 version of the reflection synthesis used for training.
+
+    Blur kernels for the sigmas in `k_sz` and the vignetting mask are built
+    once. Intermediate results live in preallocated scratch buffers that
+    only grow, so a call allocates nothing but the outputs, and nothing at
+    all when `out` is given.
+    """
+
+    def __init__(self, sigmas=k_sz, mask_size=560):
+        self.kernels = {}
+        for sigma in sigmas:
+            self.kernel(sigma)
+        # create a vignetting mask
+        self.mask_size = mask_size
+        self.mask = np.float32(gkern(mask_size, 3))
+        self.mask = np.dstack((self.mask, self.mask, self.mask))
+        self.capacity = 0
+        self.scratch = None
+
+    def kernel(self, sigma):
+        sigma = float(sigma)
+        if sigma not in self.kernels:
+            sz = int(2*np.ceil(2*sigma)+1)
+            self.kernels[sigma] = cv2.getGaussianKernel(sz, sigma, cv2.CV_32F)
+        return self.kernels[sigma]
+
+    def _buffers(self, shape):
+        size = int(np.prod(shape))
+        if size > self.capacity:
+            self.capacity = size
+            self.scratch = [np.empty(size, dtype=np.float32)
+                            for _ in range(4)]
+        return [buf[:size].reshape(shape) for buf in self.scratch]
+
+    def synthesize(self, t, r, sigma, out=None):
+        """Same contract as `syn_data` for a single [h, w, 3] pair."""
+        if out is not None:
+            out = [o[np.newaxis] for o in out]
+        t, r_blur_mask, blend = self.synthesize_batch(
+            t[np.newaxis], r[np.newaxis], [sigma], out=out)
+        return t[0], r_blur_mask[0], blend[0]
+
+    def synthesize_batch(self, t, r, sigmas, out=None):
+        """Blends a batch of [n, h, w, 3] transmission/reflection layers.
+
+        Random draws happen per sample in the same order as sequential
+        `syn_data` calls, so a seeded run produces the same images.
+        """
+        n, h, w = t.shape[0:3]
+        params = []
+        for _ in range(n):
+            att = 1.08+np.random.random()/10.0
+            neww = np.random.randint(0, self.mask_size-w-10)
+            newh = np.random.randint(0, self.mask_size-h-10)
+            alpha2 = 1-np.random.random()/5.0
+            params.append((att, neww, newh, alpha2))
+        if out is None:
+            out = [np.empty((n, h, w, 3), dtype=np.float32) for _ in range(3)]
+        t_out, r_out, blend_out = out
+        t_lin, r_lin, r_blur, blend = self._buffers((n, h, w, 3))
+
+        np.power(t, 2.2, out=t_lin)
+        np.power(r, 2.2, out=r_lin)
+        for i in range(n):
+            k = self.kernel(sigmas[i])
+            cv2.sepFilter2D(r_lin[i], -1, k, k, dst=r_blur[i],
+                            borderType=cv2.BORDER_DEFAULT)
+        np.add(r_blur, t_lin, out=blend)
+
+        # remove the mean overexposure of every channel from the reflection
+        mask = np.greater(blend, 1, out=r_lin)
+        for i, (att, neww, newh, alpha2) in enumerate(params):
+            count = np.array(cv2.sumElems(mask[i])[0:3])
+            np.multiply(blend[i], mask[i], out=mask[i])
+            mean = np.maximum(1., np.array(cv2.sumElems(mask[i])[0:3])/(count+1e-6))
+            cv2.subtract(r_blur[i], tuple((mean-1)*att)+(0,), dst=r_blur[i])
+            np.clip(r_blur[i], 0, 1, out=r_blur[i])
+            # fade the reflection with a random crop of the vignetting mask
+            alpha1 = self.mask[newh:newh+h, neww:neww+w, :]
+            np.multiply(r_blur[i], alpha1, out=r_blur[i])
+            np.multiply(t_lin[i], alpha2, out=blend[i])
+        np.add(blend, r_blur, out=blend)
+
+        np.copyto(t_out, t)
+        np.power(r_blur, 1/2.2, out=r_out)
+        np.power(blend, 1/2.2, out=blend_out)
+        np.clip(blend_out, 0, 1, out=blend_out)
+        return t_out, r_out, blend_out
+
+
+_synthesizer = None
+
+
+def syn_data(t, r, sigma):
+    global _synthesizer
+    if _synthesizer is None:
+        _synthesizer = ReflectionSynthesizer()
+    return _synthesizer.synthesize(t, r, sigma)
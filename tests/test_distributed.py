@@ -0,0 +1,52 @@
+import os
+import multiprocessing
+import numpy as np
+import pytest
+from distributed import SharedAllReduce, flatten, shared_path, unflatten
+
+G_SIZE, D_SIZE, EXTRA = 50, 300, 6
+
+
+def _rank(rank, num_workers, name, barrier, results):
+    # sized like the training workers: the broadcast of both networks is
+    # larger than any single gradient vector
+    reducer = SharedAllReduce(name, rank, num_workers, max(G_SIZE+D_SIZE, G_SIZE+EXTRA), barrier)
+    weights = reducer.broadcast(np.arange(G_SIZE+D_SIZE, dtype=np.float32)*(rank+1))
+    ok = bool((weights == np.arange(G_SIZE+D_SIZE)).all())
+    for step in range(20):
+        d = reducer.allreduce(np.full(D_SIZE, rank+step, np.float32))
+        g = reducer.allreduce(np.arange(G_SIZE+EXTRA, dtype=np.float32)*rank+step)
+        mean_rank = (num_workers-1)/2.0
+        ok = ok and np.allclose(d, mean_rank+step)
+        ok = ok and np.allclose(g, np.arange(G_SIZE+EXTRA)*mean_rank+step)
+    try:
+        reducer.allreduce(np.zeros(G_SIZE+D_SIZE+1, np.float32))
+        ok = False
+    except ValueError:
+        pass
+    reducer.close()
+    results.put((rank, ok))
+
+
+@pytest.mark.parametrize("num_workers", [2, 3])
+def test_shared_allreduce(num_workers):
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(num_workers)
+    results = ctx.Queue()
+    name = shared_path('reflection_removal_test_%d_%d' % (os.getpid(), num_workers))
+    workers = [ctx.Process(target=_rank, args=(rank, num_workers, name, barrier, results))
+               for rank in range(num_workers)]
+    for p in workers:
+        p.start()
+    outcomes = sorted(results.get(timeout=60) for _ in workers)
+    for p in workers:
+        p.join(timeout=60)
+        assert p.exitcode == 0
+    assert outcomes == [(rank, True) for rank in range(num_workers)]
+    assert not os.path.exists(name)
+
+
+def test_flatten_roundtrip():
+    arrays = [np.ones((2, 3)), np.arange(4).reshape(1, 4)]
+    for a, b in zip(unflatten(flatten(arrays), [(2, 3), (1, 4)]), arrays):
+        assert (a == b).all()
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+inference = pytest.importorskip("inference")
+
+
+def test_tile_size_for_budget():
+    minimum = inference.min_tile_memory_mb()
+    assert inference.tile_size_for_budget(minimum) == 16
+    assert inference.tile_size_for_budget(8192) % 16 == 0
+    assert inference.tile_size_for_budget(8192) > inference.tile_size_for_budget(4096)
+    with pytest.raises(ValueError):
+        inference.tile_size_for_budget(minimum-1)
+    # a smaller halo needs a smaller budget
+    assert inference.min_tile_memory_mb(halo=64) < minimum
+    # the projected hypercolumn gets larger tiles from the same budget
+    assert inference.min_tile_memory_mb(projected=True) < minimum
+    assert inference.tile_size_for_budget(4096) == 96
+    assert inference.tile_size_for_budget(4096, projected=True) == 960
+    assert inference.tile_overhead(96) == 36.0
+
+
+def test_run_tiled_matches_untiled():
+    benchmark = pytest.importorskip("benchmark")
+    # a small randomly initialised generator: without hypercolumn the
+    # projected g_conv0 only sees the image, no vgg19 is built
+    sess, input, output, _ = benchmark.generator_session(False, True, '', seed=0)
+    # not a multiple of 16, and larger than one haloed tile in both directions
+    image = benchmark.synthetic_images(1, 530, 601, seed=1)[0]
+    full = sess.run(output, feed_dict={input: image[np.newaxis]})
+    with sess.graph.as_default():
+        tiled = inference.run_tiled(sess, input, [output], image, 256)[0]
+    sess.close()
+    assert tiled.shape == full.shape
+    assert np.abs(tiled-full).max() <= 1e-3*max(1.0, np.abs(full).max())
+
+
+def test_result_defaults_halo():
+    from manifest import RESULT_DEFAULTS
+    assert RESULT_DEFAULTS['tile_halo'] == inference.GENERATOR_HALO
@@ -0,0 +1,35 @@
+import os
+import pytest
+from manifest import RESULT_DEFAULTS, ResultManifest, model_identity, result_identity
+
+
+def test_result_identity_defaults(tmp_path):
+    model = str(tmp_path/'frozen.pb')
+    open(model, 'w').close()
+    default = result_identity(model, hyper=True, projected=0, tile_memory_mb=0)
+    assert default == model_identity(model, hyper=True, projected=0, tile_memory_mb=0, **RESULT_DEFAULTS)
+    assert default == result_identity(model, hyper=True, projected=0, tile_memory_mb=0, tile_stats='exact')
+    assert default != result_identity(model, hyper=True, projected=0, tile_memory_mb=0, format='jpg')
+    with pytest.raises(ValueError):
+        result_identity(model, hyper=True, projected=0, tile_memory_mb=0, write_format='jpg')
+
+
+def test_result_manifest_pending(tmp_path):
+    images = []
+    for name in ('a.jpg', 'a.png'):
+        images.append(str(tmp_path/name))
+        with open(images[-1], 'wb') as f:
+            f.write(name.encode())
+    path = str(tmp_path/'manifest.sqlite')
+    manifest = ResultManifest(path, 'model')
+    assert manifest.pending(images) == images
+    for image in images:
+        manifest.done(image)
+    manifest.close()
+    manifest = ResultManifest(path, 'model')
+    assert manifest.pending(images) == []
+    manifest.close()
+    manifest = ResultManifest(path, 'other model')
+    assert manifest.pending(images) == images
+    manifest.close()
+    assert os.path.exists(path)
@@ -0,0 +1,21 @@
+import pytest
+
+profiler = pytest.importorskip("profiler")
+
+
+@pytest.mark.parametrize("name,group", [
+    ("vgg19/conv1_1/Conv2D", "vgg19"),
+    ("vgg19_1/conv1_1/Conv2D", "vgg19"),
+    ("g_conv1/Conv2D", "g_conv1"),
+    ("g_conv_last_1/BiasAdd", "g_conv_last"),
+    ("discriminator_1/layer_3/conv/Conv2D", "discriminator/layer_3"),
+    ("percep_loss/vgg19/conv2_2/Relu", "percep_loss/vgg19"),
+    ("percep_loss_1/vgg19_2/conv2_2/Relu", "percep_loss/vgg19"),
+    ("percep_loss_1/Mean", "percep_loss"),
+    ("exclusion_loss_1/mul", "exclusion_loss"),
+    ("gradients/percep_loss_1/vgg19/conv2_2/Relu_grad/ReluGrad", "gradients/percep_loss/vgg19"),
+    ("gradients_1/discriminator/layer_1/conv/Conv2D_grad/Conv2DBackpropInput", "gradients/discriminator/layer_1"),
+    ("Adam/update_g_conv1/weights/ApplyAdam", "Adam"),
+])
+def test_op_group(name, group):
+    assert profiler.op_group(name) == group
@@ -0,0 +1,124 @@
+import os
+import json
+import threading
+import http.client
+import numpy as np
+import pytest
+
+server = pytest.importorskip("server")
+
+
+class FakeSession(object):
+    """Returns the input and half the input, and records the batch sizes."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def run(self, fetches, feed_dict):
+        images = list(feed_dict.values())[0]
+        with self.lock:
+            self.batches.append(images.shape)
+        threading.Event().wait(self.delay)
+        return [images, images*0.5]
+
+
+def _images(n, shape):
+    return [np.full(shape, i, np.uint8) for i in range(n)]
+
+
+def test_dynamic_batcher_batches_equal_shapes():
+    sess = FakeSession(delay=0.01)
+    batcher = server.DynamicBatcher(sess, 'input', ['t', 'r'], batch_size=4, max_latency=0.2)
+    images = _images(8, (8, 12, 3))+_images(3, (16, 8, 3))
+    outputs = [None]*len(images)
+
+    def request(i):
+        outputs[i] = batcher.process(images[i])
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(len(images))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+    for image, (output_t, output_r) in zip(images, outputs):
+        assert np.allclose(output_t, image/255.0)
+        assert np.allclose(output_r, image/255.0*0.5)
+    assert all(shape[0] <= 4 for shape in sess.batches)
+    assert sum(shape[0] for shape in sess.batches) == len(images)
+    assert len(sess.batches) < len(images)
+    stats = batcher.stats()
+    assert stats['requests'] == len(images) and stats['queue_depth'] == 0
+    assert stats['batches'] == len(sess.batches)
+
+
+def test_dynamic_batcher_waits_at_most_max_latency():
+    sess = FakeSession()
+    batcher = server.DynamicBatcher(sess, 'input', ['t', 'r'], batch_size=4, max_latency=0.05)
+    output_t, _ = batcher.process(np.zeros((4, 4, 3), np.uint8))
+    assert output_t.shape == (4, 4, 3)
+    assert sess.batches == [(1, 4, 4, 3)]
+    assert batcher.stats()['latency_p50_ms'] < 1000
+
+
+def test_dynamic_batcher_reports_errors():
+    class FailingSession(object):
+        def run(self, fetches, feed_dict):
+            raise RuntimeError("out of memory")
+
+    batcher = server.DynamicBatcher(FailingSession(), 'input', ['t', 'r'], batch_size=2, max_latency=0.01)
+    with pytest.raises(RuntimeError):
+        batcher.process(np.zeros((4, 4, 3), np.uint8))
+
+
+@pytest.fixture
+def http_server():
+    server.Handler.batcher = server.DynamicBatcher(FakeSession(), 'input', ['t', 'r'],
+                                                   batch_size=4, max_latency=0.05)
+    httpd = server.ThreadingHTTPServer(('127.0.0.1', 0), server.Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _post(port, body):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('POST', '/separate', body)
+    response = conn.getresponse()
+    reply = json.loads(response.read().decode())
+    conn.close()
+    return response.status, reply
+
+
+def test_handler_rejects_non_object_bodies(http_server):
+    for body in ('[1, 2]', '"path"', '3', 'not json'):
+        status, reply = _post(http_server, body)
+        assert status == 400, body
+        assert 'error' in reply
+
+
+def test_handler_writes_unique_outputs(http_server, tmp_path):
+    import cv2
+    path = str(tmp_path/'photo.png')
+    cv2.imwrite(path, np.full((8, 8, 3), 128, np.uint8))
+    output_dir = str(tmp_path/'out')
+    replies = [_post(http_server, json.dumps({'path': path, 'output_dir': output_dir})) for _ in range(2)]
+    assert [status for status, _ in replies] == [200, 200]
+    written = [reply[key] for _, reply in replies for key in ('t_output', 'r_output')]
+    assert len(set(written)) == 4
+    assert all(os.path.basename(p).startswith('photo_') and os.path.exists(p) for p in written)
+
+
+def test_handler_reports_write_errors(http_server, tmp_path):
+    import cv2
+    path = str(tmp_path/'photo.png')
+    cv2.imwrite(path, np.full((8, 8, 3), 128, np.uint8))
+    blocker = tmp_path/'file'
+    blocker.write_text('')
+    status, reply = _post(http_server, json.dumps({'path': path, 'output_dir': str(blocker/'out')}))
+    assert status == 500
+    assert 'could not write' in reply['error']
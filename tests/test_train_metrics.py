@@ -0,0 +1,28 @@
+import json
+from train_metrics import RunningStat, TrainMetrics
+
+
+def test_creates_missing_folder(tmp_path):
+    for name in ('train_metrics.csv', 'train_metrics.jsonl'):
+        path = tmp_path/'new_task'/name
+        metrics = TrainMetrics(str(path), ['loss', 'exclusion_loss'])
+        metrics.update(0, 1, loss=0.5)
+        metrics.update(1, 1, loss=1.5, exclusion_loss=2.0)
+        stats = metrics.end_epoch()
+        metrics.close()
+        assert stats['loss']['mean'] == 1.0
+        assert stats['exclusion_loss']['count'] == 1
+        lines = path.read_text().splitlines()
+        if name.endswith('.jsonl'):
+            assert [json.loads(line)['step'] for line in lines] == [0, 1]
+        else:
+            assert lines[0].split('\t') == ['step', 'epoch', 'time', 'loss', 'exclusion_loss']
+            assert len(lines) == 3
+
+
+def test_running_stat():
+    stat = RunningStat()
+    for value in (1, 2, 3):
+        stat.update(value)
+    assert stat.mean == 2.0 and stat.min == 1.0 and stat.max == 3.0
+    assert 1.0 < stat.smoothed < 3.0
@@ -0,0 +1,34 @@
+import os
+import numpy as np
+from dataset_manifest import output_names
+from manifest import ResultManifest
+from writer import ResultWriter
+
+
+def test_output_names():
+    assert output_names(['d/a.jpg', 'd/a.png', 'd/b.jpg']) == ['a_jpg', 'a_png', 'b']
+    assert output_names(['d/x/a.jpg', 'd/y/a.jpg']) == ['x_a_jpg', 'y_a_jpg']
+    assert output_names(['d/a.jpg', 'd/a.png', 'd/a_jpg.png']) == ['a_jpg', 'a_png', 'a_jpg_1']
+
+
+def test_shared_stems_get_their_own_folders(tmp_path):
+    inputs = []
+    for i, name in enumerate(('a.jpg', 'a.png')):
+        inputs.append(str(tmp_path/name))
+        with open(inputs[-1], 'wb') as f:
+            f.write(name.encode())
+    output = tmp_path/'results'
+    manifest = ResultManifest(str(tmp_path/'manifest.sqlite'), 'model')
+    assert manifest.pending(inputs) == inputs
+    writer = ResultWriter(str(output), num_workers=2, on_written=manifest.done)
+    for i, (name, path) in enumerate(zip(output_names(inputs), inputs)):
+        image = np.full((4, 4, 3), 0.25*(i+1), np.float32)
+        writer.submit(name, path, image, image, image)
+    writer.close()
+    manifest.close()
+    assert sorted(os.listdir(str(output))) == ['a_jpg', 'a_png']
+    for name in ('a_jpg', 'a_png'):
+        assert sorted(os.listdir(str(output/name))) == ['input.png', 'r_output.png', 't_output.png']
+    manifest = ResultManifest(str(tmp_path/'manifest.sqlite'), 'model')
+    assert manifest.pending(inputs) == []
+    manifest.close()
@@ -0,0 +1,121 @@
+from __future__ import division
+import os
+import json
+import time
+
+# running statistics of the training losses and timings, updated in
+# constant time per iteration and logged in batches
+
+
+class RunningStat(object):
+    """Count, mean, exponential moving average, min and max of a value."""
+
+    def __init__(self, decay=0.98):
+        self.decay = decay
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.ema = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def update(self, value):
+        value = float(value)
+        self.count += 1
+        self.mean += (value-self.mean)/self.count
+        self.ema = self.decay*self.ema+(1-self.decay)*value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def smoothed(self):
+        # bias corrected so the first values are not pulled towards 0
+        return self.ema/(1-self.decay**self.count) if self.count else 0.0
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'ema': self.smoothed,
+                'min': self.min, 'max': self.max}
+
+
+class TrainMetrics(object):
+    """Per-epoch statistics and log of named training values.
+
+    `update(step, epoch, **values)` updates the statistics of every value
+    given; values that do not apply to an iteration (e.g. the exclusion
+    loss of a real image) are left out instead of being recorded as 0. The
+    values of every iteration are buffered and appended to `path`, CSV or
+    JSON lines depending on its extension, at most every `flush_interval`
+    seconds. With `tensorboard_dir` they are also written as TensorBoard
+    summaries.
+    """
+
+    def __init__(self, path, names, flush_interval=30.0, decay=0.98, tensorboard_dir=''):
+        self.path = path
+        self.names = list(names)
+        self.jsonl = path.endswith('.jsonl')
+        self.flush_interval = flush_interval
+        self.epoch_stats = dict((name, RunningStat(decay)) for name in self.names)
+        self.buffer = []
+        self.last_flush = time.time()
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        if not self.jsonl and not os.path.exists(path):
+            with open(path, 'w') as f:
+                f.write('\t'.join(['step', 'epoch', 'time']+self.names)+'\n')
+        self.summary_writer = None
+        if tensorboard_dir:
+            import tensorflow as tf
+            self.summary_writer = tf.summary.FileWriter(tensorboard_dir)
+
+    def update(self, step, epoch, **values):
+        values = dict((name, float(value)) for name, value in values.items())
+        for name, value in values.items():
+            self.epoch_stats[name].update(value)
+        self.buffer.append((step, epoch, time.time(), values))
+        if time.time()-self.last_flush > self.flush_interval:
+            self.flush()
+
+    def mean(self, name):
+        """Mean of `name` over the current epoch."""
+        return self.epoch_stats[name].mean
+
+    def ema(self, name):
+        return self.epoch_stats[name].smoothed
+
+    def end_epoch(self):
+        """Flushes the log and returns the statistics of the epoch, then resets them."""
+        self.flush()
+        stats = dict((name, stat.as_dict()) for name, stat in self.epoch_stats.items())
+        for stat in self.epoch_stats.values():
+            stat.reset()
+        return stats
+
+    def flush(self):
+        if not self.buffer:
+            return
+        with open(self.path, 'a') as f:
+            for step, epoch, t, values in self.buffer:
+                if self.jsonl:
+                    record = dict(values, step=step, epoch=epoch, time=t)
+                    f.write(json.dumps(record, sort_keys=True)+'\n')
+                else:
+                    f.write('\t'.join(['%d' % step, '%d' % epoch, '%.3f' % t] +
+                                      ['%.6g' % values[name] if name in values else ''
+                                       for name in self.names])+'\n')
+        if self.summary_writer is not None:
+            import tensorflow as tf
+            for step, _, _, values in self.buffer:
+                summary = tf.Summary(value=[tf.Summary.Value(tag=name, simple_value=value)
+                                            for name, value in sorted(values.items())])
+                self.summary_writer.add_summary(summary, step)
+            self.summary_writer.flush()
+        self.buffer = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        if self.summary_writer is not None:
+            self.summary_writer.close()
@@ -0,0 +1,187 @@
+from __future__ import division
+import tensorflow as tf
+from discriminator import build_discriminator
+from model import build
+from vgg import build_vgg19
+
+# training graph of the generator and the discriminator
+
+EPS = 1e-12
+
+
+# functions to compute different loss terms
+
+
+def compute_l1_loss(input, output):
+    return tf.reduce_mean(tf.abs(input-output))
+
+
+# vgg19 features compared by the perceptual loss and their weights
+PERCEP_LAYERS = [('input', 1.), ('conv1_2', 1/2.6), ('conv2_2', 1/4.8),
+                 ('conv3_2', 1/3.7), ('conv4_2', 1/5.6), ('conv5_2', 10/1.5)]
+
+
+def compute_percep_losses(inputs, outputs):
+    # perceptual loss between every inputs[i] and outputs[i]. All inputs go
+    # through one batched vgg19 pass, and all outputs, which are constant
+    # targets, through a second one without backward pass
+    with tf.name_scope('percep_loss'):
+        vgg_fake = build_vgg19(tf.concat(inputs, axis=0)*255.0)
+        vgg_real = build_vgg19(tf.stop_gradient(tf.concat(outputs, axis=0))*255.0)
+        losses = [0.]*len(inputs)
+        for layer, weight in PERCEP_LAYERS:
+            fake = tf.split(vgg_fake[layer], len(inputs), axis=0)
+            real = tf.split(vgg_real[layer], len(inputs), axis=0)
+            for i in range(len(inputs)):
+                losses[i] += compute_l1_loss(real[i], fake[i])*weight
+    return losses
+
+
+def compute_percep_loss(input, output):
+    return compute_percep_losses([input], [output])[0]
+
+
+def compute_exclusion_loss(img1, img2, level=1):
+    with tf.name_scope('exclusion_loss'):
+        gradx_loss = []
+        grady_loss = []
+
+        for l in range(level):
+            gradx1, grady1 = compute_gradient(img1)
+            gradx2, grady2 = compute_gradient(img2)
+            alphax = 2.0*tf.reduce_mean(tf.abs(gradx1)) / \
+                tf.reduce_mean(tf.abs(gradx2))
+            alphay = 2.0*tf.reduce_mean(tf.abs(grady1)) / \
+                tf.reduce_mean(tf.abs(grady2))
+
+            gradx1_s = (tf.nn.sigmoid(gradx1)*2)-1
+            grady1_s = (tf.nn.sigmoid(grady1)*2)-1
+            gradx2_s = (tf.nn.sigmoid(gradx2*alphax)*2)-1
+            grady2_s = (tf.nn.sigmoid(grady2*alphay)*2)-1
+
+            gradx_loss.append(tf.reduce_mean(tf.multiply(
+                tf.square(gradx1_s), tf.square(gradx2_s)), reduction_indices=[1, 2, 3])**0.25)
+            grady_loss.append(tf.reduce_mean(tf.multiply(
+                tf.square(grady1_s), tf.square(grady2_s)), reduction_indices=[1, 2, 3])**0.25)
+
+            img1 = tf.nn.avg_pool(img1, [1, 2, 2, 1], [1, 2, 2, 1], padding='SAME')
+            img2 = tf.nn.avg_pool(img2, [1, 2, 2, 1], [1, 2, 2, 1], padding='SAME')
+        return gradx_loss, grady_loss
+
+
+def compute_gradient(img):
+    gradx = img[:, 1:, :, :]-img[:, :-1, :, :]
+    grady = img[:, :, 1:, :]-img[:, :, :-1, :]
+    return gradx, grady
+
+
+class TrainingGraph(object):
+    """Placeholders, losses and train ops of the adversarial training.
+
+    Synthetic and real images are trained with separate losses and train
+    ops, real images have no reflection ground truth so the reflection
+    losses are never computed for them. `g_fetches[is_syn]` runs the
+    generator step of a batch and, with `fused_update`, `fused_steps[is_syn]`
+    updates the discriminator and the generator in the same run.
+
+    With `replicated`, for data-parallel training, the first element of
+    `g_fetches[is_syn]` and `d_opt` are the gradients instead of the train
+    ops. Averaged gradients are fed to `g_grad_inputs` and `d_grad_inputs`
+    and applied by `g_apply` and `d_apply`.
+    """
+
+    def __init__(self, hyper=True, projected=False, lr=(0.0002, 0.0001), fused_update=False,
+                 replicated=False):
+        with tf.variable_scope(tf.get_variable_scope()):
+            self.input = tf.placeholder(tf.float32, shape=[None, None, None, 3])
+            self.target = tf.placeholder(tf.float32, shape=[None, None, None, 3])
+            self.reflection = tf.placeholder(tf.float32, shape=[None, None, None, 3])
+            self._build_losses(hyper, projected)
+
+        train_vars = tf.trainable_variables()
+        self.d_vars = [var for var in train_vars if 'discriminator' in var.name]
+        self.g_vars = [var for var in train_vars if 'g_' in var.name]
+        # TODO: allow to modify the lr during train. https://github.com/ibab/tensorflow-wavenet/issues/267
+        # both generator train ops share the same optimizer and thus the same Adam slots
+        self.g_optimizer = tf.train.AdamOptimizer(learning_rate=lr[0])
+        self.d_optimizer = tf.train.AdamOptimizer(learning_rate=lr[1])
+        if replicated:
+            self._build_replicated()
+        else:
+            self.g_opt_syn = self.g_optimizer.minimize(
+                self.loss_syn*100+self.g_loss, var_list=self.g_vars)  # optimizer for the generator
+            self.g_opt_real = self.g_optimizer.minimize(
+                self.loss_real*100+self.g_loss, var_list=self.g_vars)
+            self.d_opt = self.d_optimizer.minimize(
+                self.d_loss, var_list=self.d_vars)  # optimizer for the discriminator
+
+        # generator step of the training loop for synthetic (True) and real (False) batches
+        self.g_fetches = {
+            True: [self.g_opt_syn, self.transmission_layer, self.reflection_layer, self.d_loss,
+                   self.g_loss, self.loss_syn, self.loss_percep_syn, self.loss_grad_syn],
+            False: [self.g_opt_real, self.transmission_layer, self.reflection_layer, self.d_loss,
+                    self.g_loss, self.loss_real, self.loss_percep_real, self.loss_grad_real],
+        }
+        if fused_update:
+            self.fused_steps = {True: self._fused_step(self.loss_syn*100+self.g_loss),
+                                False: self._fused_step(self.loss_real*100+self.g_loss)}
+
+    def _build_losses(self, hyper, projected):
+        input, target, reflection = self.input, self.target, self.reflection
+        # build the model
+        network = build(input, hyper=hyper, projected=projected)
+        transmission_layer, reflection_layer = tf.split(
+            network, num_or_size_splits=2, axis=3)
+        self.transmission_layer, self.reflection_layer = transmission_layer, reflection_layer
+
+        # Perceptual Loss
+        loss_percep_t, loss_percep_r = compute_percep_losses(
+            [transmission_layer, reflection_layer], [target, reflection])
+        self.loss_percep_syn = loss_percep_t+loss_percep_r
+        self.loss_percep_real = compute_percep_loss(transmission_layer, target)
+
+        # Adversarial Loss
+        with tf.variable_scope("discriminator"):
+            predict_real, pred_real_dict = build_discriminator(input, target)
+        with tf.variable_scope("discriminator", reuse=True):
+            predict_fake, pred_fake_dict = build_discriminator(
+                input, transmission_layer)
+
+        self.d_loss = (tf.reduce_mean(-(tf.log(predict_real + EPS) +
+                                        tf.log(1 - predict_fake + EPS)))) * 0.5
+        self.g_loss = tf.reduce_mean(-tf.log(predict_fake + EPS))
+
+        # L1 loss on reflection image
+        loss_l1_r = compute_l1_loss(reflection_layer, reflection)
+
+        # Gradient loss
+        loss_gradx, loss_grady = compute_exclusion_loss(
+            transmission_layer, reflection_layer, level=3)
+        loss_gradxy = tf.reduce_mean(sum(loss_gradx)/3.) + \
+            tf.reduce_mean(sum(loss_grady)/3.)
+        self.loss_grad_syn = loss_gradxy/2.0
+        self.loss_grad_real = tf.constant(0.)
+
+        self.loss_syn = loss_l1_r+self.loss_percep_syn*0.2+self.loss_grad_syn
+        self.loss_real = self.loss_percep_real*0.2
+
+    def _build_replicated(self):
+        def gradients(optimizer, loss, var_list):
+            return [grad for grad, _ in optimizer.compute_gradients(loss, var_list=var_list)]
+        self.g_opt_syn = gradients(self.g_optimizer, self.loss_syn*100+self.g_loss, self.g_vars)
+        self.g_opt_real = gradients(self.g_optimizer, self.loss_real*100+self.g_loss, self.g_vars)
+        self.d_opt = gradients(self.d_optimizer, self.d_loss, self.d_vars)
+        self.g_grad_inputs = [tf.placeholder(tf.float32, var.shape) for var in self.g_vars]
+        self.d_grad_inputs = [tf.placeholder(tf.float32, var.shape) for var in self.d_vars]
+        self.g_apply = self.g_optimizer.apply_gradients(zip(self.g_grad_inputs, self.g_vars))
+        self.d_apply = self.d_optimizer.apply_gradients(zip(self.d_grad_inputs, self.d_vars))
+
+    def _fused_step(self, g_total_loss):
+        # updates the discriminator and the generator from a single forward
+        # pass. The discriminator is only updated once the generator gradients,
+        # which read its weights, have been computed
+        g_grads = self.g_optimizer.compute_gradients(g_total_loss, var_list=self.g_vars)
+        d_grads = self.d_optimizer.compute_gradients(self.d_loss, var_list=self.d_vars)
+        with tf.control_dependencies([grad for grad, _ in g_grads if grad is not None]):
+            d_step = self.d_optimizer.apply_gradients(d_grads)
+        return tf.group(self.g_optimizer.apply_gradients(g_grads), d_step)
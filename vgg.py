@@ -0,0 +1,90 @@
+from __future__ import division
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+# pre-trained vgg19 used for the hypercolumn features and the perceptual loss
+
+VGG_MAT_PATH = './VGG_Model/imagenet-vgg-verydeep-19.mat'
+VGG_NPZ_PATH = './VGG_Model/vgg19_conv5_2.npz'
+
+# (name, index in the .mat layer list, input channels, output channels) of
+# the convolutions up to conv5_2, the deepest layer the model uses
+VGG_LAYERS = [
+    ('conv1_1', 0, 3, 64), ('conv1_2', 2, 64, 64),
+    ('conv2_1', 5, 64, 128), ('conv2_2', 7, 128, 128),
+    ('conv3_1', 10, 128, 256), ('conv3_2', 12, 256, 256),
+    ('conv3_3', 14, 256, 256), ('conv3_4', 16, 256, 256),
+    ('conv4_1', 19, 256, 512), ('conv4_2', 21, 512, 512),
+    ('conv4_3', 23, 512, 512), ('conv4_4', 25, 512, 512),
+    ('conv5_1', 28, 512, 512), ('conv5_2', 30, 512, 512),
+]
+VGG_WEIGHTS = 'vgg19_weights'
+
+
+def convert_vgg19(mat_path=VGG_MAT_PATH, npz_path=VGG_NPZ_PATH):
+    """Extracts the float32 weights up to conv5_2 from the MatConvNet model."""
+    import scipy.io
+    vgg_layers = scipy.io.loadmat(mat_path)['layers'][0]
+    arrays = {}
+    for name, i, _, _ in VGG_LAYERS:
+        arrays[name+'/weights'] = np.float32(vgg_layers[i][0][0][2][0][0])
+        bias = vgg_layers[i][0][0][2][0][1]
+        arrays[name+'/biases'] = np.float32(np.reshape(bias, (bias.size)))
+    np.savez(npz_path, **arrays)
+    print("[i] Converted %s to %s" % (mat_path, npz_path))
+
+
+def load_vgg19_weights(sess, npz_path=VGG_NPZ_PATH, mat_path=VGG_MAT_PATH):
+    """Loads the pre-trained weights into the vgg19 variables of the graph.
+
+    The compact weight file is created from the .mat model on first use.
+    """
+    st = time.time()
+    if not os.path.isfile(npz_path):
+        convert_vgg19(mat_path, npz_path)
+    weights = np.load(npz_path)
+    for var in tf.get_collection(VGG_WEIGHTS):
+        # vgg19/conv1_1/weights:0 -> conv1_1/weights
+        var.load(weights[var.op.name.split('/', 1)[1]], sess)
+    print("[i] Loaded pre-trained vgg19 parameters in %.2fs" % (time.time()-st))
+
+
+def get_weight_bias(name, nin, nout):
+    # the weights are created once and shared by every vgg19 in the graph.
+    # They are local variables, so checkpoints do not store them, and they
+    # are initialized from zeros so the GraphDef does not embed them
+    with tf.variable_scope(name):
+        weights = tf.get_variable('weights', [3, 3, nin, nout], trainable=False,
+                                  initializer=tf.zeros_initializer(),
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES, VGG_WEIGHTS])
+        bias = tf.get_variable('biases', [nout], trainable=False,
+                               initializer=tf.zeros_initializer(),
+                               collections=[tf.GraphKeys.LOCAL_VARIABLES, VGG_WEIGHTS])
+    return weights, bias
+
+
+def build_net(ntype, nin, nwb=None, name=None):
+    if ntype == 'conv':
+        return tf.nn.relu(tf.nn.conv2d(nin, nwb[0], strides=[1, 1, 1, 1], padding='SAME', name=name)+nwb[1])
+    elif ntype == 'pool':
+        return tf.nn.avg_pool(nin, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
+
+
+# build VGG19 to load pre-trained parameters
+def build_vgg19(input):
+    with tf.variable_scope("vgg19", reuse=tf.AUTO_REUSE):
+        net = {}
+        net['input'] = input - \
+            np.array([123.6800, 116.7790, 103.9390]).reshape((1, 1, 1, 3))
+        current = net['input']
+        for name, _, nin, nout in VGG_LAYERS:
+            if name.endswith('_1') and name != 'conv1_1':
+                # pool after the last convolution of every block
+                current = build_net('pool', current)
+                net['pool%d' % (int(name[4])-1)] = current
+            current = build_net('conv', current, get_weight_bias(
+                name, nin, nout), name='vgg_'+name)
+            net[name] = current
+        return net
@@ -0,0 +1,194 @@
+from __future__ import division
+import os
+import time
+import argparse
+import threading
+from queue import Queue
+import cv2
+import numpy as np
+from inference import load_model, run_lowres
+from writer import to_uint8
+
+# removes reflections from a video: decoding, inference and encoding run
+# as separate stages connected by bounded queues, so memory does not grow
+# with the length of the video
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--task", default="pre-trained",
+                    help="path to folder containing the model")
+parser.add_argument("--frozen_model", default="",
+                    help="Frozen graph written by export.py to use instead of the checkpoint in `task`")
+parser.add_argument("--is_hyper", default=1, type=int,
+                    help="use hypercolumn or not")
+parser.add_argument("--projected_hypercolumn", default=0, type=int,
+                    help="Project the vgg features before upsampling them instead of building the full resolution hypercolumn")
+parser.add_argument("--input", required=True,
+                    help="video to process")
+parser.add_argument("--output", required=True,
+                    help="video of the transmission layer")
+parser.add_argument("--reflection_output", default="",
+                    help="Also write the reflection layer to this video")
+parser.add_argument("--fourcc", default="mp4v",
+                    help="Codec of the output videos")
+parser.add_argument("--batch_size", default=1, type=int,
+                    help="Number of frames run together")
+parser.add_argument("--queue_size", default=8, type=int,
+                    help="Maximum number of batches waiting between two stages")
+parser.add_argument("--reuse_threshold", default=0.0, type=float,
+                    help="Reuse the reflection of the last processed frame when the mean absolute difference "
+                         "to it is below this, 0 processes every frame")
+parser.add_argument("--reuse_max", default=10, type=int,
+                    help="Maximum number of consecutive frames reusing a reflection")
+parser.add_argument("--lowres_pixels", default=0, type=int,
+                    help="Run frames larger than this many pixels at a reduced resolution, 0 disables it")
+
+
+def _read(capture, frames, batch_size):
+    # decoding stage, puts batches of consecutive [h, w, 3] uint8 frames
+    batch = []
+    while True:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        batch.append(frame)
+        if len(batch) == batch_size:
+            frames.put(batch)
+            batch = []
+    if batch:
+        frames.put(batch)
+    frames.put(None)
+
+
+def _write(writers, outputs):
+    # encoding stage
+    while True:
+        batch = outputs.get()
+        if batch is None:
+            break
+        for layers in batch:
+            for writer, layer in zip(writers, layers):
+                writer.write(to_uint8(layer))
+
+
+class ReflectionReuse(object):
+    """Decides which frames reuse the reflection of the last processed frame.
+
+    Frames are compared on a thumbnail; a near-duplicate frame keeps the
+    reflection of the last processed frame and the part of it the network
+    assigned to neither layer, and its transmission is derived from them.
+    """
+
+    def __init__(self, threshold, max_reuse):
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+        self.thumbnail = None
+        self.reflection = None
+        self.residual = None
+        self.n_reused = 0
+        self.count = 0
+
+    def _thumbnail(self, frame):
+        return cv2.resize(frame, (frame.shape[1]//8, frame.shape[0]//8),
+                          interpolation=cv2.INTER_AREA)
+
+    def is_duplicate(self, frame):
+        """Whether `frame` can reuse the reflection of the last key frame."""
+        if self.threshold <= 0:
+            return False
+        thumbnail = self._thumbnail(frame)
+        if (self.thumbnail is not None and self.count < self.max_reuse and
+                np.mean(np.abs(thumbnail-self.thumbnail)) < self.threshold):
+            self.count += 1
+            return True
+        self.thumbnail = thumbnail
+        self.count = 0
+        return False
+
+    def update(self, image, t, r):
+        self.reflection = r
+        self.residual = image-t-r
+
+    def apply(self, image):
+        self.n_reused += 1
+        return image-self.reflection-self.residual, self.reflection
+
+
+def process_video(sess, input, fetches, capture, writers, batch_size=1, queue_size=8,
+                  reuse=None, lowres_pixels=0):
+    """Runs the decode, inference and encode stages until the video ends.
+
+    Returns the number of frames processed.
+    """
+    frames = Queue(maxsize=queue_size)
+    outputs = Queue(maxsize=queue_size)
+    reader = threading.Thread(target=_read, args=(capture, frames, batch_size))
+    encoder = threading.Thread(target=_write, args=(writers, outputs))
+    reader.daemon = encoder.daemon = True
+    reader.start()
+    encoder.start()
+    n_frames, last_print, last_frames = 0, time.time(), 0
+    st = time.time()
+    while True:
+        batch = frames.get()
+        if batch is None:
+            break
+        images = [np.float32(frame)/255.0 for frame in batch]
+        duplicates = [reuse is not None and reuse.is_duplicate(image) for image in images]
+        keys = [image for image, duplicate in zip(images, duplicates) if not duplicate]
+        results = []
+        if lowres_pixels and keys and keys[0].shape[0]*keys[0].shape[1] > lowres_pixels:
+            results = [[o[0] for o in run_lowres(sess, input, fetches, image, lowres_pixels)]
+                       for image in keys]
+        elif keys:
+            t, r = sess.run(fetches, feed_dict={input: np.stack(keys)})
+            results = list(zip(t, r))
+        results = iter(results)
+        layers = []
+        for image, duplicate in zip(images, duplicates):
+            if duplicate:
+                layers.append(reuse.apply(image))
+            else:
+                t, r = next(results)
+                if reuse is not None:
+                    reuse.update(image, t, r)
+                layers.append((t, r))
+        outputs.put(layers)
+        n_frames += len(batch)
+        if time.time()-last_print > 5:
+            print("[i] %d frames, %.2f fps over the last %.0fs, %.2f fps overall, queues %d/%d" % (
+                n_frames, (n_frames-last_frames)/(time.time()-last_print), time.time()-last_print,
+                n_frames/(time.time()-st), frames.qsize(), outputs.qsize()))
+            last_print, last_frames = time.time(), n_frames
+    outputs.put(None)
+    encoder.join()
+    return n_frames
+
+
+if __name__ == '__main__':
+    ARGS = parser.parse_args()
+    print(ARGS)
+    sess, input, transmission_layer, reflection_layer = load_model(
+        ARGS.frozen_model or ARGS.task, hyper=ARGS.is_hyper == 1,
+        projected=ARGS.projected_hypercolumn == 1)
+    capture = cv2.VideoCapture(ARGS.input)
+    if not capture.isOpened():
+        raise IOError("Could not open %s" % ARGS.input)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25
+    size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    fourcc = cv2.VideoWriter_fourcc(*ARGS.fourcc)
+    writers = [cv2.VideoWriter(ARGS.output, fourcc, fps, size)]
+    if ARGS.reflection_output:
+        writers.append(cv2.VideoWriter(ARGS.reflection_output, fourcc, fps, size))
+    for path, writer in zip([ARGS.output, ARGS.reflection_output], writers):
+        if not writer.isOpened():
+            raise IOError("Could not open %s for writing" % path)
+    reuse = ReflectionReuse(ARGS.reuse_threshold, ARGS.reuse_max) if ARGS.reuse_threshold > 0 else None
+    st = time.time()
+    n_frames = process_video(sess, input, [transmission_layer, reflection_layer], capture, writers,
+                             ARGS.batch_size, ARGS.queue_size, reuse, ARGS.lowres_pixels)
+    for writer in writers:
+        writer.release()
+    capture.release()
+    print("[i] Processed %d frames of %s in %.2fs: %.2f fps sustained%s" % (
+        n_frames, os.path.basename(ARGS.input), time.time()-st, n_frames/max(time.time()-st, 1e-6),
+        ", %d frames reused the previous reflection" % reuse.n_reused if reuse else ""))
@@ -0,0 +1,115 @@
+from __future__ import division
+import os
+import time
+import shutil
+import threading
+import cv2
+import numpy as np
+from queue import Queue
+
+# writes the test results on background threads, off the inference path
+
+FORMATS = {
+    'png': ('.png', cv2.IMWRITE_PNG_COMPRESSION),
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),  # quality above 100 is lossless
+}
+
+
+def to_uint8(image):
+    return np.uint8(np.minimum(np.maximum(image, 0.0), 1.0)*255.0)
+
+
+class ResultWriter(object):
+    """Clamps, encodes and writes the outputs of the test loop.
+
+    `submit` hands the arrays of one image to `num_workers` threads through
+    a queue of at most `max_queue` images, and blocks only when the queue
+    is full. With `num_workers=0` the results are written on the calling
+    thread. `outputs` selects among 't' and 'r'; the input is encoded like
+    the outputs, hard-linked from its source file ('link', copied if links
+    are not possible) or not written at all ('skip'). `level` is the PNG
+    compression level or the JPEG/WebP quality. `on_written(source)` is
+    called once all files of an image are written.
+    """
+
+    def __init__(self, folder, num_workers=2, max_queue=16, outputs=('t', 'r'),
+                 format='png', level=None, input_copy='encode', on_written=None):
+        self.folder = folder
+        self.on_written = on_written
+        self.outputs = outputs
+        self.ext, flag = FORMATS[format]
+        self.params = [] if level is None else [flag, level]
+        self.input_copy = input_copy
+        self.num_workers = num_workers
+        self.wait_time = 0.0
+        self.error = None
+        self.workers = []
+        if num_workers > 0:
+            self.queue = Queue(maxsize=max(max_queue, 1))
+            for _ in range(num_workers):
+                thread = threading.Thread(target=self._loop)
+                thread.daemon = True
+                thread.start()
+                self.workers.append(thread)
+
+    def submit(self, testind, source, input_image, output_t, output_r):
+        """Queues the [h, w, 3] float images of one test image."""
+        if self.error is not None:
+            raise self.error
+        item = (testind, source, input_image, output_t, output_r)
+        if self.num_workers == 0:
+            self._write(*item)
+            return
+        st = time.time()
+        self.queue.put(item)
+        self.wait_time += time.time()-st
+
+    def _loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+
+    def _write(self, testind, source, input_image, output_t, output_r):
+        folder = os.path.join(self.folder, testind)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass  # created by another worker
+        if self.input_copy == 'encode':
+            self._imwrite(os.path.join(folder, 'input'+self.ext),
+                          np.uint8(input_image*255.0+0.5))
+        elif self.input_copy == 'link':
+            target = os.path.join(folder, 'input'+os.path.splitext(source)[1])
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+        if 't' in self.outputs:  # output transmission layer
+            self._imwrite(os.path.join(folder, 't_output'+self.ext), to_uint8(output_t))
+        if 'r' in self.outputs:  # output reflection layer
+            self._imwrite(os.path.join(folder, 'r_output'+self.ext), to_uint8(output_r))
+        if self.on_written is not None:
+            self.on_written(source)
+
+    def _imwrite(self, path, image):
+        if not cv2.imwrite(path, image, self.params):
+            raise IOError("Could not write %s" % path)
+
+    def close(self):
+        """Waits for the queued images and stops the workers."""
+        for _ in self.workers:
+            self.queue.put(None)
+        for thread in self.workers:
+            thread.join()
+        self.workers = []
+        if self.error is not None:
+            raise self.error